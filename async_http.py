@@ -0,0 +1,125 @@
+import asyncio
+import json
+from typing import Any, Optional, Tuple
+
+import aiohttp
+
+# Connections kept open at once, in total and to one host
+POOL_SIZE = 200
+POOL_SIZE_PER_HOST = 50
+# A request taking longer than this has failed
+REQUEST_TIMEOUT_SECONDS = 15
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class HttpStatusError(Exception):
+    """Raised by HttpResponse.raise_for_status for 4xx and 5xx responses."""
+
+    def __init__(self, response: "HttpResponse"):
+        super().__init__(f"{response.status_code} for {response.url}")
+        self.response = response
+
+
+class HttpResponse:
+    """
+    A fully read aiohttp response, with the attributes of a requests
+    response that the platform modules and the circuit breakers read.
+    """
+
+    def __init__(
+        self,
+        status_code: int,
+        headers,
+        content: bytes,
+        url: str,
+        history: Tuple["HttpResponse", ...] = (),
+        encoding: Optional[str] = None,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.history = history
+        self.encoding = encoding
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HttpStatusError(self)
+
+
+def session() -> aiohttp.ClientSession:
+    """
+    The client every async lookup shares, created on first use. Its pool
+    keeps connections to each host open, so concurrent lookups cost sockets
+    rather than threads.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            _close_abandoned(_session, _session_loop)
+        _session_loop = loop
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=POOL_SIZE, limit_per_host=POOL_SIZE_PER_HOST
+            ),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        )
+    return _session
+
+
+def _close_abandoned(
+    abandoned: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop
+):
+    # a session belongs to the loop it was created on, which may still run
+    # in another thread or run again later
+    if loop.is_closed():
+        # its connections went with the loop, only the session is left open
+        abandoned.detach()
+    else:
+        asyncio.run_coroutine_threadsafe(abandoned.close(), loop)
+
+
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        if _session_loop is asyncio.get_running_loop():
+            await _session.close()
+        else:
+            _close_abandoned(_session, _session_loop)
+    _session = None
+
+
+async def request(method: str, url: str, **kwargs) -> HttpResponse:
+    """Send a request on the shared client and read the whole response."""
+    async with session().request(method, url, **kwargs) as response:
+        content = await response.read()
+        history = tuple(
+            HttpResponse(hop.status, hop.headers, b"", str(hop.url))
+            for hop in response.history
+        )
+        return HttpResponse(
+            response.status,
+            response.headers,
+            content,
+            str(response.url),
+            history,
+            response.charset,
+        )
+
+
+async def get(url: str, **kwargs) -> HttpResponse:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> HttpResponse:
+    return await request("POST", url, **kwargs)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterable, Awaitable, Callable, Optional, Set
+
+import metrics
+from general_utils import link_key, read_links
+from object_types import CategorizedLink
+
+logger = logging.getLogger(__name__)
+
+# Lookups a backfill runs at once and starts per second, well below what
+# live embeds use
+BACKFILL_CONCURRENCY = 2
+BACKFILL_LOOKUPS_PER_SECOND = 2
+# Seconds between progress reports
+REPORT_INTERVAL_SECONDS = 10
+
+# A coroutine function looking up one link
+Lookup = Callable[[CategorizedLink], Awaitable[Optional[dict]]]
+
+
+class BackfillProgress:
+    """How far a backfill has come, for its progress reports."""
+
+    def __init__(self):
+        self.messages = 0
+        self.links = 0
+        self.cached = 0
+        self.resolved = 0
+        self.failed = 0
+        self.done = False
+        # why the scan stopped early, if it did
+        self.error: Optional[str] = None
+
+    def summary(self) -> str:
+        if self.error:
+            state = f"Backfill stopped ({self.error})"
+        else:
+            state = "Backfill done" if self.done else "Backfilling"
+        return (
+            f"{state}: {self.messages} messages scanned, {self.links} links found, "
+            f"{self.cached} already cached, {self.resolved} resolved, "
+            f"{self.failed} failed"
+        )
+
+
+async def backfill_history(
+    messages: AsyncIterable,
+    resolve: Lookup,
+    cached: Lookup,
+    progress: Optional[BackfillProgress] = None,
+    report: Optional[Callable[[BackfillProgress], Awaitable[None]]] = None,
+    concurrency: int = BACKFILL_CONCURRENCY,
+    lookups_per_second: float = BACKFILL_LOOKUPS_PER_SECOND,
+) -> BackfillProgress:
+    """
+    Resolve every link in a channel's history once, to warm the cache.
+    Links are deduplicated by cache key and those already cached are
+    skipped. Nothing is posted, progress goes to `report` every few seconds
+    and once more at the end, also when reading the history fails. A link
+    that cannot be looked up counts as failed and the scan goes on.
+    Scanning pauses while all lookups are busy, so a long history does not
+    pile up in memory.
+
+    Args:
+        messages: The history, e.g. `channel.history(limit=...)`
+        resolve: Coroutine function resolving one link
+        cached: Coroutine function returning a link's cached parts, if any
+        progress: Counters to update, a new BackfillProgress by default
+        report: Coroutine function called with the progress
+        concurrency: Lookups running at once
+        lookups_per_second: Lookups started per second
+    """
+    progress = progress or BackfillProgress()
+    seen: Set[str] = set()
+    slots = asyncio.Semaphore(concurrency)
+    lookups = set()
+    interval = 1 / lookups_per_second
+    next_start = time.monotonic()
+    reported_at = time.monotonic()
+
+    async def warm(link: CategorizedLink):
+        try:
+            await resolve(link)
+            progress.resolved += 1
+            metrics.increment("backfill_resolved_total")
+        except Exception as e:
+            # remembered by the negative cache like any failed lookup
+            progress.failed += 1
+            logger.debug("Backfill could not resolve %s: %s", link[0], e)
+        finally:
+            slots.release()
+
+    try:
+        async for message in messages:
+            progress.messages += 1
+            for link in read_links([message.content or ""]):
+                key = link_key(link)
+                if key in seen:
+                    continue
+                seen.add(key)
+                progress.links += 1
+                try:
+                    is_cached = await cached(link) is not None
+                except Exception as e:
+                    # e.g. the resolver tier is unreachable
+                    progress.failed += 1
+                    logger.warning("Backfill could not check %s: %s", link[0], e)
+                    continue
+                if is_cached:
+                    progress.cached += 1
+                    continue
+                await slots.acquire()
+                # paced, the lookups share upstream limits with live embeds
+                delay = next_start - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_start = max(next_start, time.monotonic()) + interval
+                lookup = asyncio.ensure_future(warm(link))
+                lookups.add(lookup)
+                lookup.add_done_callback(lookups.discard)
+            if report and time.monotonic() - reported_at >= REPORT_INTERVAL_SECONDS:
+                reported_at = time.monotonic()
+                await report(progress)
+    except Exception as e:
+        progress.error = str(e) or type(e).__name__
+        logger.warning("Backfill stopped reading the history: %s", e)
+        raise
+    finally:
+        # the lookups already started still count
+        await asyncio.gather(*lookups)
+        progress.done = True
+        logger.info(progress.summary())
+        if report:
+            await report(progress)
+    return progress
@@ -1,13 +1,19 @@
+import asyncio
 import json
 import os
 import re
 from datetime import datetime, timezone
 
+import aiohttp
 import requests
 from babel.numbers import format_currency
 from bs4 import BeautifulSoup
 from dotmap import DotMap
 
+import async_http
+import deadlines
+from bulkheads import BulkheadFull, bulkheads
+from circuit_breaker import CircuitOpen, circuit_breakers, is_server_error
 from general_utils import (
     formatMillisecondsToDurationString,
     formatTimeToDisplay,
@@ -15,6 +21,7 @@ from general_utils import (
     get_tag_content,
     remove_trailing_slash,
 )
+from negative_cache import LinkUnavailable
 
 endpoint = os.getenv('ENDPOINT')
 if endpoint is None:
@@ -38,6 +45,8 @@ class Track:
             self.tags = pageData['keywords'][1:-1]
         self.thumbnail = pageData['image']
         self.duration = None
+        self.is_purchasable = None
+        self.free_download = None
         self.artist = {
             'name': pageData['byArtist']['name'],
             'url': pageData['byArtist'].get('@id')
@@ -83,17 +92,34 @@ class Track:
                     self.title = trackTitleParts.group(2)
         #extra data from API
         if trackData:
-            self.is_purchasable = trackData['is_purchasable']
-            self.free_download = trackData['free_download']
-            self.price = trackData['price']
-            self.currency = trackData['currency']
+            self.setVolatileData(trackData)
             if trackData.get('tracks') and len(trackData['tracks']) > 0:
                 self.duration = trackData['tracks'][0]['duration']
-            self.release_date = datetime.fromtimestamp(
-                trackData['release_date'], tz=timezone.utc)
             if trackData.get('tags') and len(trackData.get('tags')) > 0:
                 self.tags = (tag['name'] for tag in trackData['tags'])
 
+    #price and release date, refreshed on their own from the API
+    def setVolatileData(self, trackData):
+        self.is_purchasable = trackData['is_purchasable']
+        self.free_download = trackData['free_download']
+        self.price = trackData['price']
+        self.currency = trackData['currency']
+        self.release_date = datetime.fromtimestamp(trackData['release_date'],
+                                                   tz=timezone.utc)
+
+    def mapVolatileParts(self):
+        parts = {}
+        if self.is_purchasable:
+            parts['Price'] = (
+                f'`{format_currency(self.price, self.currency, locale="en_US")}`'
+            ) if self.price > 0 else f'[Free]({self.trackUrl})'
+        elif self.free_download:
+            parts['Price'] = f':arrow_down: [Free Download]({self.trackUrl})'
+
+        if self.release_date:
+            parts.update(mapReleaseDate(self.release_date))
+        return parts
+
     def mapToParts(self):
         parts = {}
         if self.thumbnail:
@@ -104,21 +130,7 @@ class Track:
         if self.duration:
             parts['Duration'] = formatMillisecondsToDurationString(self.duration *
                                                                1000)
-        if self.is_purchasable:
-            parts['Price'] = (
-                f'`{format_currency(self.price, self.currency, locale="en_US")}`'
-            ) if self.price > 0 else f'[Free]({self.trackUrl})'
-        elif self.free_download:
-            parts['Price'] = f':arrow_down: [Free Download]({self.trackUrl})'
-
-        if self.release_date:
-            displayTime = formatTimeToDisplay(
-                self.release_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                '%Y-%m-%dT%H:%M:%S')
-            if self.release_date > datetime.now(timezone.utc):
-                parts['Releases on'] = displayTime
-            else:
-                parts['Released on'] = displayTime
+        parts.update(self.mapVolatileParts())
         if self.artist:
             parts['Artist'] = (f'[{self.artist["name"]}]({self.artist["url"]})'
                                if self.artist.get('url') else
@@ -172,14 +184,30 @@ class Album:
 
         #extra data from API
         if albumData:
-            self.is_purchasable = albumData['is_purchasable']
-            self.free_download = albumData['free_download']
-            self.price = albumData['price']
-            self.currency = albumData['currency']
+            self.setVolatileData(albumData)
             if albumData.get('tags') and len(albumData.get('tags')) > 0:
                 self.tags = (tag['name'] for tag in albumData['tags'])
-            self.release_date = datetime.fromtimestamp(
-                albumData['release_date'], tz=timezone.utc)
+
+    #price and release date, refreshed on their own from the API
+    def setVolatileData(self, albumData):
+        self.is_purchasable = albumData['is_purchasable']
+        self.free_download = albumData['free_download']
+        self.price = albumData['price']
+        self.currency = albumData['currency']
+        self.release_date = datetime.fromtimestamp(albumData['release_date'],
+                                                   tz=timezone.utc)
+
+    def mapVolatileParts(self):
+        parts = {}
+        if self.is_purchasable and self.price and self.currency:
+            parts['Price'] = (
+                f'`{format_currency(self.price, self.currency, locale="en_US")}`'
+                if self.price > 0 else f'[Free]({self.albumUrl})')
+        elif self.free_download:
+            parts['Price'] = f':arrow_down: [Free Download]({self.albumUrl})'
+        if self.release_date:
+            parts.update(mapReleaseDate(self.release_date))
+        return parts
 
     def mapToParts(self):
         parts = {}
@@ -224,20 +252,7 @@ class Album:
                 artists.add(trackData['band_name'])
 
         parts['Duration'] = formatMillisecondsToDurationString(totalDuration)
-        if self.is_purchasable and self.price and self.currency:
-            parts['Price'] = (
-                f'`{format_currency(self.price, self.currency, locale="en_US")}`'
-                if self.price > 0 else f'[Free]({self.albumUrl})')
-        elif self.free_download:
-            parts['Price'] = f':arrow_down: [Free Download]({self.albumUrl})'
-        if self.release_date:
-            displayTime = formatTimeToDisplay(
-                self.release_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                '%Y-%m-%dT%H:%M:%S')
-            if self.release_date > datetime.now(timezone.utc):
-                parts['Releases on'] = displayTime
-            else:
-                parts['Released on'] = displayTime
+        parts.update(self.mapVolatileParts())
         if len(artists) > 1 or self.artist['name'] == 'Various Artists':
             parts['title'] = self.title
             parts['Artist'] = 'Various Artists'
@@ -290,43 +305,86 @@ class Discography:
 class BandcampScraper:
 
     def __init__(self, url: str):
-
-        isDiscography = bool(re.match(discography_page_pattern, url))
-        data = self._fetch_data(url, isDiscography)
+        dataType = getDataType(url)
+        data = self._fetch_data(url, dataType == types.discography)
         if data is None:
             raise Exception("No data found")
-
-        if isDiscography:
+        apiData = None
+        if self._wants_api(dataType):
+            apiData = callAPI(*self._item_ids(data, dataType), dataType)
+        self._parse(data, dataType, apiData)
+
+    @classmethod
+    async def scrape(cls, url: str) -> 'BandcampScraper':
+        """BandcampScraper(url) for the event loop, fetching without a thread."""
+        scraper = cls.__new__(cls)
+        dataType = getDataType(url)
+        data = await scraper._fetch_data_async(url,
+                                               dataType == types.discography)
+        if data is None:
+            raise Exception("No data found")
+        apiData = None
+        if scraper._wants_api(dataType):
+            apiData = await callAPIAsync(*scraper._item_ids(data, dataType),
+                                         dataType)
+        scraper._parse(data, dataType, apiData)
+        return scraper
+
+    def _parse(self, data, dataType, apiData):
+        if dataType == types.discography:
             self.dataClass = self._parse_discography(data)
-            self.dataType = types.discography
-        elif re.match(track_url_pattern, url):
-            self.dataClass = self._parse_track(data)
-            self.dataType = types.track
-        elif re.match(album_url_pattern, url):
-            self.dataClass = self._parse_album(data)
-            self.dataType = types.album
+        elif dataType == types.track:
+            self.dataClass = self._parse_track(data, apiData)
+        elif dataType == types.album:
+            self.dataClass = self._parse_album(data, apiData)
+        self.dataType = dataType
 
     @staticmethod
-    def _parse_track(pageData):
+    def _wants_api(dataType):
+        if dataType == types.track:
+            # the page has everything but price, duration and tags
+            return deadlines.allows('bandcamp api')
+        return dataType == types.album
+
+    @staticmethod
+    def _item_ids(pageData, dataType):
+        """The band and item id of a page, as tralbum_details takes them."""
+        if dataType == types.track:
+            additionalProperty = pageData['additionalProperty']
+        else:
+            additionalProperty = pageData['albumRelease'][0][
+                'additionalProperty']
         properties = {
             item['name']: item['value']
-            for item in pageData['additionalProperty']
+            for item in additionalProperty
         }
-        artistId = properties.get('art_id')
-        trackId = properties.get('track_id')
-        trackData = callAPI(artistId, trackId, types.track)
-        return Track(pageData, trackData)
+        itemId = properties.get(
+            'track_id' if dataType == types.track else 'item_id')
+        return properties.get('art_id'), itemId
 
     @staticmethod
-    def _parse_album(pageData):
-        properties = {
-            item['name']: item['value']
-            for item in pageData['albumRelease'][0]['additionalProperty']
+    def _parse_track(pageData, trackData):
+        artistId, trackId = BandcampScraper._item_ids(pageData, types.track)
+        track = Track(pageData, trackData)
+        track.refreshSource = {
+            'bandId': artistId,
+            'itemId': trackId,
+            'itemType': types.track,
+            'url': track.trackUrl
+        }
+        return track
+
+    @staticmethod
+    def _parse_album(pageData, albumData):
+        artistId, albumId = BandcampScraper._item_ids(pageData, types.album)
+        album = Album(pageData, albumData)
+        album.refreshSource = {
+            'bandId': artistId,
+            'itemId': albumId,
+            'itemType': types.album,
+            'url': album.albumUrl
         }
-        artistId = properties.get('art_id')
-        albumId = properties.get('item_id')
-        albumData = callAPI(artistId, albumId, types.album)
-        return Album(pageData, albumData)
+        return album
 
     @staticmethod
     def _parse_discography(soup: BeautifulSoup):
@@ -347,27 +405,32 @@ class BandcampScraper:
 
     def _fetch_data(self, url, pageData=False):
         try:
-            response = requests.get(url)
-            if response.status_code != 200 and endpoint:
-                response = requests.post(endpoint,
-                                         data={
-                                             'action': 'psvAjaxAction',
-                                             'url': url,
-                                         })
-            if response.status_code != 200:
-                return None
-            else:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                if pageData:
-                    return soup
-                else:
-                    script_tag = soup.find('script',
-                                           {'type': 'application/ld+json'})
-                    if script_tag is None:
-                        return None
-                    else:
-                        songData = json.loads(script_tag.text)
-                        return songData
+            try:
+                response = circuit_breakers['bandcamp_page'].call(
+                    requests.get,
+                    url,
+                    timeout=deadlines.request_timeout(
+                        async_http.REQUEST_TIMEOUT_SECONDS),
+                    is_failure=is_server_error)
+            except CircuitOpen:
+                # straight to the proxy while Bandcamp is failing
+                response = None
+            notFound = (response is not None
+                        and response.status_code in (404, 410))
+            if (response is None or response.status_code != 200) and endpoint:
+                response = circuit_breakers['proxy_endpoint'].call(
+                    requests.post,
+                    endpoint,
+                    data={
+                        'action': 'psvAjaxAction',
+                        'url': url,
+                    },
+                    timeout=deadlines.request_timeout(
+                        async_http.REQUEST_TIMEOUT_SECONDS),
+                    is_failure=is_server_error)
+            return self._read_page(response, notFound, pageData)
+        except LinkUnavailable:
+            raise
         except requests.exceptions.RequestException as e:
             print(f"Network error occurred: {e}")
             return None
@@ -378,6 +441,71 @@ class BandcampScraper:
             print(f"An unexpected error occurred: {e}")
             return None
 
+    async def _fetch_data_async(self, url, pageData=False):
+        try:
+            try:
+                response = await circuit_breakers['bandcamp_page'].call_async(
+                    async_http.get, url, is_failure=is_server_error)
+            except CircuitOpen:
+                response = None
+            notFound = (response is not None
+                        and response.status_code in (404, 410))
+            if (response is None or response.status_code != 200) and endpoint:
+                response = await circuit_breakers['proxy_endpoint'].call_async(
+                    async_http.post,
+                    endpoint,
+                    data={
+                        'action': 'psvAjaxAction',
+                        'url': url,
+                    },
+                    is_failure=is_server_error)
+            # parsing a page takes a while, it runs off the event loop
+            return await bulkheads['bandcamp'].run(self._read_page, response,
+                                                   notFound, pageData)
+        except (LinkUnavailable, BulkheadFull):
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Network error occurred: {e}")
+            return None
+        except json.JSONDecodeError as e:
+            print(f"JSON decoding error: {e}")
+            return None
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+            return None
+
+    @staticmethod
+    def _read_page(response, notFound, pageData):
+        if response is None:
+            return None
+        if response.status_code != 200 and notFound:
+            raise LinkUnavailable(
+                'not_found', 'This Bandcamp page does not exist anymore.')
+        if response.status_code != 200:
+            return None
+        else:
+            soup = BeautifulSoup(response.content, 'html.parser')
+            if pageData:
+                return soup
+            else:
+                script_tag = soup.find('script',
+                                       {'type': 'application/ld+json'})
+                if script_tag is None:
+                    return None
+                else:
+                    songData = json.loads(script_tag.text)
+                    return songData
+
+
+def getDataType(url: str):
+    if re.match(discography_page_pattern, url):
+        return types.discography
+    if re.match(track_url_pattern, url):
+        return types.track
+    if re.match(album_url_pattern, url):
+        return types.album
+    return None
+
 
 def getBandcampParts(url: str):
     bandcampParts = {'embedPlatformType': 'bandcamp', 'embedColour': 0x1da0c3}
@@ -386,8 +514,9 @@ def getBandcampParts(url: str):
     try:
         # raise Exception('bypassing until mapping is complete')
         scraper = BandcampScraper(remove_trailing_slash(url))
-        if scraper.dataClass:
-            bandcampParts.update(scraper.dataClass.mapToParts())
+        mapScraperParts(bandcampParts, scraper)
+    except LinkUnavailable:
+        raise
     except Exception as e:
         #fallback method from embed
         print(f"An error occurred while fetching Bandcamp details: {e}")
@@ -395,11 +524,73 @@ def getBandcampParts(url: str):
     return bandcampParts
 
 
+async def getBandcampPartsAsync(url: str):
+    """getBandcampParts for the event loop, on the shared async client."""
+    bandcampParts = {'embedPlatformType': 'bandcamp', 'embedColour': 0x1da0c3}
+    try:
+        scraper = await BandcampScraper.scrape(remove_trailing_slash(url))
+        mapScraperParts(bandcampParts, scraper)
+    except LinkUnavailable:
+        raise
+    except Exception as e:
+        print(f"An error occurred while fetching Bandcamp details: {e}")
+
+    return bandcampParts
+
+
+def mapScraperParts(bandcampParts, scraper):
+    if scraper.dataClass:
+        bandcampParts.update(scraper.dataClass.mapToParts())
+        refreshSource = getattr(scraper.dataClass, 'refreshSource', None)
+        if refreshSource:
+            # lets the cache refresh Price and release date from the API
+            bandcampParts['refreshSource'] = refreshSource
+
+
+def refreshVolatileParts(refreshSource):
+    """
+    Price and release date of a track or album scraped before, from
+    tralbum_details alone. Returns None if the API has nothing for it.
+    """
+    data = callAPI(refreshSource['bandId'], refreshSource['itemId'],
+                   refreshSource['itemType'])
+    if not data or 'release_date' not in data:
+        return None
+    # the page is not fetched again, only what mapVolatileParts reads is set
+    if refreshSource['itemType'] == types.track:
+        item = Track.__new__(Track)
+        item.trackUrl = refreshSource['url']
+    else:
+        item = Album.__new__(Album)
+        item.albumUrl = refreshSource['url']
+    try:
+        item.setVolatileData(data)
+        return item.mapVolatileParts()
+    except Exception as e:
+        print(f"An error occurred while refreshing Bandcamp details: {e}")
+        return None
+
+
+def mapReleaseDate(release_date):
+    displayTime = formatTimeToDisplay(
+        release_date.strftime('%Y-%m-%dT%H:%M:%S'), '%Y-%m-%dT%H:%M:%S')
+    if release_date > datetime.now(timezone.utc):
+        return {'Releases on': displayTime}
+    return {'Released on': displayTime}
+
+
+def getAPIUrl(artistId, itemId, type):
+    return (f'https://bandcamp.com/api/mobile/25/tralbum_details'
+            f'?band_id={artistId}&tralbum_id={itemId}&tralbum_type={type}')
+
+
 def callAPI(artistId, itemId, type):
     try:
-        response = requests.get(url=(
-            f'https://bandcamp.com/api/mobile/25/tralbum_details'
-            f'?band_id={artistId}&tralbum_id={itemId}&tralbum_type={type}'))
+        response = circuit_breakers['bandcamp_api'].call(
+            requests.get,
+            url=getAPIUrl(artistId, itemId, type),
+            timeout=deadlines.request_timeout(async_http.REQUEST_TIMEOUT_SECONDS),
+            is_failure=is_server_error)
         result = response.json()
         return result
     except requests.exceptions.RequestException as e:
@@ -413,6 +604,24 @@ def callAPI(artistId, itemId, type):
         return None
 
 
+async def callAPIAsync(artistId, itemId, type):
+    try:
+        response = await circuit_breakers['bandcamp_api'].call_async(
+            async_http.get,
+            getAPIUrl(artistId, itemId, type),
+            is_failure=is_server_error)
+        return response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Network error occurred: {e}")
+        return None
+    except json.JSONDecodeError as e:
+        print(f"JSON decoding error: {e}")
+        return None
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return None
+
+
 def checkTrackTitle(track_title):
     return '-' in track_title or '–' in track_title
 
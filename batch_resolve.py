@@ -0,0 +1,163 @@
+"""
+Resolves every supported link in a file (or stdin) to embed parts, writing
+one JSON line per link as the lookups complete.
+
+    python batch_resolve.py links.txt -o parts.jsonl
+
+Lookups run in a pool of processes, with at most --limit lookups of one
+platform at a time. When the output file already exists the links it has
+results for are skipped and new results appended, so an interrupted run
+resumes where it stopped.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, TextIO
+
+from general_utils import read_links
+from negative_cache import LinkUnavailable
+from object_types import CategorizedLink, link_types
+from platform_registry import load_resolvers, resolve_link
+
+# Lookups of one platform running at once, unless given with --limit
+DEFAULT_PLATFORM_LIMITS = {
+    link_types.bandcamp: 2,
+    link_types.soundcloud: 4,
+    link_types.spotify: 4,
+    link_types.youtube: 4,
+}
+
+
+def resolve_record(link: CategorizedLink) -> dict:
+    """The JSON record of one lookup, run in a worker process."""
+    url, platform = link
+    record = {"url": url, "platform": platform}
+    try:
+        parts = resolve_link(link)
+    except LinkUnavailable as e:
+        return dict(record, error={"message": str(e), "reason": e.reason})
+    except Exception as e:
+        return dict(record, error={"message": str(e)})
+    if not parts:
+        return dict(record, error={"message": "This link cannot be embedded"})
+    return dict(record, parts=parts)
+
+
+def completed_urls(path: str) -> Set[str]:
+    """
+    The URLs already written to an output file. A last line cut short by an
+    interrupted run is removed so new results start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as file:
+        content = file.read()
+        complete = content.rfind(b"\n") + 1
+        if complete < len(content):
+            file.truncate(complete)
+    urls = set()
+    for line in content[:complete].splitlines():
+        try:
+            urls.add(json.loads(line)["url"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return urls
+
+
+async def resolve_all(
+    links: List[CategorizedLink],
+    output: TextIO,
+    workers: Optional[int] = None,
+    limits: Optional[Dict[str, int]] = None,
+) -> int:
+    """Resolve `links` in a process pool, writing records as they complete."""
+    limits = dict(DEFAULT_PLATFORM_LIMITS, **(limits or {}))
+    semaphores = {
+        platform: asyncio.Semaphore(limit) for platform, limit in limits.items()
+    }
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(workers, initializer=load_resolvers) as pool:
+
+        async def lookup(link: CategorizedLink) -> dict:
+            async with semaphores[link[1]]:
+                return await loop.run_in_executor(pool, resolve_record, link)
+
+        written = 0
+        for done in asyncio.as_completed([lookup(link) for link in links]):
+            output.write(json.dumps(await done) + "\n")
+            # flushed per line, it is the checkpoint of an interrupted run
+            output.flush()
+            written += 1
+    return written
+
+
+def _parse_limits(values: List[str]) -> Dict[str, int]:
+    limits = {}
+    for value in values:
+        platform, _, limit = value.partition("=")
+        if platform not in DEFAULT_PLATFORM_LIMITS or not limit.isdigit():
+            raise argparse.ArgumentTypeError(f"Expected platform=number, got {value}")
+        limits[platform] = int(limit)
+    return limits
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "input", nargs="?", default="-", help="File of URLs, - for stdin (the default)"
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="JSONL file to write, - for stdout"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    parser.add_argument(
+        "--limit",
+        action="append",
+        default=[],
+        metavar="PLATFORM=N",
+        help="Lookups of one platform at a time, e.g. bandcamp=2",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Overwrite the output file instead of resuming",
+    )
+    arguments = parser.parse_args(argv)
+    try:
+        limits = _parse_limits(arguments.limit)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if arguments.input == "-":
+        links = read_links(sys.stdin)
+    else:
+        with open(arguments.input, encoding="utf-8") as file:
+            links = read_links(file)
+
+    with contextlib.ExitStack() as stack:
+        if arguments.output == "-":
+            output = sys.stdout
+        else:
+            if arguments.restart and os.path.exists(arguments.output):
+                os.remove(arguments.output)
+            done = completed_urls(arguments.output)
+            links = [link for link in links if link[0] not in done]
+            if done:
+                print(f"Resuming, {len(done)} links already resolved", file=sys.stderr)
+            output = stack.enter_context(
+                open(arguments.output, "a", encoding="utf-8")
+            )
+        written = asyncio.run(resolve_all(links, output, arguments.workers, limits))
+    print(f"Resolved {written} links", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+import deadlines
+from bulkheads import Bulkhead
+from deadlines import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Lookups requested within this many seconds share one batch
+BATCH_WINDOW_SECONDS = 0.05
+
+
+class WindowBatcher:
+    """
+    Collects the keys requested within `window` seconds, from one message or
+    several, and resolves them with a single `fetch_batch` call, awaited if
+    it is a coroutine function and run on `bulkhead` (or in a worker thread)
+    if not. Each key is fetched once however many callers are waiting on it.
+    A batch runs under the most generous budget of its callers, and the
+    enrichments it had to drop are reported to each of them.
+
+    Args:
+        fetch_batch: Function or coroutine function mapping a list of keys to
+            a dict of results. A key may map to an Exception, which is raised for its
+            callers only.
+        window: Seconds to wait for more keys after the first one
+        max_batch: Largest number of keys handed to one `fetch_batch` call
+        bulkhead: Threads for a blocking `fetch_batch`, asyncio's default
+            executor if not given
+    """
+
+    def __init__(
+        self,
+        fetch_batch: Callable[
+            [List[str]], Union[Dict[str, Any], Awaitable[Dict[str, Any]]]
+        ],
+        window: float = BATCH_WINDOW_SECONDS,
+        max_batch: int = 50,
+        bulkhead: Optional[Bulkhead] = None,
+    ):
+        self.fetch_batch = fetch_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.bulkhead = bulkhead
+        self._waiting: Dict[str, asyncio.Future] = {}
+        self._budgets: Dict[str, List[Optional[Deadline]]] = {}
+        self._queued: List[str] = []
+        self._flush_scheduled = False
+
+    async def get(self, key: str) -> Any:
+        loop = asyncio.get_running_loop()
+        future = self._waiting.get(key)
+        if future is None:
+            future = loop.create_future()
+            self._waiting[key] = future
+            self._budgets[key] = [deadlines.current()]
+            self._queued.append(key)
+            if len(self._queued) >= self.max_batch:
+                self._flush()
+            elif not self._flush_scheduled:
+                self._flush_scheduled = True
+                loop.call_later(self.window, self._flush)
+        else:
+            # joins the batch budget while queued; once in flight it only
+            # hears about the enrichments the fetch dropped
+            self._budgets[key].append(deadlines.current())
+        # shielded so one cancelled embed does not cancel the shared lookup
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        keys, self._queued = self._queued, []
+        if keys:
+            batch_budget = deadlines.latest(
+                budget for key in keys for budget in self._budgets[key])
+            with deadlines.using(batch_budget):
+                asyncio.ensure_future(self._run(keys))
+
+    async def _run(self, keys: List[str]):
+        logger.debug("Fetching a batch of %d keys", len(keys))
+        try:
+            if asyncio.iscoroutinefunction(self.fetch_batch):
+                results = await self.fetch_batch(keys)
+            elif self.bulkhead is not None:
+                results = await self.bulkhead.run(self.fetch_batch, keys)
+            else:
+                results = await asyncio.to_thread(self.fetch_batch, keys)
+        except Exception as e:
+            results = dict.fromkeys(keys, e)
+        dropped = deadlines.dropped()
+        for key in keys:
+            callers = self._budgets.pop(key)
+            if dropped:
+                # not known per key, every result of the batch counts as partial
+                for budget in callers:
+                    if budget is not None:
+                        budget.dropped.extend(dropped)
+            future = self._waiting.pop(key)
+            result = results.get(key, LookupError(f"No result for {key}"))
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+
+# Calls allowed to wait in a bulkhead's queue for each of its workers
+QUEUE_PER_WORKER = 16
+
+
+class BulkheadFull(Exception):
+    """A call was refused because its bulkhead already has a full queue."""
+
+    def __init__(self, name: str):
+        super().__init__(f"Too many {name} lookups waiting, try again later")
+        self.name = name
+
+
+class Bulkhead:
+    """
+    A thread pool of its own for the blocking calls to one upstream. When
+    the upstream hangs, its calls tie up only these workers and lookups on
+    other platforms keep moving. Calls wait in the bulkhead's queue while
+    every worker is busy, up to `max_queue` of them; more are refused with
+    BulkheadFull rather than piling up behind a stuck upstream.
+
+    Args:
+        name: Name of the bulkhead, for metrics and thread names
+        workers: Calls running at once
+        max_queue: Calls allowed to wait for a worker, QUEUE_PER_WORKER per
+            worker by default
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: Optional[int] = None):
+        self.name = name
+        self.workers = workers
+        self.max_queue = workers * QUEUE_PER_WORKER if max_queue is None else max_queue
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix=f"bulkhead-{name}"
+        )
+        self._queued = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._publish()
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def busy(self) -> int:
+        return self._busy
+
+    async def run(self, function: Callable[..., Any], *args) -> Any:
+        """
+        Run `function(*args)` on one of the bulkhead's workers. Like
+        asyncio.to_thread it keeps the caller's context, deadline included.
+        """
+        with self._lock:
+            if self._queued >= self.max_queue:
+                metrics.increment("bulkhead_rejected_total", bulkhead=self.name)
+                raise BulkheadFull(self.name)
+            self._queued += 1
+            self._publish()
+        context = copy_context()
+        queued_at = time.monotonic()
+
+        def work():
+            self._start(queued_at)
+            try:
+                return context.run(function, *args)
+            finally:
+                self._finish()
+
+        future = self._executor.submit(work)
+        future.add_done_callback(self._discard)
+        return await asyncio.wrap_future(future)
+
+    def _start(self, queued_at: float):
+        with self._lock:
+            self._queued -= 1
+            self._busy += 1
+            self._publish()
+        metrics.observe(
+            "bulkhead_wait_seconds", time.monotonic() - queued_at, bulkhead=self.name
+        )
+
+    def _finish(self):
+        with self._lock:
+            self._busy -= 1
+            self._publish()
+
+    def _discard(self, future: Future):
+        if future.cancelled():
+            # cancelled while queued, it never reached a worker
+            with self._lock:
+                self._queued -= 1
+                self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("bulkhead_queue_depth", self._queued, bulkhead=self.name)
+        metrics.set_gauge("bulkhead_busy_workers", self._busy, bulkhead=self.name)
+        metrics.set_gauge(
+            "bulkhead_saturation", self._busy / self.workers, bulkhead=self.name
+        )
+
+
+# Workers of each bulkhead, by platform (see `link_types`)
+_BULKHEAD_WORKERS = {
+    "soundcloud": 8,
+    "youtube": 8,
+    "spotify": 8,
+    # page fetches fall back to the proxy, which can take many seconds
+    "bandcamp": 4,
+    # the SoundCloud fallback, slow and only needed while SoundCloud fails
+    "yt_dlp": 2,
+}
+
+bulkheads: Dict[str, Bulkhead] = {
+    name: Bulkhead(name, workers) for name, workers in _BULKHEAD_WORKERS.items()
+}
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import aiohttp
+import requests
+
+import deadlines
+import metrics
+from concurrency_limiter import AdaptiveLimiter, retry_after_seconds
+from negative_cache import LinkUnavailable
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+# circuit_state gauge values
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"{upstream} is unavailable, not calling it for now")
+        self.upstream = upstream
+
+
+class HostBusy(TimeoutError):
+    """No slot of an upstream's host freed up within the caller's deadline."""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"{upstream} is busy, no time left to wait for it")
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing. Opens once at least
+    `failure_rate` of the calls within the last `window` seconds failed
+    (and there were at least `min_calls` of them), then rejects calls for
+    `open_seconds`. After that, up to `probes` calls are let through: if they
+    all succeed the circuit closes, a single failure opens it again.
+
+    Errors that only concern the request (HTTP 4xx other than 429) do not
+    count as failures of the upstream.
+
+    Calls also take a slot of the upstream host's `limiter`, when it has
+    one, and report back how the host coped with them. They wait for the
+    slot no longer than the current deadline allows and raise HostBusy when
+    it runs out, or when the host asked us to wait past it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        min_calls: int = 5,
+        window: float = 60,
+        open_seconds: float = 30,
+        probes: int = 1,
+        limiter: Optional[AdaptiveLimiter] = None,
+    ):
+        self.name = name
+        self.limiter = limiter
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        # (time, failed) of recent calls
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self._lock = threading.Lock()
+        metrics.set_gauge("circuit_state", 0, upstream=name)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._expire_open(time.monotonic())
+            return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead, counting it as a probe if half-open."""
+        with self._lock:
+            self._expire_open(time.monotonic())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return True
+        metrics.increment("circuit_rejected_total", upstream=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self._transition(CLOSED)
+                return
+            self._record(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._transition(OPEN)
+                return
+            self._record(True)
+            failures = sum(1 for _, failed in self._calls if failed)
+            if (
+                self._state == CLOSED
+                and len(self._calls) >= self.min_calls
+                and failures >= self.failure_rate * len(self._calls)
+            ):
+                self._transition(OPEN)
+
+    def call(
+        self,
+        function: Callable[..., Any],
+        *args,
+        is_failure: Optional[Callable[[Any], bool]] = None,
+        **kwargs,
+    ) -> Any:
+        """
+        Call `function` through the breaker. Raises CircuitOpen when the
+        circuit is open; `is_failure` flags results that are failures even
+        though nothing was raised, like a 503 response.
+        """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        if self.limiter and not self.limiter.acquire(deadlines.remaining()):
+            self._abandon(holds_slot=False)
+            raise HostBusy(self.name)
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._settle_error(started, e)
+            raise
+        self._settle_result(started, result, is_failure)
+        return result
+
+    async def call_async(
+        self,
+        function: Callable[..., Awaitable[Any]],
+        *args,
+        is_failure: Optional[Callable[[Any], bool]] = None,
+        **kwargs,
+    ) -> Any:
+        """
+        call for coroutine functions, waiting for the host's limiter on the
+        event loop. A cancelled call frees its slots without counting as a
+        success or a failure.
+        """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        if self.limiter:
+            try:
+                acquired = await self.limiter.acquire_async(deadlines.remaining())
+            except asyncio.CancelledError:
+                self._abandon(holds_slot=False)
+                raise
+            if not acquired:
+                self._abandon(holds_slot=False)
+                raise HostBusy(self.name)
+        started = time.monotonic()
+        try:
+            result = await function(*args, **kwargs)
+        except asyncio.CancelledError:
+            self._abandon(holds_slot=True)
+            raise
+        except Exception as e:
+            self._settle_error(started, e)
+            raise
+        self._settle_result(started, result, is_failure)
+        return result
+
+    def _settle_error(self, started: float, error: Exception):
+        self._release(started, is_overloaded(error), getattr(error, "response", error))
+        if is_upstream_failure(error):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def _settle_result(
+        self, started: float, result: Any, is_failure: Optional[Callable[[Any], bool]]
+    ):
+        failed = bool(is_failure and is_failure(result))
+        self._release(started, failed and is_server_error(result), result)
+        if failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def _abandon(self, holds_slot: bool):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+        if self.limiter and holds_slot:
+            self.limiter.cancel()
+
+    def _release(self, started: float, overloaded: bool, response: Any):
+        if not self.limiter:
+            return
+        retry_after = None
+        if overloaded:
+            # requests' responses and urllib's HTTPError both carry headers
+            retry_after = retry_after_seconds(getattr(response, "headers", None))
+        self.limiter.release(time.monotonic() - started, overloaded, retry_after)
+
+    def _record(self, failed: bool):
+        now = time.monotonic()
+        self._calls.append((now, failed))
+        while self._calls and self._calls[0][0] <= now - self.window:
+            self._calls.popleft()
+
+    def _expire_open(self, now: float):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state: str):
+        logger.warning("Circuit for %s: %s -> %s", self.name, self._state, state)
+        metrics.increment(
+            "circuit_transitions_total", upstream=self.name, to=state
+        )
+        metrics.set_gauge("circuit_state", _STATE_VALUES[state], upstream=self.name)
+        self._state = state
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        else:
+            self._calls.clear()
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    if isinstance(error, LinkUnavailable):
+        # the upstream answered, there is just nothing to embed
+        return False
+    status = _status_code(error)
+    return status is None or status == 429 or status >= 500
+
+
+def is_overloaded(error: BaseException) -> bool:
+    """Whether an error says the host could not keep up with us."""
+    if isinstance(
+        error,
+        (
+            TimeoutError,
+            asyncio.TimeoutError,
+            requests.Timeout,
+            requests.ConnectionError,
+            aiohttp.ClientConnectionError,
+        ),
+    ):
+        return True
+    status = _status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def is_server_error(response) -> bool:
+    """is_failure for HTTP responses: rate limits and 5xx."""
+    status = getattr(response, "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+
+# The host behind each upstream, upstreams on the same host share its
+# concurrency limit and its Retry-After
+_UPSTREAM_HOSTS = {
+    "bandcamp_page": "bandcamp.com",
+    "bandcamp_api": "bandcamp.com",
+    "proxy_endpoint": "proxy",
+    "soundcloud_api": "soundcloud.com",
+    # the SoundCloud fallback, its slow extractions must not shrink the
+    # API's limit nor trip its breaker
+    "yt_dlp": "yt_dlp",
+    "ytmusic": "music.youtube.com",
+    "youtube_data_api": "www.googleapis.com",
+    "spotify": "spotify.com",
+}
+
+host_limiters: Dict[str, AdaptiveLimiter] = {
+    host: AdaptiveLimiter(host) for host in set(_UPSTREAM_HOSTS.values())
+}
+
+# One breaker per upstream the bot depends on
+circuit_breakers: Dict[str, CircuitBreaker] = {
+    name: CircuitBreaker(name, limiter=host_limiters[host])
+    for name, host in _UPSTREAM_HOSTS.items()
+}
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Longest Retry-After we will honour, some hosts send hours
+MAX_RETRY_AFTER_SECONDS = 300
+
+
+class AdaptiveLimiter:
+    """
+    Limits how many requests run at once against one host, adapting the
+    limit AIMD style: each successful call that had the limit in use adds
+    1/limit (so about one more slot per round of calls), a 429 or 5xx halves
+    it, and a call much slower than usual trims it by `latency_backoff`.
+    A Retry-After from the host pauses every new call to it until then.
+
+    Args:
+        host: Name of the host, for metrics and logs
+        initial: Starting limit
+        minimum: The limit never drops below this
+        maximum: The limit never grows past this
+        backoff: Factor applied to the limit on 429/5xx
+        latency_backoff: Factor applied when a call is slow
+        latency_tolerance: How many times the usual latency counts as slow
+    """
+
+    def __init__(
+        self,
+        host: str,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 32,
+        backoff: float = 0.5,
+        latency_backoff: float = 0.9,
+        latency_tolerance: float = 2.0,
+    ):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_backoff = latency_backoff
+        self.latency_tolerance = latency_tolerance
+        self._in_flight = 0
+        self._retry_at = 0.0
+        # slow moving average of successful call latency
+        self._usual_latency: Optional[float] = None
+        self._condition = threading.Condition()
+        # coroutines in acquire_async, woken on every release
+        self._async_waiters: List[
+            Tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = []
+        self._publish()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a slot, False if none freed up within `timeout` seconds.
+        Gives up right away when the host asked us to wait past the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._take_slot(now):
+                    return True
+                waits = []
+                if deadline is not None:
+                    if deadline <= now or self._retry_at > deadline:
+                        return False
+                    waits.append(deadline - now)
+                if self._retry_at > now:
+                    waits.append(self._retry_at - now)
+                self._condition.wait(min(waits) if waits else None)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """acquire for the event loop, waiting for a slot without a thread."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                if self._take_slot(now):
+                    return True
+                waits = []
+                if deadline is not None:
+                    if deadline <= now or self._retry_at > deadline:
+                        return False
+                    waits.append(deadline - now)
+                if self._retry_at > now:
+                    waits.append(self._retry_at - now)
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, min(waits) if waits else None)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def cancel(self):
+        """Free a slot whose call was abandoned, without adapting the limit."""
+        with self._condition:
+            self._in_flight -= 1
+            self._publish()
+            self._wake()
+
+    def release(
+        self,
+        latency: float,
+        overloaded: bool = False,
+        retry_after: Optional[float] = None,
+    ):
+        """
+        Free a slot and adapt the limit to how the call went.
+
+        Args:
+            latency: Seconds the call took
+            overloaded: The host answered 429/5xx or did not answer
+            retry_after: Seconds the host asked us to wait
+        """
+        with self._condition:
+            limit_in_use = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            if retry_after:
+                self._retry_at = max(
+                    self._retry_at,
+                    time.monotonic() + min(retry_after, MAX_RETRY_AFTER_SECONDS),
+                )
+                logger.warning("%s asked us to wait %ss", self.host, retry_after)
+            if overloaded:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                metrics.increment("upstream_overloaded_total", host=self.host)
+            elif self._is_slow(latency):
+                self.limit = max(self.minimum, self.limit * self.latency_backoff)
+            elif limit_in_use:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if not overloaded:
+                self._track_latency(latency)
+            self._publish()
+            self._wake()
+
+    def _take_slot(self, now: float) -> bool:
+        if now >= self._retry_at and self._in_flight < int(self.limit):
+            self._in_flight += 1
+            self._publish()
+            return True
+        return False
+
+    def _wake(self):
+        self._condition.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                # release may run in a worker thread
+                loop.call_soon_threadsafe(_set_done, waiter)
+
+    def _is_slow(self, latency: float) -> bool:
+        return (
+            self._usual_latency is not None
+            and latency > self._usual_latency * self.latency_tolerance
+        )
+
+    def _track_latency(self, latency: float):
+        if self._usual_latency is None:
+            self._usual_latency = latency
+        else:
+            self._usual_latency += 0.05 * (latency - self._usual_latency)
+
+    def _publish(self):
+        metrics.set_gauge("upstream_concurrency_limit", int(self.limit), host=self.host)
+        metrics.set_gauge("upstream_in_flight", self._in_flight, host=self.host)
+
+
+def _set_done(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """The Retry-After header in seconds, as a number or an HTTP date."""
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,127 @@
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import Iterable, Iterator, List, Optional
+
+# Time an optional enrichment needs to be worth starting
+ENRICHMENT_RESERVE_SECONDS = 1.0
+# Least time a blocking request is given, however little budget is left
+MIN_REQUEST_TIMEOUT_SECONDS = 1.0
+
+
+class Deadline:
+    """
+    The time budget of one embed. It lives in a context variable, so it
+    follows the lookup into worker threads started with asyncio.to_thread
+    or a bulkhead.
+    Enrichments skipped for lack of time are listed in `dropped`.
+    """
+
+    def __init__(self, expires_at: float):
+        self.expires_at = expires_at
+        self.dropped: List[str] = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def child(self) -> "Deadline":
+        """Same expiry, its own list of dropped enrichments."""
+        return Deadline(self.expires_at)
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def current() -> Optional[Deadline]:
+    return _current.get()
+
+
+def remaining() -> Optional[float]:
+    """Seconds left in the current budget, None when there is none."""
+    deadline = _current.get()
+    return deadline.remaining() if deadline else None
+
+
+def request_timeout(ceiling: float) -> float:
+    """
+    Timeout for a blocking request: the time left in the current budget, at
+    least MIN_REQUEST_TIMEOUT_SECONDS and at most `ceiling`.
+    """
+    seconds = remaining()
+    if seconds is None:
+        return ceiling
+    return min(ceiling, max(seconds, MIN_REQUEST_TIMEOUT_SECONDS))
+
+
+def allows(enrichment: str, seconds: float = ENRICHMENT_RESERVE_SECONDS) -> bool:
+    """
+    Whether an optional enrichment expected to take `seconds` still fits in
+    the budget. When it does not, it is recorded as dropped.
+    """
+    deadline = _current.get()
+    if deadline is None or deadline.remaining() > seconds:
+        return True
+    deadline.dropped.append(enrichment)
+    return False
+
+
+def dropped() -> List[str]:
+    deadline = _current.get()
+    return list(deadline.dropped) if deadline else []
+
+
+def report(enrichments: List[str]):
+    """Record enrichments dropped by work done on our behalf elsewhere."""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.dropped.extend(enrichments)
+
+
+@contextlib.contextmanager
+def budget(seconds: float) -> Iterator[Deadline]:
+    """Give everything run within the block at most `seconds` from now."""
+    expires_at = time.monotonic() + seconds
+    outer = _current.get()
+    if outer is not None:
+        expires_at = min(expires_at, outer.expires_at)
+    token = _current.set(Deadline(expires_at))
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def using(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """Run the block under `deadline`, or without a budget if it is None."""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def unbounded():
+    """
+    Run the block without a budget, for background work which should not be
+    cut short for any one embed.
+    """
+    return using(None)
+
+
+def latest(deadlines: Iterable[Optional[Deadline]]) -> Optional[Deadline]:
+    """
+    A budget for work shared by several embeds: the most generous of theirs,
+    or none if any of them has none.
+    """
+    deadlines = list(deadlines)
+    if not deadlines or any(deadline is None for deadline in deadlines):
+        return None
+    return Deadline(max(deadline.expires_at for deadline in deadlines))
+
+
+def scope_to_task():
+    """Give the current task its own list of dropped enrichments."""
+    deadline = _current.get()
+    if deadline is not None:
+        _current.set(deadline.child())
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+
+class CachedParts:
+    """
+    A cache hit: the parts and how fresh they are. Stale parts are still
+    `servable` while within the entry's maximum staleness.
+    """
+
+    def __init__(self, parts: dict, stale: bool, volatile_stale: bool, servable: bool):
+        self.parts = parts
+        self.stale = stale
+        self.volatile_stale = volatile_stale
+        self.servable = servable
+
+    @property
+    def fresh(self) -> bool:
+        return not (self.stale or self.volatile_stale)
+
+
+class EmbedCache:
+    """
+    In-memory LRU cache of resolved embed parts with a TTL per entry.
+    An entry may also carry a shorter TTL for its volatile fields (play
+    counts, prices), which can then be refreshed without resolving again,
+    and a maximum staleness for which it is kept after expiring so it can
+    be served while it is revalidated.
+    Safe to share between the event loop and worker threads.
+
+    Args:
+        max_entries: Entries kept, the least recently used are evicted first
+    """
+
+    def __init__(self, max_entries: int = 2048):
+        self.max_entries = max_entries
+        # key -> (expires_at, volatile_expires_at, max_stale, parts)
+        self._entries: "OrderedDict[str, tuple[float, float, float, dict]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        """The cached parts, only if none of them have expired."""
+        entry = self.lookup(key)
+        if entry is None or not entry.fresh:
+            return None
+        return entry.parts
+
+    def lookup(self, key: str) -> Optional[CachedParts]:
+        """The cached parts, fresh or stale, until their maximum staleness."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, volatile_expires_at, max_stale, parts = entry
+            now = time.monotonic()
+            if expires_at + max_stale <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return CachedParts(
+                dict(parts),
+                stale=expires_at <= now,
+                volatile_stale=volatile_expires_at <= now,
+                servable=min(expires_at, volatile_expires_at) + max_stale > now,
+            )
+
+    def set(
+        self,
+        key: str,
+        parts: dict,
+        ttl: float,
+        volatile_ttl: Optional[float] = None,
+        max_stale: float = 0,
+    ):
+        """
+        Cache the parts of `key`.
+
+        Args:
+            key: The cache key, see `Platform.cache_key`
+            parts: The embed parts, copied into the cache
+            ttl: Seconds the parts are fresh
+            volatile_ttl: Seconds the volatile fields are fresh, at most `ttl`
+            max_stale: Seconds the parts are still served after they expired
+        """
+        now = time.monotonic()
+        volatile_ttl = ttl if volatile_ttl is None else min(ttl, volatile_ttl)
+        with self._lock:
+            self._entries[key] = (now + ttl, now + volatile_ttl, max_stale, dict(parts))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def refresh(
+        self,
+        key: str,
+        volatile_parts: dict,
+        volatile_fields: Iterable[str],
+        volatile_ttl: float,
+    ) -> Optional[dict]:
+        """
+        Replace the volatile fields of an entry, keeping its stable part and
+        its expiry. Returns the updated parts, or None if the entry is gone.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, _, max_stale, parts = entry
+            parts = merge_volatile(parts, volatile_parts, volatile_fields)
+            volatile_expires_at = min(expires_at, time.monotonic() + volatile_ttl)
+            self._entries[key] = (expires_at, volatile_expires_at, max_stale, parts)
+            return dict(parts)
+
+    def purge(self, key: str) -> bool:
+        """Drop the entry of `key`, True if there was one."""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def merge_volatile(
+    parts: dict, volatile_parts: dict, volatile_fields: Iterable[str]
+) -> dict:
+    """
+    Swap the volatile fields of `parts` for `volatile_parts`. The new fields
+    take the place of the first old one so the embed keeps its field order,
+    e.g. "Releases on" becoming "Released on" stays where it was.
+    """
+    volatile_fields = set(volatile_fields)
+    merged = {}
+    inserted = False
+    for name, value in parts.items():
+        if name not in volatile_fields:
+            merged[name] = value
+        elif not inserted:
+            merged.update(volatile_parts)
+            inserted = True
+    if not inserted:
+        merged.update(volatile_parts)
+    return merged
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Dict, Tuple
+
+import discord
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Discord allows about five edits every two seconds per webhook
+EDIT_INTERVAL_SECONDS = 0.4
+
+
+class EditBatcher:
+    """
+    Applies edits to sent messages no faster than one every `interval`
+    seconds per channel, which stays within Discord's webhook rate limits.
+    Edits to a message still waiting for its turn are merged into one, the
+    latest value of each field wins, so a burst of enrichments costs a
+    single request.
+
+    Args:
+        interval: Seconds between two edits in the same channel
+    """
+
+    def __init__(self, interval: float = EDIT_INTERVAL_SECONDS):
+        self.interval = interval
+        # channel id -> message id -> (message, fields to edit)
+        self._pending: Dict[int, Dict[int, Tuple[discord.Message, dict]]] = {}
+        self._workers: Dict[int, "asyncio.Task[None]"] = {}
+
+    def edit(self, message: discord.Message, **fields):
+        """Queue an edit of `message`, taking the same arguments as its edit."""
+        channel_id = message.channel.id
+        pending = self._pending.setdefault(channel_id, {})
+        if message.id in pending:
+            pending[message.id][1].update(fields)
+            metrics.increment("embed_edits_merged_total")
+        else:
+            pending[message.id] = (message, dict(fields))
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.ensure_future(self._drain(channel_id))
+
+    def pending(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    async def _drain(self, channel_id: int):
+        pending = self._pending[channel_id]
+        try:
+            while pending:
+                message_id = next(iter(pending))
+                message, fields = pending.pop(message_id)
+                try:
+                    await message.edit(**fields)
+                    metrics.increment("embed_edits_total")
+                except discord.HTTPException as e:
+                    logger.warning("Could not edit message %s: %s", message_id, e)
+                await asyncio.sleep(self.interval)
+        finally:
+            self._workers.pop(channel_id, None)
+            self._pending.pop(channel_id, None)
@@ -1,11 +1,12 @@
 import math
 import re
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterable, List
 
 from bs4 import Tag
 
-from object_types import CategorizedLink, link_types
+from object_types import CategorizedLink
+from platform_registry import get_platform, match_platform
 
 
 def formatMillisecondsToDurationString(milliseconds):
@@ -45,16 +46,6 @@ def remove_trailing_slash(url: str):
 def find_and_categorize_links(
     message_content: str, isContextMenu=False
 ) -> List[CategorizedLink]:
-    # Define patterns for each platform including additional domains
-    soundcloud_pattern = re.compile(
-        r"https?://(?:www\.|on\.|m\.)?soundcloud\.com/[^\s]+"
-    )
-    youtube_pattern = re.compile(
-        r"https?://(?:www\.|music\.|m\.)?(?:youtube\.com|youtu\.be)/[^\s]+"
-    )
-    spotify_pattern = re.compile(r"https?://(?:open\.)?spotify\.com/[^\s]+")
-    bandcamp_pattern = re.compile(r"https?://[A-Za-z0-9_-]+\.bandcamp\.com/[^\s]+")
-
     # Initialize a list to store URLs with their platform types
     categorized_links = []
 
@@ -75,24 +66,30 @@ def find_and_categorize_links(
 
     # Determine the platform for each URL and maintain order
     for url in cleaned_links:
-        if soundcloud_pattern.match(url):
-            if url.startswith("https://m.soundcloud.com"):
-                url = url.replace("m.", "")
-            elif url.startswith("https://www.soundcloud.com"):
-                url = url.replace("www.", "")
-            categorized_links.append((url, link_types.soundcloud))
-        elif youtube_pattern.match(url):
-            if url.startswith("https://m.youtube.com"):
-                url = url.replace("m.", "www.", 1)
-            categorized_links.append((url, link_types.youtube))
-        elif spotify_pattern.match(url):
-            categorized_links.append((url, link_types.spotify))
-        elif bandcamp_pattern.match(url):
-            categorized_links.append((url, link_types.bandcamp))
+        platform = match_platform(url)
+        if platform:
+            categorized_links.append((platform.canonicalize(url), platform.name))
 
     return categorized_links
 
 
+def link_key(link: CategorizedLink) -> str:
+    """The cache key of a link, the same for links to the same thing."""
+    return get_platform(link[1]).cache_key(link[0])
+
+
+def read_links(lines: Iterable[str]) -> List[CategorizedLink]:
+    """
+    Every supported link in the lines, canonicalized, once per cache key so
+    links differing only in tracking parameters are resolved once.
+    """
+    links: Dict[str, CategorizedLink] = {}
+    for line in lines:
+        for link in find_and_categorize_links(line, True):
+            links.setdefault(link_key(link), link)
+    return list(links.values())
+
+
 def get_tag(soup, id=None, tag_name=None, attrs=None, property=None) -> Tag | None:
     """
     Safely get content from a BeautifulSoup tag with proper type checking.
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# What to do with a message arriving while the queue is full
+DROP_OLDEST = "drop_oldest"  # drop the longest waiting message for it
+CACHE_ONLY = "cache_only"  # embed it only from cached parts
+BUSY = "busy"  # let the poster know with a reaction
+OVERLOAD_POLICIES = (DROP_OLDEST, CACHE_ONLY, BUSY)
+
+
+class IngestionQueue:
+    """
+    A bounded queue of passive messages worked off by a fixed pool of
+    workers, so a raid or mass-paste cannot grow the number of embeds in
+    flight (and the sockets they hold) without limit. Messages wait in a
+    queue per guild and the workers take them from the guilds in turn, so a
+    guild flooding the bot does not hold up the others. When the queue is
+    full the overload policy applies to the guild with the most messages
+    waiting: DROP_OLDEST makes room by dropping its oldest message,
+    CACHE_ONLY and BUSY hand its newest one (the new message, when it is
+    that guild's) to `shed` instead, which is expected to do only cheap
+    work with it.
+
+    Args:
+        handle: Coroutine function embedding one message
+        shed: Coroutine function called with each message that is dropped
+            or turned away
+        workers: Messages handled at once
+        capacity: Messages allowed to wait
+        policy: One of OVERLOAD_POLICIES
+    """
+
+    def __init__(
+        self,
+        handle: Callable[[Any], Awaitable[None]],
+        shed: Callable[[Any], Awaitable[None]],
+        workers: int = 8,
+        capacity: int = 100,
+        policy: str = DROP_OLDEST,
+    ):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy {policy}")
+        self.handle = handle
+        self.shed = shed
+        self.workers = workers
+        self.capacity = capacity
+        self.policy = policy
+        # waiting items by guild, in the order the guilds take their turns
+        self._queues: Dict[Hashable, Deque[Any]] = OrderedDict()
+        self._depth = 0
+        self._ready: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._unfinished = 0
+        self._workers: List["asyncio.Task[None]"] = []
+        self._busy = 0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    async def submit(self, item: Any, key: Hashable = None):
+        """
+        Queue an item, applying the overload policy when the queue is full.
+
+        Args:
+            item: The item to handle
+            key: Guild (or other owner) of the item, items of one key wait
+                behind each other and take turns with the other keys
+        """
+        if self._ready is None:
+            self._start()
+        shed = None
+        if self._depth >= self.capacity:
+            shed = self._make_room(key, item)
+            metrics.increment("ingestion_shed_total", policy=self.policy)
+            logger.warning("Ingestion queue is full, applying %s", self.policy)
+        if shed is not item:
+            self._queues.setdefault(key, deque()).append(item)
+            if shed is None:
+                self._depth += 1
+                self._unfinished += 1
+                self._idle.clear()
+                self._ready.release()
+        self._publish()
+        if shed is not None:
+            await self.shed(shed)
+
+    async def join(self):
+        """Wait until every queued item has been handled."""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        self._queues.clear()
+        self._depth = 0
+        self._unfinished = 0
+        self._ready = None
+        self._idle = None
+
+    def _start(self):
+        # created on first use, they belong to the running event loop
+        self._ready = asyncio.Semaphore(0)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [
+            asyncio.ensure_future(self._work(self._ready)) for _ in range(self.workers)
+        ]
+
+    def _make_room(self, key: Hashable, item: Any) -> Any:
+        # the guild with the most items waiting gives one up, the submitting
+        # one when it ties, so one guild cannot crowd out the others
+        waiting = len(self._queues.get(key, ()))
+        longest = max(self._queues, key=lambda other: len(self._queues[other]))
+        if len(self._queues[longest]) <= waiting:
+            longest = key
+        if self.policy == DROP_OLDEST:
+            return self._take(longest, newest=False)
+        if longest == key:
+            return item
+        return self._take(longest, newest=True)
+
+    def _take(self, key: Hashable, newest: bool) -> Any:
+        queue = self._queues[key]
+        item = queue.pop() if newest else queue.popleft()
+        if not queue:
+            del self._queues[key]
+        return item
+
+    def _next(self) -> Any:
+        # the guild first in turn gives its oldest item and goes last
+        key = next(iter(self._queues))
+        item = self._take(key, newest=False)
+        if key in self._queues:
+            self._queues.move_to_end(key)
+        self._depth -= 1
+        return item
+
+    async def _work(self, ready: asyncio.Semaphore):
+        while True:
+            await ready.acquire()
+            item = self._next()
+            self._busy += 1
+            self._publish()
+            try:
+                await self.handle(item)
+            except Exception as e:
+                logger.error("Could not handle a queued item: %s", e)
+            finally:
+                self._busy -= 1
+                self._unfinished -= 1
+                if self._unfinished == 0:
+                    self._idle.set()
+                self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("ingestion_queue_depth", self.depth)
+        metrics.set_gauge("ingestion_busy_workers", self._busy)
@@ -0,0 +1,154 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+
+# Finished jobs are remembered this long, so a message seen twice is
+# embedded once
+DONE_RETENTION_SECONDS = 24 * 60 * 60
+# Old finished jobs are pruned once every this many finished jobs, so the
+# table and its WAL stay small while the bot runs
+PRUNE_EVERY_FINISHES = 1000
+# A job that was started this often without finishing is given up on,
+# it probably takes the bot down with it
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    guild_id INTEGER,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class JobStore:
+    """
+    Embed jobs persisted in SQLite, keyed by message id. Jobs still pending
+    when the bot stops are replayed after a restart, and a message that
+    already has a job is not queued again, so every message is embedded
+    at most once.
+
+    Args:
+        path: The SQLite database file, opened on first use
+        retention: Seconds finished jobs are remembered
+        prune_every: Finished jobs between two prunes
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retention: float = DONE_RETENTION_SECONDS,
+        prune_every: int = PRUNE_EVERY_FINISHES,
+    ):
+        self.path = path
+        self.retention = retention
+        self.prune_every = prune_every
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._finished = 0
+
+    def add(self, message_id: int, channel_id: int, guild_id: Optional[int]) -> bool:
+        """Record a new pending job, False if the message already has one."""
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT OR IGNORE INTO jobs "
+                "(message_id, channel_id, guild_id, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (message_id, channel_id, guild_id, PENDING, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def start(self, message_id: int):
+        """Count an attempt at a job, before any work is done for it."""
+        self._execute(
+            "UPDATE jobs SET attempts = attempts + 1, updated_at = ? "
+            "WHERE message_id = ?",
+            (time.time(), message_id),
+        )
+
+    def finish(self, message_id: int):
+        """
+        Mark a job done, whether it was embedded, dropped or failed. Every
+        `prune_every` finished jobs, the old ones are pruned.
+        """
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE message_id = ?",
+                (DONE, time.time(), message_id),
+            )
+            self._finished += 1
+            if self._finished % self.prune_every == 0:
+                pruned = self._prune(self.retention)
+                logger.debug("Pruned %d finished jobs", pruned)
+
+    def pending(self) -> List[Tuple[int, int]]:
+        """
+        (message id, channel id) of the jobs to replay, oldest first. Jobs
+        that were attempted too often are finished instead.
+        """
+        with self._lock:
+            connection = self._connect()
+            abandoned = connection.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? "
+                "WHERE state = ? AND attempts >= ?",
+                (DONE, time.time(), PENDING, MAX_ATTEMPTS),
+            ).rowcount
+            if abandoned:
+                logger.warning("Giving up on %d jobs that kept failing", abandoned)
+            return connection.execute(
+                "SELECT message_id, channel_id FROM jobs WHERE state = ? "
+                "ORDER BY message_id",
+                (PENDING,),
+            ).fetchall()
+
+    def prune(self, retention: Optional[float] = None) -> int:
+        """
+        Forget jobs finished more than `retention` seconds ago, the store's
+        retention if not given.
+        """
+        with self._lock:
+            return self._prune(self.retention if retention is None else retention)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _prune(self, retention: float) -> int:
+        connection = self._connect()
+        pruned = connection.execute(
+            "DELETE FROM jobs WHERE state = ? AND updated_at < ?",
+            (DONE, time.time() - retention),
+        ).rowcount
+        if pruned:
+            # hand the freed WAL space back rather than letting the file grow
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return pruned
+
+    def _execute(self, sql: str, parameters: tuple):
+        with self._lock:
+            self._connect().execute(sql, parameters)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # autocommit, every statement is its own transaction
+            self._connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps NORMAL safe against corruption, a crash may only
+            # lose the last few updates, which replay covers
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(_SCHEMA)
+        return self._connection
@@ -0,0 +1,79 @@
+"""
+Runs the bot sharded over several processes on one machine: one shared
+resolver tier (resolver_tier.py) and one gateway process per shard
+(main.py), which hand their lookups to the tier over a Unix socket.
+
+    SHARD_COUNT=4 python launcher.py
+
+SHARD_COUNT defaults to the number of CPUs and RESOLVER_SOCKET to
+/tmp/coolvivy-resolver.sock. If any process exits the others are stopped,
+so a supervisor restarting the launcher restarts all of them.
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from resolver_tier import DEFAULT_SOCKET_PATH
+
+# Seconds to wait for the resolver tier to listen before starting shards
+RESOLVER_START_TIMEOUT = 30
+
+
+def _spawn(script: str, *args: str, **env: str) -> subprocess.Popen:
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen(
+        [sys.executable, os.path.join(here, script), *args],
+        env=dict(os.environ, **env),
+    )
+
+
+def _wait_for_socket(path: str, resolver: subprocess.Popen):
+    deadline = time.monotonic() + RESOLVER_START_TIMEOUT
+    while not os.path.exists(path):
+        if resolver.poll() is not None or time.monotonic() > deadline:
+            raise SystemExit("The resolver tier did not start")
+        time.sleep(0.1)
+
+
+def main() -> int:
+    shard_count = int(os.getenv("SHARD_COUNT") or os.cpu_count() or 1)
+    socket_path = os.getenv("RESOLVER_SOCKET", DEFAULT_SOCKET_PATH)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    resolver = _spawn("resolver_tier.py", socket_path)
+    processes = [resolver]
+    try:
+        _wait_for_socket(socket_path, resolver)
+        for shard in range(shard_count):
+            processes.append(
+                _spawn(
+                    "main.py",
+                    SHARD_COUNT=str(shard_count),
+                    SHARD_IDS=str(shard),
+                    RESOLVER_SOCKET=socket_path,
+                    # state keyed by guild stays with the shard owning it
+                    JOB_DB_PATH=f"jobs-shard{shard}.sqlite3",
+                    PROCESSED_INDEX_PATH=f"processed_index-shard{shard}.bin",
+                )
+            )
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        while True:
+            for process in processes:
+                code = process.poll()
+                if code is not None:
+                    print(f"Process {process.args} exited with {code}")
+                    return code or 1
+            time.sleep(1)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import json
 import logging
@@ -7,13 +8,26 @@ import re
 import discord
 from discord.ext import commands
 
-from bandcamp_utils import getBandcampParts
+import deadlines
+import metrics
+from backfill import BackfillProgress, backfill_history
+from embed_edits import EditBatcher
 from general_utils import find_and_categorize_links, remove_trailing_slash
-from object_types import CategorizedLink, link_types
+from ingestion import BUSY, CACHE_ONLY, DROP_OLDEST, IngestionQueue
+from job_store import JobStore
+from object_types import CategorizedLink
+from platform_registry import (
+    cached_link,
+    get_author_block,
+    load_resolvers,
+    purge_link,
+    resolve_link,
+)
+from platform_registry import resolve_links as resolve_local_links
+from processed_index import ProcessedIndex
 from reactions import PaginatedSelect, fetch_animated_emotes
-from soundcloud_utils import getSoundcloudParts
-from spotify_utils import getSpotifyParts
-from youtube_utils import getYouTubeParts
+from resolver_tier import ResolverClient, ResolverError
+from scheduler import INTERACTIVE, PASSIVE, scheduler
 
 _log_level = (
     logging.DEBUG if os.getenv("LOG_LEVEL", "").upper() == "DEBUG" else logging.WARNING
@@ -25,14 +39,52 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds an embed may spend on optional enrichments, interactions have to
+# be answered quickly so they get the smaller budget
+EMBED_DEADLINE_SECONDS = 8
+INTERACTION_DEADLINE_SECONDS = 2.5
+# Auto-embeds worked on at once and allowed to wait, beyond that the
+# OVERLOAD_POLICY applies
+INGESTION_WORKERS = 8
+INGESTION_CAPACITY = 100
+
+edit_batcher = EditBatcher()
+# Keeps enrichments and backfills running after their message was sent
+_background_tasks = set()
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# SHARD_COUNT runs the bot sharded, over the SHARD_IDS given or all shards
+# in this process, see launcher.py
+shardCount = os.getenv("SHARD_COUNT")
+if shardCount:
+    shardIds = os.getenv("SHARD_IDS")
+    shardIdList = [int(shard) for shard in shardIds.split(",")] if shardIds else None
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=int(shardCount),
+        shard_ids=shardIdList,
+    )
+    # the command tree is global, only the process running shard 0 syncs it
+    syncsCommands = shardIdList is None or 0 in shardIdList
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+    syncsCommands = True
 
 ownerUser = str(os.getenv("OWNER_USER_ID"))
 testInstance = os.getenv("TEST_INSTANCE", "False")
+progressiveEmbeds = os.getenv("PROGRESSIVE_EMBEDS", "False") == "True"
+overloadPolicy = os.getenv("OVERLOAD_POLICY", DROP_OLDEST)
+busyEmoji = os.getenv("BUSY_EMOJI", "⏳")
+job_store = JobStore(os.getenv("JOB_DB_PATH", "jobs.sqlite3"))
+jobsReplayed = False
+commandsSynced = False
+processed_index = ProcessedIndex(
+    os.getenv("PROCESSED_INDEX_PATH", "processed_index.bin")
+)
 servers = os.getenv("SERVERS")
 if servers:
     server_whitelist = json.loads(servers)
@@ -40,13 +92,34 @@ else:
     server_whitelist = []
     print("SERVERS is not set in the environment variables.")
 
+# Sharded processes share one resolver tier, and with it one cache
+resolverSocket = os.getenv("RESOLVER_SOCKET")
+resolver_tier = ResolverClient(resolverSocket) if resolverSocket else None
+if resolver_tier is None:
+    # the resolver tier loads them for sharded processes
+    load_resolvers()
+
+# Optional fair queuing weight and concurrency cap of whitelisted servers
+# e.g. '{"16568721763": {"weight": 2, "max_concurrency": 4}}'
+guildLimits = json.loads(os.getenv("GUILD_LIMITS", "{}"))
+for guildId in server_whitelist:
+    scheduler.configure_guild(guildId, **guildLimits.get(guildId, {}))
+
 
 @bot.event
 async def on_ready():
+    global jobsReplayed, commandsSynced
     print(f"We have logged in as {bot.user}")
+    # on_ready fires again after reconnects, jobs are replayed once
+    if not jobsReplayed:
+        jobsReplayed = True
+        await replayPendingJobs()
+    if not syncsCommands or commandsSynced:
+        return
     # Sync commands to make sure they are registered
     try:
         synced = await bot.tree.sync()
+        commandsSynced = True
         print(f"Synced {len(synced)} command(s)")
     except Exception as e:
         print(f"Failed to sync commands: {e}")
@@ -98,6 +171,81 @@ async def on_reaction_add(reaction: discord.Reaction, user: discord.User):
                 break
 
 
+async def resolve_links(links):
+    if resolver_tier:
+        return await resolver_tier.resolve_links(links)
+    return await resolve_local_links(links)
+
+
+async def cachedLinks(links):
+    if resolver_tier:
+        return [await resolver_tier.cached_link(link) for link in links]
+    return [cached_link(link) for link in links]
+
+
+async def purgeLink(url):
+    if resolver_tier:
+        return await resolver_tier.purge_link(url)
+    return purge_link(url)
+
+
+async def embedMessage(message):
+    try:
+        await fetchEmbed(message, False)
+    except Exception as e:
+        print(f"Error: {e}")
+
+
+async def handleQueuedMessage(message):
+    # counted before any work, a message that crashes the bot is not
+    # replayed forever. SQLite commits block, they run off the event loop
+    await asyncio.to_thread(job_store.start, message.id)
+    try:
+        await embedMessage(message)
+    finally:
+        await asyncio.to_thread(job_store.finish, message.id)
+
+
+async def shedQueuedMessage(message):
+    # only cheap work here, this runs because the bot is overloaded
+    try:
+        if overloadPolicy == CACHE_ONLY:
+            try:
+                await fetchEmbed(message, False, cacheOnly=True)
+            except Exception as e:
+                print(f"Error: {e}")
+        elif overloadPolicy == BUSY:
+            with contextlib.suppress(discord.HTTPException):
+                await message.add_reaction(busyEmoji)
+    finally:
+        await asyncio.to_thread(job_store.finish, message.id)
+
+
+async def replayPendingJobs():
+    """Queue the auto-embeds that were still pending when the bot stopped."""
+    await asyncio.to_thread(job_store.prune)
+    for messageId, channelId in await asyncio.to_thread(job_store.pending):
+        try:
+            channel = bot.get_channel(channelId) or await bot.fetch_channel(
+                channelId
+            )
+            message = await channel.fetch_message(messageId)
+        except discord.HTTPException:
+            # deleted, most likely replaced by its embed before the restart
+            await asyncio.to_thread(job_store.finish, messageId)
+            continue
+        await ingestion_queue.submit(message, message.guild and message.guild.id)
+
+
+ingestion_queue = IngestionQueue(
+    handleQueuedMessage,
+    shedQueuedMessage,
+    workers=INGESTION_WORKERS,
+    capacity=INGESTION_CAPACITY,
+    policy=overloadPolicy,
+)
+
+
 @bot.event
 async def on_message(message):
     if message.author.bot is True or (
@@ -115,10 +263,20 @@ async def on_message(message):
                 else "Use **/help** for help."
             )
     elif message.guild and str(message.guild.id) in server_whitelist:
-        try:
-            await fetchEmbed(message, False)
-        except Exception as e:
-            print(f"Error: {e}")
+        if find_and_categorize_links(message.content):
+            if await asyncio.to_thread(processed_index.check_and_add, message.id):
+                # delivered again, after a reconnect or a restart. The index
+                # is saved to disk now and then, hence the thread
+                metrics.increment("duplicate_messages_total")
+                return
+            # embeds are worked off by a fixed pool, see ingestion.py, and
+            # persisted until done so a restart does not lose them
+            if await asyncio.to_thread(
+                job_store.add, message.id, message.channel.id, message.guild.id
+            ):
+                await ingestion_queue.submit(message, message.guild.id)
+        else:
+            await embedMessage(message)
     else:
         referencedUser = await getReferencedUser(message)
         if referencedUser:
@@ -173,7 +331,9 @@ async def fetchWebhook(message):
     return webhook
 
 
-async def fetchEmbed(message, isInteraction=False, isDM=False, isContext=False):
+async def fetchEmbed(
+    message, isInteraction=False, isDM=False, isContext=False, cacheOnly=False
+):
     webhook = None
     referencedUser = None
     embeds = []
@@ -191,39 +351,44 @@ async def fetchEmbed(message, isInteraction=False, isDM=False, isContext=False):
             "Bandcamp, SoundCloud, Spotify and YouTube links are supported."
         )
 
-    for link in allMusicUrls:
+    # interactions only reply with the first embed
+    links = allMusicUrls[:1] if isInteraction else allMusicUrls
+    progressive = canUseWebhook and progressiveEmbeds
+    deadline = (
+        INTERACTION_DEADLINE_SECONDS if isInteraction else EMBED_DEADLINE_SECONDS
+    )
+    # context menus are answered before passive auto-embeds, which queue
+    # per guild and may be shed when too many are waiting
+    jobClass = INTERACTIVE if isInteraction or isContext else PASSIVE
+    # resolve every link up front so lookups run (and batch) concurrently,
+    # enrichments that do not fit in the budget are left out
+    guildId = str(message.guild.id) if message.guild else None
+    if cacheOnly:
+        # the bot is overloaded, embed only what needs no lookup
+        allFieldParts = await cachedLinks(links)
+        if not all(allFieldParts):
+            raise Exception("Not every link is cached")
+    elif progressive:
+        # the message goes out with what the cache knows, the other links
+        # are looked up and edited in by enrichEmbeds
+        allFieldParts = await cachedLinks(links)
+    else:
+        async with scheduler.slot(jobClass, guildId):
+            with deadlines.budget(deadline):
+                allFieldParts = await resolve_links(links)
+    skeleton = progressive and not all(allFieldParts)
+    if skeleton:
+        allFieldParts = [
+            parts or placeholderParts(link)
+            for link, parts in zip(links, allFieldParts, strict=True)
+        ]
+
+    for link, fieldParts in zip(links, allFieldParts, strict=True):
         # get all embed fields
-        fieldParts = getDescriptionParts(link)
         if not fieldParts:
             raise Exception("No data found")
 
-        # create a new embed
-        embedVar = discord.Embed(
-            title=fieldParts.get("title"),
-            description=fieldParts.get("description"),
-            color=fieldParts.get("embedColour", 0x00DCFF),
-            url=remove_trailing_slash(link[0]),
-        )
-
-        # add platform link if applicable
-        setAuthorLink(embedVar, fieldParts.get("embedPlatformType"))
-
-        # thumbnail
-        thumbnailUrl = fieldParts.get("thumbnailUrl")
-        if thumbnailUrl:
-            embedVar.set_thumbnail(url=thumbnailUrl)
-
-        # populate embed fields
-        for key, value in fieldParts.items():
-            if key not in [
-                "description",
-                "title",
-                "thumbnailUrl",
-                "embedPlatformType",
-                "embedColour",
-            ]:
-                inline = key not in ["Tags", "Description", "Tracks", "Videos"]
-                embedVar.add_field(name=key, value=value, inline=inline)
+        embedVar = buildEmbed(link, fieldParts)
 
         # remove embed from original message
         if not isInteraction and fieldParts.get("embedPlatformType") == "bandcamp":
@@ -267,83 +432,121 @@ async def fetchEmbed(message, isInteraction=False, isDM=False, isContext=False):
                 f"{referencedUser.mention if referencedUser else ''} {jump_url}\n"
                 f"{message.content}"
             )
-        embeds[-1].set_footer(
-            text="Powered by CoolVivy",
-            icon_url=f"{message.channel.guild.me.avatar.url}#{message.author.id}",
-        )
+        setFooter(embeds[-1], message)
+        # the sent message is only needed to edit in the missing links
         if hasattr(message.channel, "parent"):
-            await webhook.send(
+            sentMessage = await webhook.send(
                 content=message.content,
                 embeds=embeds,
                 username=message.author.display_name,
                 avatar_url=message.author.avatar.url,
                 thread=message.channel,
+                wait=skeleton,
             )
         else:
-            await webhook.send(
+            sentMessage = await webhook.send(
                 content=message.content,
                 embeds=embeds,
                 username=message.author.display_name,
                 avatar_url=message.author.avatar.url,
+                wait=skeleton,
             )
         sentReplyMessage = True
+        if skeleton:
+            metrics.increment("embed_skeletons_total")
+            task = asyncio.ensure_future(
+                enrichEmbeds(sentMessage, links, allFieldParts, message)
+            )
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
         # remove original message
         await message.delete()
     if not sentReplyMessage and referencedUser:
         await message.reply(referencedUser.mention, mention_author=False)
 
 
+def buildEmbed(link: CategorizedLink, fieldParts: dict) -> discord.Embed:
+    embedVar = discord.Embed(
+        title=fieldParts.get("title"),
+        description=fieldParts.get("description"),
+        color=fieldParts.get("embedColour", 0x00DCFF),
+        url=remove_trailing_slash(link[0]),
+    )
+
+    # add platform link if applicable
+    setAuthorLink(embedVar, fieldParts.get("embedPlatformType"))
+
+    # thumbnail
+    thumbnailUrl = fieldParts.get("thumbnailUrl")
+    if thumbnailUrl:
+        embedVar.set_thumbnail(url=thumbnailUrl)
+
+    # populate embed fields
+    for key, value in fieldParts.items():
+        if key not in [
+            "description",
+            "title",
+            "thumbnailUrl",
+            "embedPlatformType",
+            "embedColour",
+            "refreshSource",
+        ]:
+            inline = key not in ["Tags", "Description", "Tracks", "Videos"]
+            embedVar.add_field(name=key, value=value, inline=inline)
+    return embedVar
+
+
+def placeholderParts(link: CategorizedLink) -> dict:
+    """Stand-in parts for a link not looked up yet, shown in a skeleton."""
+    return {"title": link[0], "embedPlatformType": link[1]}
+
+
+def setFooter(embedVar, message):
+    # the footer icon carries the poster's id, see getUserIdFromFooter
+    embedVar.set_footer(
+        text="Powered by CoolVivy",
+        icon_url=f"{message.channel.guild.me.avatar.url}#{message.author.id}",
+    )
+
+
+async def enrichEmbeds(sentMessage, links: list, allFieldParts: list, message):
+    """
+    Edit the links left out of a skeleton message into it. Only the links
+    still missing from the cache are looked up, the others are taken from it.
+    """
+    try:
+        cached = await cachedLinks(links)
+        partial = [link for link, parts in zip(links, cached, strict=True) if not parts]
+        guildId = str(message.guild.id) if message.guild else None
+        async with scheduler.slot(PASSIVE, guildId):
+            with deadlines.budget(EMBED_DEADLINE_SECONDS):
+                enriched = iter(await resolve_links(partial) if partial else [])
+    except Exception as e:
+        logger.warning("Could not enrich embeds of %s: %s", sentMessage.id, e)
+        return
+    allFieldParts = [
+        parts or next(enriched, None) or skeleton
+        for parts, skeleton in zip(cached, allFieldParts, strict=True)
+    ]
+    embeds = [
+        buildEmbed(link, fieldParts)
+        for link, fieldParts in zip(links, allFieldParts, strict=True)
+    ]
+    setFooter(embeds[-1], message)
+    edit_batcher.edit(sentMessage, embeds=embeds)
+
+
 async def deleteOriginalInteractionMessage(interaction: discord.Interaction):
     with contextlib.suppress(discord.HTTPException):
         await interaction.delete_original_response()
 
 
 def getDescriptionParts(link: CategorizedLink):
-    linkType = link[1]
-    linkUrl = link[0]
-    if linkType == link_types.soundcloud:
-        return getSoundcloudParts(linkUrl)
-    elif linkType == link_types.youtube:
-        return getYouTubeParts(linkUrl)
-    elif linkType == link_types.spotify:
-        return getSpotifyParts(linkUrl)
-    else:  # Bandcamp
-        if re.match("https?://bandcamp.com.+", linkUrl):
-            return None
-        return getBandcampParts(linkUrl)
+    return resolve_link(link)
 
 
 def setAuthorLink(embedMessage, embedType):
-    if embedType == "soundcloud":
-        embedMessage.set_author(
-            name="SoundCloud",
-            url="https://soundcloud.com/",
-            icon_url="https://soundcloud.com/pwa-round-icon-192x192.png",
-        )
-    elif embedType == "youtube":
-        embedMessage.set_author(
-            name="YouTube",
-            url="https://www.youtube.com/",
-            icon_url="https://www.youtube.com/s/desktop/0c61234c/img/favicon_144x144.png",
-        )
-    elif embedType == "youtubemusic":
-        embedMessage.set_author(
-            name="YouTube Music",
-            url="https://music.youtube.com/",
-            icon_url="https://www.gstatic.com/youtube/media/ytm/images/applauncher/music_icon_144x144.png",
-        )
-    elif embedType == "spotify":
-        embedMessage.set_author(
-            name="Spotify",
-            url="https://open.spotify.com/",
-            icon_url="https://open.spotifycdn.com/cdn/images/icons/Spotify_256.17e41e58.png",
-        )
-    else:
-        embedMessage.set_author(
-            name="Bandcamp",
-            url="https://bandcamp.com/",
-            icon_url="https://s4.bcbits.com/img/favicon/favicon-32x32.png",
-        )
+    embedMessage.set_author(**get_author_block(embedType))
 
 
 def getUserIdFromFooter(message):
@@ -561,6 +764,86 @@ async def quick_react_command(
         )
 
 
+@bot.tree.command(
+    name="purge", description="Forget what is cached for a link (owner only)"
+)
+async def purge_command(interaction: discord.Interaction, url: str):
+    if str(interaction.user.id) != ownerUser:
+        await interaction.response.send_message(
+            "Only the bot owner can purge cached links.", ephemeral=True
+        )
+        return
+    purged = await purgeLink(url.strip())
+    logger.info(f"[purge] {url} purged: {purged}")
+    await interaction.response.send_message(
+        "Purged the cached embed for this link."
+        if purged
+        else "Nothing was cached for this link.",
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(
+    name="backfill",
+    description="Warm the cache with the links in a channel's history (owner only)",
+)
+async def backfill_command(
+    interaction: discord.Interaction, channel: discord.TextChannel, limit: int = 1000
+):
+    if str(interaction.user.id) != ownerUser:
+        await interaction.response.send_message(
+            "Only the bot owner can backfill channels.", ephemeral=True
+        )
+        return
+    await interaction.response.send_message(
+        f"Backfilling the last {limit} messages of {channel.mention}", ephemeral=True
+    )
+
+    async def report(progress: BackfillProgress):
+        # the interaction expires after 15 minutes, later reports are logged
+        logger.info(f"[backfill] {channel.id}: {progress.summary()}")
+        with contextlib.suppress(discord.HTTPException):
+            await interaction.edit_original_response(content=progress.summary())
+
+    async def resolve(link):
+        return (await resolve_links([link]))[0]
+
+    async def cached(link):
+        return (await cachedLinks([link]))[0]
+
+    async def run():
+        try:
+            await backfill_history(
+                channel.history(limit=limit), resolve, cached, report=report
+            )
+        except Exception as e:
+            # the summary still went out, from backfill_history's finally
+            logger.warning(f"[backfill] {channel.id} stopped: {e}")
+
+    task = asyncio.ensure_future(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+@bot.tree.command(name="metrics", description="Show bot metrics (owner only)")
+async def metrics_command(interaction: discord.Interaction):
+    if str(interaction.user.id) != ownerUser:
+        await interaction.response.send_message(
+            "Only the bot owner can see metrics.", ephemeral=True
+        )
+        return
+    rendered = metrics.render()
+    if resolver_tier:
+        # lookups, caches and limits are counted in the shared resolver tier
+        try:
+            rendered += "\n# resolver tier\n" + await resolver_tier.metrics()
+        except (OSError, ResolverError) as e:
+            rendered += f"\n# resolver tier unavailable: {e}"
+    # keep within Discord's 2000 character message limit
+    rendered = rendered.strip()[:1900] or "No metrics yet."
+    await interaction.response.send_message(f"```\n{rendered}\n```", ephemeral=True)
+
+
 @bot.tree.command(name="help", description="Show help information")
 async def help_command(interaction: discord.Interaction):
     help_text = """I provide information about track links and albums.
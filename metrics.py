@@ -0,0 +1,73 @@
+import threading
+from typing import Dict, Tuple
+
+# In-process metrics, shown to the owner through the /metrics command.
+# Series are keyed by name and label values, Prometheus style.
+
+_SeriesKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_lock = threading.Lock()
+_counters: Dict[_SeriesKey, float] = {}
+_gauges: Dict[_SeriesKey, float] = {}
+# name -> (count, total, max) of observed values
+_summaries: Dict[_SeriesKey, Tuple[int, float, float]] = {}
+
+
+def _key(name: str, labels: Dict[str, object]) -> _SeriesKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    """Record one observation, like a wait time, into a count/sum/max summary."""
+    key = _key(name, labels)
+    with _lock:
+        count, total, maximum = _summaries.get(key, (0, 0.0, value))
+        _summaries[key] = (count + 1, total + value, max(maximum, value))
+
+
+def get(name: str, **labels) -> float:
+    """The current value of a counter or gauge, 0 if it was never set."""
+    key = _key(name, labels)
+    with _lock:
+        return _counters.get(key, _gauges.get(key, 0))
+
+
+def snapshot() -> Dict[str, float]:
+    """Every series as `name{label="value"}` -> value."""
+    with _lock:
+        series = {_format(key): value for key, value in _counters.items()}
+        series.update({_format(key): value for key, value in _gauges.items()})
+        for (name, labels), (count, total, maximum) in _summaries.items():
+            series[_format((f"{name}_count", labels))] = count
+            series[_format((f"{name}_sum", labels))] = total
+            series[_format((f"{name}_max", labels))] = maximum
+    return dict(sorted(series.items()))
+
+
+def render() -> str:
+    return "\n".join(f"{name} {value:g}" for name, value in snapshot().items())
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
+
+
+def _format(key: _SeriesKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
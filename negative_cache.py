@@ -0,0 +1,81 @@
+from typing import Optional
+
+from embed_cache import EmbedCache
+
+# Seconds a failed lookup is remembered, by the class of failure.
+# Failures that may clear up on their own (timeouts, rate limits, 5xx) are
+# never remembered.
+NEGATIVE_TTLS = {
+    # deleted or never existed
+    "not_found": 60 * 60,
+    # private, or needs a login we do not have
+    "private": 15 * 60,
+    # resolved without an error but with nothing to show
+    "no_data": 5 * 60,
+}
+
+
+class LinkUnavailable(Exception):
+    """
+    A link that cannot be embedded and is not worth retrying for a while.
+
+    Args:
+        reason: The class of failure, one of `NEGATIVE_TTLS`
+        message: What to tell the user
+    """
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+# Set by a resolver on the bare parts it returns when the upstream answered
+# but had nothing to embed. Only those are remembered as `no_data`; bare parts
+# returned after an error may be transient and are not remembered at all.
+NO_DATA = "noData"
+
+# Failed lookups by `Platform.cache_key`, as {'reason', 'message'} or, for
+# lookups that returned incomplete parts, {'reason', 'parts'}
+failed_links = EmbedCache(max_entries=4096)
+
+
+def classify_failure(error: BaseException) -> Optional[str]:
+    """The class of failure of an exception, or None if it may be transient."""
+    if isinstance(error, LinkUnavailable):
+        return error.reason
+    response = getattr(error, "response", None)
+    # requests.HTTPError carries a response, urllib's HTTPError a code
+    status = getattr(response, "status_code", None) or getattr(error, "code", None)
+    if status in (404, 410):
+        return "not_found"
+    if status == 403:
+        return "private"
+    return None
+
+
+def remember_failure(key: str, error: BaseException):
+    reason = classify_failure(error)
+    if reason in NEGATIVE_TTLS:
+        failed_links.set(
+            key, {"reason": reason, "message": str(error)}, NEGATIVE_TTLS[reason]
+        )
+
+
+def remember_incomplete(key: str, parts: dict):
+    failed_links.set(
+        key, {"reason": "no_data", "parts": parts}, NEGATIVE_TTLS["no_data"]
+    )
+
+
+def replay_failure(key: str) -> Optional[dict]:
+    """
+    Replays a remembered failure: raises LinkUnavailable for failed lookups
+    and returns the incomplete parts of lookups that found nothing.
+    Returns None when nothing is remembered for the key.
+    """
+    failure = failed_links.get(key)
+    if failure is None:
+        return None
+    if "parts" in failure:
+        return dict(failure["parts"])
+    raise LinkUnavailable(failure["reason"], failure["message"])
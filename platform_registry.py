@@ -0,0 +1,484 @@
+import asyncio
+import importlib
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import deadlines
+from bulkheads import bulkheads
+from embed_cache import CachedParts, EmbedCache
+from negative_cache import (
+    NO_DATA,
+    classify_failure,
+    failed_links,
+    remember_failure,
+    remember_incomplete,
+    replay_failure,
+)
+from object_types import CategorizedLink, PlatformType, link_types
+
+logger = logging.getLogger(__name__)
+
+# Query parameters that never change what a link points to
+_TRACKING_PARAMS = {"si", "feature", "ref", "context", "nd", "pp", "t"}
+
+
+class Platform:
+    """
+    Everything the bot needs to know about a supported music platform.
+
+    Args:
+        name: The link type for this platform (see `link_types`)
+        pattern: Regex matching URLs that belong to this platform
+        resolver: Dotted path to the function that maps a URL to embed parts.
+            It is looked up on every call, which keeps this module free of
+            import cycles with the platform modules (they import general_utils).
+        authors: Embed author blocks keyed by `embedPlatformType`
+        canonicalize: Optional function rewriting a matched URL into the form
+            that is fetched and displayed
+        cache_key: Optional function mapping a canonical URL to a cache key
+        skip_pattern: Regex for URLs on this platform that cannot be embedded
+        cache_ttl: Seconds a resolved embed stays in the cache
+        async_resolver: Optional dotted path to a coroutine function used
+            instead of running `resolver` on the platform's bulkhead, for
+            platforms that batch or fetch on the event loop
+        volatile_fields: Embed fields that go stale long before the rest,
+            like play counts and prices
+        volatile_ttl: Seconds the volatile fields stay fresh
+        refresher: Optional dotted path to a function re-fetching only the
+            volatile fields from the `refreshSource` of cached parts, through
+            the platform's cheapest endpoint. Returns None when it cannot.
+        max_stale: Seconds expired parts may still be served while they are
+            revalidated in the background
+    """
+
+    def __init__(
+        self,
+        name: PlatformType,
+        pattern: str,
+        resolver: str,
+        authors: Dict[str, dict],
+        canonicalize: Optional[Callable[[str], str]] = None,
+        cache_key: Optional[Callable[[str], str]] = None,
+        skip_pattern: Optional[str] = None,
+        cache_ttl: int = 0,
+        async_resolver: Optional[str] = None,
+        volatile_fields: Tuple[str, ...] = (),
+        volatile_ttl: Optional[int] = None,
+        refresher: Optional[str] = None,
+        max_stale: int = 0,
+    ):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.resolver = resolver
+        self.authors = authors
+        self._canonicalize = canonicalize
+        self._cache_key = cache_key
+        self.skip_pattern = re.compile(skip_pattern) if skip_pattern else None
+        self.cache_ttl = cache_ttl
+        self.async_resolver = async_resolver
+        self.volatile_fields = volatile_fields
+        self.volatile_ttl = volatile_ttl
+        self.refresher = refresher
+        self.max_stale = max_stale
+
+    def matches(self, url: str) -> bool:
+        return bool(self.pattern.match(url))
+
+    def canonicalize(self, url: str) -> str:
+        return self._canonicalize(url) if self._canonicalize else url
+
+    def cache_key(self, url: str) -> str:
+        key = self._cache_key(url) if self._cache_key else None
+        return f"{self.name}:{key or strip_tracking(url)}"
+
+    def can_resolve(self, url: str) -> bool:
+        return not (self.skip_pattern and self.skip_pattern.match(url))
+
+    def load_resolver(self) -> Callable[[str], dict]:
+        return _load(self.resolver)
+
+    def resolve(self, url: str) -> Optional[dict]:
+        if not self.can_resolve(url):
+            return None
+        return self.load_resolver()(url)
+
+    async def resolve_async(self, url: str) -> Optional[dict]:
+        if not self.can_resolve(url):
+            return None
+        if self.async_resolver:
+            resolver: Callable[[str], Awaitable[dict]] = _load(self.async_resolver)
+            return await resolver(url)
+        return await bulkheads[self.name].run(self.load_resolver(), url)
+
+    def can_refresh(self, parts: dict) -> bool:
+        return bool(self.refresher and parts.get("refreshSource"))
+
+    def refresh(self, parts: dict) -> Optional[dict]:
+        """Fresh volatile fields for cached parts, or None to resolve again."""
+        if not self.can_refresh(parts):
+            return None
+        refresher: Callable[[dict], Optional[dict]] = _load(self.refresher)
+        return refresher(parts["refreshSource"])
+
+    async def refresh_async(self, parts: dict) -> Optional[dict]:
+        if not self.can_refresh(parts):
+            return None
+        return await bulkheads[self.name].run(self.refresh, parts)
+
+    def entry_ttls(self, parts: dict) -> Tuple[int, Optional[int]]:
+        """
+        Cache TTLs for the stable and the volatile part of resolved parts.
+        Parts that cannot be refreshed cheaply expire whole when their
+        volatile fields do.
+        """
+        if self.volatile_ttl is None or not any(
+            name in parts for name in self.volatile_fields
+        ):
+            return self.cache_ttl, None
+        if self.can_refresh(parts):
+            return self.cache_ttl, self.volatile_ttl
+        return min(self.cache_ttl, self.volatile_ttl), None
+
+
+def _load(dotted_path: str):
+    module_name, function_name = dotted_path.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def strip_tracking(url: str) -> str:
+    """Drop the fragment, trailing slash and share-tracking query parameters."""
+    parts = urlsplit(url)
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in _TRACKING_PARAMS and not key.startswith("utm_")
+    ]
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/"),
+            urlencode(query),
+            "",
+        )
+    )
+
+
+def _canonical_soundcloud(url: str) -> str:
+    if url.startswith("https://m.soundcloud.com"):
+        url = url.replace("m.", "")
+    elif url.startswith("https://www.soundcloud.com"):
+        url = url.replace("www.", "")
+    return url
+
+
+def _canonical_youtube(url: str) -> str:
+    if url.startswith("https://m.youtube.com"):
+        url = url.replace("m.", "www.", 1)
+    return url
+
+
+# The forms of link naming a single video, each followed by its 11 character id
+_YOUTUBE_VIDEO = re.compile(
+    r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)"
+    r"([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])"
+)
+
+
+def _youtube_key(url: str) -> Optional[str]:
+    video = _YOUTUBE_VIDEO.search(url)
+    if video:
+        return f"video:{video.group(1)}"
+    playlist = re.search(r"list=([^&#]+)", url)
+    if playlist:
+        return f"playlist:{playlist.group(1)}"
+    return None
+
+
+def _spotify_key(url: str) -> Optional[str]:
+    match = re.search(r"/(track|album|playlist)/([A-Za-z0-9]+)", url)
+    return f"{match.group(1)}:{match.group(2)}" if match else None
+
+
+# The order matters: links are categorized by the first matching platform
+PLATFORMS: List[Platform] = [
+    Platform(
+        name=link_types.soundcloud,
+        pattern=r"https?://(?:www\.|on\.|m\.)?soundcloud\.com/[^\s]+",
+        resolver="soundcloud_utils.getSoundcloudParts",
+        async_resolver="soundcloud_utils.getSoundcloudPartsAsync",
+        canonicalize=_canonical_soundcloud,
+        cache_ttl=24 * 60 * 60,
+        volatile_fields=("Likes", "Plays"),
+        volatile_ttl=15 * 60,
+        refresher="soundcloud_utils.refreshVolatileParts",
+        max_stale=6 * 60 * 60,
+        authors={
+            "soundcloud": {
+                "name": "SoundCloud",
+                "url": "https://soundcloud.com/",
+                "icon_url": "https://soundcloud.com/pwa-round-icon-192x192.png",
+            },
+        },
+    ),
+    Platform(
+        name=link_types.youtube,
+        pattern=r"https?://(?:www\.|music\.|m\.)?(?:youtube\.com|youtu\.be)/[^\s]+",
+        resolver="youtube_utils.getYouTubeParts",
+        canonicalize=_canonical_youtube,
+        cache_key=_youtube_key,
+        cache_ttl=6 * 60 * 60,
+        max_stale=24 * 60 * 60,
+        authors={
+            "youtube": {
+                "name": "YouTube",
+                "url": "https://www.youtube.com/",
+                "icon_url": "https://www.youtube.com/s/desktop/0c61234c/img/favicon_144x144.png",
+            },
+            "youtubemusic": {
+                "name": "YouTube Music",
+                "url": "https://music.youtube.com/",
+                "icon_url": "https://www.gstatic.com/youtube/media/ytm/images/applauncher/music_icon_144x144.png",
+            },
+        },
+    ),
+    Platform(
+        name=link_types.spotify,
+        pattern=r"https?://(?:open\.)?spotify\.com/[^\s]+",
+        resolver="spotify_utils.getSpotifyParts",
+        async_resolver="spotify_utils.getSpotifyPartsAsync",
+        cache_key=_spotify_key,
+        cache_ttl=12 * 60 * 60,
+        max_stale=24 * 60 * 60,
+        authors={
+            "spotify": {
+                "name": "Spotify",
+                "url": "https://open.spotify.com/",
+                "icon_url": "https://open.spotifycdn.com/cdn/images/icons/Spotify_256.17e41e58.png",
+            },
+        },
+    ),
+    Platform(
+        name=link_types.bandcamp,
+        pattern=r"https?://[A-Za-z0-9_-]+\.bandcamp\.com/[^\s]+",
+        resolver="bandcamp_utils.getBandcampParts",
+        async_resolver="bandcamp_utils.getBandcampPartsAsync",
+        skip_pattern=r"https?://bandcamp.com.+",
+        cache_ttl=24 * 60 * 60,
+        volatile_fields=("Price", "Releases on", "Released on"),
+        volatile_ttl=30 * 60,
+        refresher="bandcamp_utils.refreshVolatileParts",
+        max_stale=24 * 60 * 60,
+        authors={
+            "bandcamp": {
+                "name": "Bandcamp",
+                "url": "https://bandcamp.com/",
+                "icon_url": "https://s4.bcbits.com/img/favicon/favicon-32x32.png",
+            },
+        },
+    ),
+]
+
+_platforms_by_name = {platform.name: platform for platform in PLATFORMS}
+_authors_by_embed_type = {
+    embed_type: author
+    for platform in PLATFORMS
+    for embed_type, author in platform.authors.items()
+}
+
+# Resolved embed parts, keyed by `Platform.cache_key`
+parts_cache = EmbedCache()
+
+
+def load_resolvers():
+    """Import every platform module up front so missing secrets fail at start-up."""
+    for platform in PLATFORMS:
+        platform.load_resolver()
+
+
+def match_platform(url: str) -> Optional[Platform]:
+    return next((platform for platform in PLATFORMS if platform.matches(url)), None)
+
+
+def get_platform(name: str) -> Platform:
+    return _platforms_by_name[name]
+
+
+def get_author_block(embed_type: Optional[str]) -> dict:
+    """Author block for an embed type, falling back to Bandcamp's."""
+    return _authors_by_embed_type.get(
+        embed_type or "", _authors_by_embed_type[link_types.bandcamp]
+    )
+
+
+def purge_link(url: str) -> bool:
+    """Forget the cached parts and any remembered failure of a link."""
+    platform = match_platform(url)
+    if platform is None:
+        return False
+    key = platform.cache_key(platform.canonicalize(url))
+    purged_parts = parts_cache.purge(key)
+    purged_failure = failed_links.purge(key)
+    return purged_parts or purged_failure
+
+
+def resolve_link(link: CategorizedLink) -> Optional[dict]:
+    """Embed parts for a categorized link, served from the cache when fresh."""
+    url, link_type = link
+    platform = get_platform(link_type)
+    if not platform.can_resolve(url):
+        return None
+
+    key = platform.cache_key(url)
+    cached = parts_cache.lookup(key)
+    if cached is not None and cached.fresh:
+        return cached.parts
+    if cached is not None and not cached.stale:
+        refreshed = _store_refresh(platform, key, platform.refresh(cached.parts))
+        if refreshed is not None:
+            return refreshed
+    remembered = replay_failure(key)
+    if remembered is not None:
+        return remembered
+
+    try:
+        parts = platform.resolve(url)
+    except Exception as e:
+        _store_failure(key, e)
+        raise
+    _store(platform, key, parts)
+    return parts
+
+
+async def resolve_link_async(link: CategorizedLink) -> Optional[dict]:
+    """
+    resolve_link for the event loop, blocking resolvers run in a thread.
+    Stale parts within the platform's maximum staleness are returned right
+    away and revalidated in the background.
+    """
+    url, link_type = link
+    platform = get_platform(link_type)
+    if not platform.can_resolve(url):
+        return None
+
+    key = platform.cache_key(url)
+    cached = parts_cache.lookup(key)
+    if cached is not None and cached.fresh:
+        return cached.parts
+    if cached is not None and cached.servable:
+        with deadlines.unbounded():
+            _revalidate(platform, key, url, cached)
+        return cached.parts
+    remembered = replay_failure(key)
+    if remembered is not None:
+        return remembered
+    parts, dropped = await asyncio.shield(_revalidate(platform, key, url, cached))
+    # the lookup ran in its own task, its dropped enrichments are ours too
+    deadlines.report(dropped)
+    # a copy each, the lookup may be shared with other messages
+    return dict(parts) if parts is not None else None
+
+
+def cached_link(link: CategorizedLink) -> Optional[dict]:
+    """Cached parts of a link, stale ones included, without any lookup."""
+    url, link_type = link
+    platform = get_platform(link_type)
+    if not platform.can_resolve(url):
+        return None
+    cached = parts_cache.lookup(platform.cache_key(url))
+    if cached is None or not cached.servable:
+        return None
+    return cached.parts
+
+
+async def resolve_links(links: List[CategorizedLink]) -> List[Optional[dict]]:
+    """Resolve all links of a message concurrently, keeping their order."""
+    return list(await asyncio.gather(*(resolve_link_async(link) for link in links)))
+
+
+# Result of a lookup: its parts and the enrichments it had to drop
+_Fetched = Tuple[Optional[dict], List[str]]
+
+# Lookups in flight by cache key, shared by everyone waiting on that key
+_revalidating: Dict[str, "asyncio.Task[_Fetched]"] = {}
+
+
+def _revalidate(
+    platform: Platform, key: str, url: str, cached: Optional[CachedParts]
+) -> "asyncio.Task[_Fetched]":
+    task = _revalidating.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(platform, key, url, cached))
+        _revalidating[key] = task
+        task.add_done_callback(lambda done: _revalidated(key, done))
+    return task
+
+
+def _revalidated(key: str, task: "asyncio.Task[_Fetched]"):
+    _revalidating.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        # callers awaiting the task get the error, background ones only this
+        logger.warning("Could not revalidate %s: %s", key, task.exception())
+
+
+async def _fetch(
+    platform: Platform, key: str, url: str, cached: Optional[CachedParts]
+) -> _Fetched:
+    # runs in its own task, enrichments dropped by other links do not count
+    deadlines.scope_to_task()
+    if cached is not None and not cached.stale:
+        refreshed = _store_refresh(
+            platform, key, await platform.refresh_async(cached.parts)
+        )
+        if refreshed is not None:
+            return refreshed, []
+
+    try:
+        parts = await platform.resolve_async(url)
+    except Exception as e:
+        _store_failure(key, e)
+        raise
+    dropped = deadlines.dropped()
+    _store(platform, key, parts, partial=bool(dropped))
+    return parts, dropped
+
+
+def _store(
+    platform: Platform, key: str, parts: Optional[dict], partial: bool = False
+):
+    # only complete embeds are cached, lookups that found nothing return a
+    # bare dict and are remembered for a short while instead
+    no_data = bool(parts and parts.pop(NO_DATA, False))
+    if partial:
+        # enrichments were dropped to meet a deadline, the next lookup
+        # should get the whole embed
+        logger.debug("Not caching partial parts for %s", key)
+    elif parts and parts.get("title"):
+        if platform.cache_ttl > 0:
+            parts_cache.set(
+                key, parts, *platform.entry_ttls(parts), max_stale=platform.max_stale
+            )
+    elif no_data:
+        remember_incomplete(key, parts)
+    elif parts:
+        # the resolver gave up on an error, which may clear up by itself
+        logger.debug("Not remembering incomplete parts for %s", key)
+
+
+def _store_failure(key: str, error: Exception):
+    if classify_failure(error):
+        # the link is gone, stale parts must not be served for it anymore
+        parts_cache.purge(key)
+    remember_failure(key, error)
+
+
+def _store_refresh(
+    platform: Platform, key: str, volatile_parts: Optional[dict]
+) -> Optional[dict]:
+    if volatile_parts is None:
+        return None
+    return parts_cache.refresh(
+        key, volatile_parts, platform.volatile_fields, platform.volatile_ttl
+    )
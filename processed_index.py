@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Exact ids of the most recent messages
+RING_SIZE = 10_000
+# Bits per Bloom filter generation (1 MiB), with 7 hashes this keeps false
+# positives around one in ten million at 100k messages a generation
+FILTER_BITS = 1 << 23
+FILTER_HASHES = 7
+# Seconds a generation collects ids, an id is remembered for one to two
+# generations
+GENERATION_SECONDS = 12 * 60 * 60
+# Seconds between saves of the filter
+SAVE_INTERVAL_SECONDS = 60
+
+_HEADER = struct.Struct("<dII")
+
+
+class ProcessedIndex:
+    """
+    Remembers which message ids were already handled, so a message seen
+    again after a gateway reconnect or a restart is not embedded twice.
+    Recent ids are kept exactly in a ring, and all ids of the last one to
+    two generations in a pair of Bloom filters that is saved to `path`.
+    Checks are O(1) and memory is fixed; a false positive, which skips a
+    new message, is vanishingly rare at the configured size. It is safe to
+    use from several threads, so checks and saves can run off the event
+    loop.
+
+    Args:
+        path: File the filters are saved to, None to keep them in memory
+        ring_size: How many recent ids are kept exactly
+        bits: Bits per filter generation
+        hashes: Bits set per id
+        generation_seconds: Seconds after which the filters rotate
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ring_size: int = RING_SIZE,
+        bits: int = FILTER_BITS,
+        hashes: int = FILTER_HASHES,
+        generation_seconds: float = GENERATION_SECONDS,
+    ):
+        self.path = path
+        self.bits = bits
+        self.hashes = hashes
+        self.generation_seconds = generation_seconds
+        self._ring: Deque[int] = deque()
+        self._ring_ids: Set[int] = set()
+        self._ring_size = ring_size
+        self._current = bytearray(bits // 8)
+        self._previous = bytearray(bits // 8)
+        self._generation_started = time.time()
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def seen(self, message_id: int) -> bool:
+        with self._lock:
+            return self._seen(message_id)
+
+    def add(self, message_id: int):
+        with self._lock:
+            self._add(message_id)
+        self._save_if_due()
+
+    def check_and_add(self, message_id: int) -> bool:
+        """Record a message id, True if it was already there."""
+        with self._lock:
+            if self._seen(message_id):
+                return True
+            self._add(message_id)
+        self._save_if_due()
+        return False
+
+    def save(self):
+        with self._lock:
+            self._saved_at = time.monotonic()
+            if self.path is None or not self._dirty:
+                return
+            # a copy to write, ids keep being added while the file is written
+            header = _HEADER.pack(self._generation_started, self.bits, self.hashes)
+            current, previous = bytes(self._current), bytes(self._previous)
+            self._dirty = False
+        # written aside and renamed, a crash never leaves half a file
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "wb") as file:
+                file.write(header)
+                file.write(current)
+                file.write(previous)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            self._dirty = True
+            logger.warning("Could not save the processed message index: %s", e)
+
+    def _seen(self, message_id: int) -> bool:
+        self._rotate()
+        if message_id in self._ring_ids:
+            return True
+        positions = self._positions(message_id)
+        return self._contains(self._current, positions) or self._contains(
+            self._previous, positions
+        )
+
+    def _add(self, message_id: int):
+        self._rotate()
+        if message_id not in self._ring_ids:
+            self._ring.append(message_id)
+            self._ring_ids.add(message_id)
+            if len(self._ring) > self._ring_size:
+                self._ring_ids.discard(self._ring.popleft())
+        for position in self._positions(message_id):
+            self._current[position >> 3] |= 1 << (position & 7)
+        self._dirty = True
+
+    def _save_if_due(self):
+        if time.monotonic() - self._saved_at >= SAVE_INTERVAL_SECONDS:
+            self.save()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as file:
+                started, bits, hashes = _HEADER.unpack(file.read(_HEADER.size))
+                if (bits, hashes) != (self.bits, self.hashes):
+                    logger.warning("Processed message index has another size")
+                    return
+                current = file.read(bits // 8)
+                previous = file.read(bits // 8)
+        except (OSError, struct.error) as e:
+            logger.warning("Could not load the processed message index: %s", e)
+            return
+        if len(current) == len(previous) == bits // 8:
+            self._generation_started = started
+            self._current = bytearray(current)
+            self._previous = bytearray(previous)
+
+    def _rotate(self):
+        elapsed = time.time() - self._generation_started
+        if elapsed < self.generation_seconds:
+            return
+        if elapsed < 2 * self.generation_seconds:
+            self._previous = self._current
+        else:
+            # idle for more than a generation, everything has expired
+            self._previous = bytearray(self.bits // 8)
+        self._current = bytearray(self.bits // 8)
+        self._generation_started = time.time()
+        self._dirty = True
+
+    def _positions(self, message_id: int):
+        # double hashing, k positions from two 64 bit hashes
+        digest = hashlib.blake2b(message_id.to_bytes(8, "little"), digest_size=16)
+        first, second = struct.unpack("<QQ", digest.digest())
+        # odd, so the k positions differ for a power of two number of bits
+        second |= 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _contains(bits: bytearray, positions) -> bool:
+        return all(
+            bits[position >> 3] & (1 << (position & 7)) for position in positions
+        )
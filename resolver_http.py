@@ -0,0 +1,161 @@
+"""
+The link resolvers as a standalone HTTP service, for tools that want embed
+parts without running the bot. Lookups share the bot's canonicalization,
+cache and coalescing of concurrent lookups.
+
+    python resolver_http.py --host 127.0.0.1 --port 8080
+
+    GET  /resolve?url=<url>[&budget=<seconds>]
+        The parts of one link as {"url", "parts"}, or {"url", "error"}
+        with a 4xx/5xx status.
+    POST /resolve[?budget=<seconds>]  {"urls": [...]}
+        One JSON line per link (application/x-ndjson), in the order the
+        lookups complete.
+    GET  /metrics
+"""
+import argparse
+import asyncio
+import json
+import logging
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+import async_http
+import deadlines
+import metrics
+from bulkheads import BulkheadFull
+from circuit_breaker import CircuitOpen
+from general_utils import find_and_categorize_links
+from negative_cache import NO_DATA, LinkUnavailable
+from platform_registry import load_resolvers, resolve_link_async
+
+logger = logging.getLogger(__name__)
+
+# Most links accepted in one batch
+MAX_BATCH = 500
+# Lookups of one batch running at once, the hosts' own limits still apply
+BATCH_CONCURRENCY = 16
+
+_STATUS_BY_REASON = {"not_found": 404, "no_data": 404, "private": 403}
+# Keys of the parts meant for the resolvers themselves, not for clients
+_INTERNAL_KEYS = ("refreshSource", NO_DATA)
+
+
+async def resolve_url(url: str, budget: Optional[float] = None) -> Tuple[int, dict]:
+    """An HTTP status and JSON body for the lookup of one URL."""
+    metrics.increment("http_lookups_total")
+    links = find_and_categorize_links(url, True)
+    if len(links) != 1:
+        return 422, {"url": url, "error": {"message": "Not a supported link"}}
+    try:
+        if budget is None:
+            parts = await resolve_link_async(links[0])
+        else:
+            with deadlines.budget(budget):
+                parts = await resolve_link_async(links[0])
+    except LinkUnavailable as e:
+        return _STATUS_BY_REASON.get(e.reason, 404), _error(url, e, e.reason)
+    except (CircuitOpen, BulkheadFull) as e:
+        return 503, _error(url, e)
+    except Exception as e:
+        logger.warning("Could not resolve %s: %s", url, e)
+        return 502, _error(url, e)
+    if not parts:
+        return 422, {"url": url, "error": {"message": "This link cannot be embedded"}}
+    public = {key: value for key, value in parts.items() if key not in _INTERNAL_KEYS}
+    return 200, {"url": url, "parts": public}
+
+
+def _error(url: str, error: Exception, reason: Optional[str] = None) -> dict:
+    body = {"message": str(error)}
+    if reason:
+        body["reason"] = reason
+    return {"url": url, "error": body}
+
+
+def _budget(request: web.Request) -> Optional[float]:
+    budget = request.query.get("budget")
+    if budget is None:
+        return None
+    try:
+        return float(budget)
+    except ValueError:
+        raise web.HTTPBadRequest(text="budget must be a number of seconds") from None
+
+
+async def resolve_one(request: web.Request) -> web.Response:
+    url = request.query.get("url")
+    if not url:
+        raise web.HTTPBadRequest(text="url is required")
+    status, body = await resolve_url(url, _budget(request))
+    return web.json_response(body, status=status)
+
+
+async def resolve_batch(request: web.Request) -> web.StreamResponse:
+    budget = _budget(request)
+    try:
+        urls = (await request.json())["urls"]
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(
+            text='Expected a JSON body like {"urls": [...]}'
+        ) from None
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        raise web.HTTPBadRequest(text="urls must be a list of strings")
+    if len(urls) > MAX_BATCH:
+        raise web.HTTPRequestEntityTooLarge(
+            max_size=MAX_BATCH, actual_size=len(urls)
+        )
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def lookup(url: str) -> dict:
+        async with limit:
+            status, body = await resolve_url(url, budget)
+        return dict(body, status=status)
+
+    lookups = [asyncio.ensure_future(lookup(url)) for url in urls]
+    try:
+        for done in asyncio.as_completed(lookups):
+            line = json.dumps(await done) + "\n"
+            await response.write(line.encode())
+    finally:
+        # only still running if the client went away
+        for task in lookups:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+
+async def close_client(_app: web.Application):
+    await async_http.close()
+
+
+async def show_metrics(_request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render() + "\n")
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/resolve", resolve_one)
+    app.router.add_post("/resolve", resolve_batch)
+    app.router.add_get("/metrics", show_metrics)
+    app.on_cleanup.append(close_client)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)-8s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    load_resolvers()
+    web.run_app(create_app(), host=arguments.host, port=arguments.port)
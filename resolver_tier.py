@@ -0,0 +1,248 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+from typing import Dict, List, Optional, Set
+
+import async_http
+import deadlines
+import metrics
+from negative_cache import LinkUnavailable
+from object_types import CategorizedLink
+from platform_registry import (
+    cached_link,
+    load_resolvers,
+    purge_link,
+    resolve_link_async,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/coolvivy-resolver.sock"
+# Lines may carry whole embeds, well past asyncio's 64 KiB default
+STREAM_LIMIT = 1 << 22
+
+
+class ResolverError(Exception):
+    """A lookup failed in the resolver tier for a reason other than the link."""
+
+
+class ResolverServer:
+    """
+    The shared resolver tier of a sharded deployment. Every gateway process
+    sends its lookups here over a Unix socket, so all shards share one cache,
+    one set of coalesced lookups and one set of per-host limits.
+
+    Requests and responses are JSON lines, matched by `id`. Requests:
+        {"id": 1, "op": "resolve", "link": [url, type], "budget": seconds}
+        {"id": 2, "op": "cached", "link": [url, type]}
+        {"id": 3, "op": "purge", "url": url}
+        {"id": 4, "op": "metrics"}
+    Responses carry `result`, plus `dropped` enrichments for resolve, or an
+    `error` with the `reason` of a LinkUnavailable if it was one.
+
+    Args:
+        path: Path of the Unix socket to listen on
+    """
+
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH):
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        # open shard connections, closed along with the server
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set["asyncio.Task[None]"] = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # left behind by a previous run
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(
+            self._serve, self.path, limit=STREAM_LIMIT
+        )
+
+    async def serve_forever(self):
+        await self.start()
+        logger.info("Resolving links on %s", self.path)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        # the server only stops listening, its connections are ours to close
+        for writer in self._connections:
+            writer.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers)
+        if self._server is not None:
+            await self._server.wait_closed()
+        await async_http.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        handler = asyncio.current_task()
+        self._connections.add(writer)
+        self._handlers.add(handler)
+        try:
+            while line := await reader.readline():
+                # answered as they finish, a slow lookup holds up no other
+                task = asyncio.ensure_future(
+                    self._answer(json.loads(line), writer, write_lock)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.CancelledError):
+            # the shard went away or the event loop is shutting down, either
+            # way there is nobody left to answer
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            self._connections.discard(writer)
+            self._handlers.discard(handler)
+
+    async def _answer(
+        self, request: dict, writer: asyncio.StreamWriter, write_lock: asyncio.Lock
+    ):
+        response = {"id": request.get("id")}
+        try:
+            response.update(await self._handle(request))
+        except LinkUnavailable as e:
+            response["error"] = {"message": str(e), "reason": e.reason}
+        except Exception as e:
+            response["error"] = {"message": str(e)}
+        async with write_lock:
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+
+    async def _handle(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "resolve":
+            link: CategorizedLink = tuple(request["link"])
+            budget = request.get("budget")
+            if budget is None:
+                return {"result": await resolve_link_async(link), "dropped": []}
+            with deadlines.budget(budget) as deadline:
+                result = await resolve_link_async(link)
+            return {"result": result, "dropped": deadline.dropped}
+        if op == "cached":
+            return {"result": cached_link(tuple(request["link"]))}
+        if op == "purge":
+            return {"result": purge_link(request["url"])}
+        if op == "metrics":
+            # lookups, caches and limits live here, not in the shards
+            return {"result": metrics.render()}
+        raise ValueError(f"Unknown op {op}")
+
+
+class ResolverClient:
+    """
+    Sends lookups to a ResolverServer over one multiplexed connection,
+    opened on first use and again after it breaks. The caller's deadline
+    travels with each lookup and dropped enrichments come back with it.
+
+    Args:
+        path: Path of the server's Unix socket
+    """
+
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH):
+        self.path = path
+        self._ids = itertools.count(1)
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional["asyncio.Task[None]"] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+    async def resolve_links(self, links: List[CategorizedLink]) -> List[Optional[dict]]:
+        return list(await asyncio.gather(*(self.resolve_link(link) for link in links)))
+
+    async def resolve_link(self, link: CategorizedLink) -> Optional[dict]:
+        response = await self._request(
+            {"op": "resolve", "link": list(link), "budget": deadlines.remaining()}
+        )
+        deadlines.report(response.get("dropped", []))
+        return response["result"]
+
+    async def cached_link(self, link: CategorizedLink) -> Optional[dict]:
+        return (await self._request({"op": "cached", "link": list(link)}))["result"]
+
+    async def purge_link(self, url: str) -> bool:
+        return (await self._request({"op": "purge", "url": url}))["result"]
+
+    async def metrics(self) -> str:
+        """The resolver tier's metrics, rendered like metrics.render()."""
+        return (await self._request({"op": "metrics"}))["result"]
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reader_task
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            with contextlib.suppress(ConnectionError):
+                await self._writer.wait_closed()
+        self._writer = None
+
+    async def _request(self, request: dict) -> dict:
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        try:
+            writer.write(json.dumps(dict(request, id=request_id)).encode() + b"\n")
+            await writer.drain()
+            response = await future
+        finally:
+            self._waiting.pop(request_id, None)
+        error = response.get("error")
+        if error is None:
+            return response
+        if error.get("reason"):
+            raise LinkUnavailable(error["reason"], error["message"])
+        raise ResolverError(error["message"])
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_unix_connection(
+                    self.path, limit=STREAM_LIMIT
+                )
+                self._reader_task = asyncio.ensure_future(self._read(reader))
+            return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._waiting.get(response.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            # the connection broke, fail everything still waiting on it
+            if self._writer is not None:
+                self._writer.close()
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(
+                        ResolverError("Lost the connection to the resolver tier")
+                    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)-8s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    load_resolvers()
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET_PATH
+    asyncio.run(ResolverServer(path).serve_forever())
@@ -0,0 +1,283 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Job classes, in the order they are served
+INTERACTIVE = "interactive"
+PASSIVE = "passive"
+
+# Passive jobs of one guild allowed to run at once, unless configured
+DEFAULT_GUILD_CONCURRENCY = 3
+
+
+class SchedulerOverloaded(Exception):
+    """A passive job was shed because too many are already waiting."""
+
+    def __init__(self, job_class: str):
+        super().__init__(f"Too many {job_class} jobs waiting, try again later")
+        self.job_class = job_class
+
+
+class GuildQueue:
+    """
+    The passive jobs of one guild.
+
+    Args:
+        guild: The guild id, None for jobs outside any guild
+        weight: Share of the passive capacity relative to other guilds
+        max_concurrency: Jobs of this guild allowed to run at once
+    """
+
+    def __init__(
+        self,
+        guild: Optional[str],
+        weight: float = 1,
+        max_concurrency: int = DEFAULT_GUILD_CONCURRENCY,
+    ):
+        self.guild = guild
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        # (virtual finish time, future granting the slot)
+        self.waiting: Deque[Tuple[float, asyncio.Future]] = deque()
+        self.running = 0
+        self.last_finish = 0.0
+
+    @property
+    def has_room(self) -> bool:
+        return self.running < self.max_concurrency
+
+
+class PriorityScheduler:
+    """
+    Admits embed jobs to the resolvers, at most `concurrency` at a time.
+    Waiting interactive jobs (context menus, which Discord expects an answer
+    to within seconds) always start before passive auto-embeds, and passive
+    jobs never take the last `interactive_reserve` slots so an interaction
+    can start even in the middle of a flood of messages.
+
+    Passive jobs wait in one queue per guild and are served by weighted fair
+    queuing: each job is stamped with a virtual finish time advancing by
+    1/weight per job of its guild, and the earliest stamp among guilds below
+    their concurrency cap goes next. A guild pasting a hundred links then
+    only delays its own embeds. Passive jobs are shed when their guild
+    already has `max_guild_queue` waiting, when `max_passive_queue` are
+    waiting overall, or when they waited longer than `max_passive_wait`.
+
+    Args:
+        concurrency: Jobs allowed to run at once
+        interactive_reserve: Slots only interactive jobs may use
+        max_passive_queue: Waiting passive jobs beyond which new ones are shed
+        max_guild_queue: The same for the waiting passive jobs of one guild
+        max_passive_wait: Seconds after which a waiting passive job is shed
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        interactive_reserve: int = 2,
+        max_passive_queue: int = 50,
+        max_guild_queue: int = 20,
+        max_passive_wait: float = 30.0,
+    ):
+        self.concurrency = concurrency
+        self.interactive_reserve = interactive_reserve
+        self.max_passive_queue = max_passive_queue
+        self.max_guild_queue = max_guild_queue
+        self.max_passive_wait = max_passive_wait
+        self._running = 0
+        self._interactive: Deque[asyncio.Future] = deque()
+        self._guilds: Dict[Optional[str], GuildQueue] = {}
+        self._depth: Dict[str, int] = {INTERACTIVE: 0, PASSIVE: 0}
+        # virtual finish time of the last passive job started
+        self._virtual_time = 0.0
+
+    def configure_guild(
+        self,
+        guild: str,
+        weight: float = 1,
+        max_concurrency: int = DEFAULT_GUILD_CONCURRENCY,
+    ):
+        queue = self._guild(guild)
+        queue.weight = weight
+        queue.max_concurrency = max_concurrency
+
+    def depth(self, job_class: str, guild: Optional[str] = None) -> int:
+        if job_class == PASSIVE and guild is not None:
+            return len(self._guild(guild).waiting)
+        return self._depth[job_class]
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self, job_class: str, guild: Optional[str] = None
+    ) -> AsyncIterator[None]:
+        """Wait for the job's turn and hold a slot for the block."""
+        queue = self._guild(guild) if job_class == PASSIVE else None
+        await self._acquire(job_class, queue)
+        try:
+            yield
+        finally:
+            self._release(queue)
+
+    async def _acquire(self, job_class: str, queue: Optional[GuildQueue]):
+        queued_at = time.monotonic()
+        if queue is None:
+            if not self._interactive and self._has_room(job_class):
+                self._start(queue)
+                self._observe_wait(job_class, queued_at)
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._interactive.append(future)
+        else:
+            if (
+                self._depth[PASSIVE] >= self.max_passive_queue
+                or len(queue.waiting) >= self.max_guild_queue
+            ):
+                self._shed(job_class, queue)
+            finish = self._stamp(queue)
+            if (
+                not self._interactive
+                and not queue.waiting
+                and queue.has_room
+                and self._has_room(job_class)
+            ):
+                self._virtual_time = max(self._virtual_time, finish)
+                self._start(queue)
+                self._observe_wait(job_class, queued_at)
+                return
+            future = asyncio.get_running_loop().create_future()
+            queue.waiting.append((finish, future))
+            self._publish_guild(queue)
+        self._set_depth(job_class, 1)
+
+        timeout = self.max_passive_wait if queue is not None else None
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # unless the slot was handed over just as time ran out
+            if self._abandon(job_class, queue, future):
+                self._shed(job_class, queue)
+        except asyncio.CancelledError:
+            if not self._abandon(job_class, queue, future):
+                # the slot was handed over as we were cancelled
+                self._release(queue)
+            raise
+        self._observe_wait(job_class, queued_at)
+
+    def _release(self, queue: Optional[GuildQueue]):
+        self._running -= 1
+        if queue is not None:
+            queue.running -= 1
+            self._publish_guild(queue)
+        self._admit()
+
+    def _admit(self):
+        """Hand free slots to waiting jobs, interactive ones first."""
+        while self._interactive and self._has_room(INTERACTIVE):
+            future = self._interactive.popleft()
+            self._set_depth(INTERACTIVE, -1)
+            self._start(None)
+            future.set_result(None)
+        if self._interactive:
+            return
+        while self._has_room(PASSIVE):
+            queue = self._next_guild()
+            if queue is None:
+                return
+            finish, future = queue.waiting.popleft()
+            self._virtual_time = max(self._virtual_time, finish)
+            self._set_depth(PASSIVE, -1)
+            self._start(queue)
+            future.set_result(None)
+
+    def _next_guild(self) -> Optional[GuildQueue]:
+        """The guild whose next job has the earliest virtual finish time."""
+        ready = [queue for queue in self._guilds.values()
+                 if queue.waiting and queue.has_room]
+        return min(ready, key=lambda queue: queue.waiting[0][0], default=None)
+
+    def _stamp(self, queue: GuildQueue) -> float:
+        # an idle guild starts from the current virtual time, so it gets no
+        # credit for the time it spent idle
+        queue.last_finish = (
+            max(self._virtual_time, queue.last_finish) + 1 / queue.weight
+        )
+        return queue.last_finish
+
+    def _start(self, queue: Optional[GuildQueue]):
+        self._running += 1
+        if queue is not None:
+            queue.running += 1
+            self._publish_guild(queue)
+
+    def _abandon(
+        self, job_class: str, queue: Optional[GuildQueue], future: asyncio.Future
+    ) -> bool:
+        """Take a job that gave up out of the queue, False if it already left."""
+        if queue is None:
+            if future not in self._interactive:
+                return False
+            self._interactive.remove(future)
+        else:
+            entry = next((entry for entry in queue.waiting if entry[1] is future), None)
+            if entry is None:
+                return False
+            queue.waiting.remove(entry)
+            self._publish_guild(queue)
+        self._set_depth(job_class, -1)
+        future.cancel()
+        return True
+
+    def _guild(self, guild: Optional[str]) -> GuildQueue:
+        queue = self._guilds.get(guild)
+        if queue is None:
+            queue = self._guilds[guild] = GuildQueue(guild)
+        return queue
+
+    def _has_room(self, job_class: str) -> bool:
+        limit = self.concurrency
+        if job_class == PASSIVE:
+            limit -= self.interactive_reserve
+        return self._running < limit
+
+    def _set_depth(self, job_class: str, change: int):
+        self._depth[job_class] += change
+        metrics.set_gauge(
+            "scheduler_queue_depth", self._depth[job_class], job_class=job_class
+        )
+
+    def _publish_guild(self, queue: GuildQueue):
+        guild = queue.guild or "none"
+        metrics.set_gauge(
+            "scheduler_guild_queue_depth", len(queue.waiting), guild=guild
+        )
+        metrics.set_gauge("scheduler_guild_running", queue.running, guild=guild)
+
+    def _observe_wait(self, job_class: str, queued_at: float):
+        metrics.observe(
+            "scheduler_wait_seconds",
+            time.monotonic() - queued_at,
+            job_class=job_class,
+        )
+
+    def _shed(self, job_class: str, queue: Optional[GuildQueue]):
+        guild = queue.guild if queue else None
+        metrics.increment("scheduler_shed_total", job_class=job_class)
+        logger.warning(
+            "Shedding a %s job of guild %s, the queue is too deep", job_class, guild
+        )
+        raise SchedulerOverloaded(job_class)
+
+
+# Shared by every embed the bot posts
+scheduler = PriorityScheduler()
@@ -1,3 +1,4 @@
+import asyncio
 import re
 from typing import Any, Union
 from urllib.error import HTTPError
@@ -7,22 +8,206 @@ import yt_dlp
 from sclib import Playlist, Track
 from sclib import SoundcloudAPI as _SoundcloudAPI
 
+import async_http
+import deadlines
+from batching import WindowBatcher
+from bulkheads import bulkheads
+from circuit_breaker import CircuitOpen, circuit_breakers, is_server_error
+from embed_cache import EmbedCache
 from general_utils import (
     formatMillisecondsToDurationString,
     formatTimeToDisplay,
     remove_trailing_slash,
 )
+from negative_cache import LinkUnavailable
+
+RESOLVE_URL = 'https://api-v2.soundcloud.com/resolve'
+TRACKS_URL = 'https://api-v2.soundcloud.com/tracks'
+# the multi-id tracks endpoint accepts at most this many ids per request
+TRACKS_PER_REQUEST = 50
+# playlist tracks hydrated at a time, about what fits in the Tracks field
+HYDRATE_PAGE_SIZE = 20
+# track URLs (as posted) and the track id they resolved to
+resolved_track_ids = EmbedCache(max_entries=8192)
+RESOLVED_ID_TTL = 7 * 24 * 60 * 60
+# a yt-dlp lookup takes a few seconds, not worth starting with less left
+YTDLP_FALLBACK_SECONDS = 3.0
+soundcloud_breaker = circuit_breakers['soundcloud_api']
 
 
 class SoundcloudAPI(_SoundcloudAPI):
+    # scraped once and shared by every instance until it stops working
+    shared_client_id = None
+
+    def __init__(self, client_id=None):
+        super().__init__(client_id or SoundcloudAPI.shared_client_id)
+
     def get_credentials(self):
-        resp = requests.get('https://soundcloud.com')
+        resp = soundcloud_breaker.call(
+            requests.get,
+            'https://soundcloud.com',
+            timeout=deadlines.request_timeout(async_http.REQUEST_TIMEOUT_SECONDS),
+            is_failure=is_server_error)
+        self._read_client_id(resp.text)
+        return None
+
+    async def get_credentials_async(self):
+        resp = await soundcloud_breaker.call_async(async_http.get,
+                                                   'https://soundcloud.com',
+                                                   is_failure=is_server_error)
+        self._read_client_id(resp.text)
+
+    @staticmethod
+    def forget_rejected_client_id(error):
+        """
+        Forget the shared client id once SoundCloud rejects it, so the next
+        lookup scrapes a new one. Other errors, a deleted or private track
+        among them, say nothing about the id and keep it.
+        """
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', getattr(error, 'code', None))
+        if status == 401:
+            SoundcloudAPI.shared_client_id = None
+
+    def _read_client_id(self, page):
         pattern = re.compile(r'"apiClient"[\s\S]*?"id"\s*:\s*"([^"]+)"')
-        match = pattern.search(resp.text)
+        match = pattern.search(page)
         if match:
             self.client_id = match.group(1)
+            SoundcloudAPI.shared_client_id = self.client_id
+
+    def resolve(self, url):
+        if not self.client_id:
+            self.get_credentials()
+        response = soundcloud_breaker.call(
+            requests.get,
+            RESOLVE_URL,
+            params={
+                'url': url,
+                'client_id': self.client_id
+            },
+            timeout=deadlines.request_timeout(async_http.REQUEST_TIMEOUT_SECONDS),
+            is_failure=is_server_error)
+        response.raise_for_status()
+        return self._wrap(response.json())
+
+    async def resolve_async(self, url):
+        """resolve on the shared async client."""
+        if not self.client_id:
+            await self.get_credentials_async()
+        response = await soundcloud_breaker.call_async(
+            async_http.get,
+            RESOLVE_URL,
+            params={
+                'url': url,
+                'client_id': self.client_id
+            },
+            is_failure=is_server_error)
+        response.raise_for_status()
+        return self._wrap(response.json())
+
+    def _wrap(self, obj):
+        if obj['kind'] == 'track':
+            return Track(obj=obj, client=self)
+        if obj['kind'] in ('playlist', 'system-playlist'):
+            playlist = Playlist(obj=obj, client=self)
+            playlist.tracks = LazyPlaylistTracks(self, playlist.tracks)
+            # keep sclib from hydrating every track when iterated
+            playlist.ready = True
+            return playlist
         return None
 
+    def hydrate_tracks(self, track_ids):
+        """Fetch full track objects by id, up to 50 ids per request."""
+        if not self.client_id:
+            self.get_credentials()
+        tracks = {}
+        for start in range(0, len(track_ids), TRACKS_PER_REQUEST):
+            chunk = track_ids[start:start + TRACKS_PER_REQUEST]
+            response = soundcloud_breaker.call(
+                requests.get,
+                TRACKS_URL,
+                params=self._ids_params(chunk),
+                timeout=deadlines.request_timeout(
+                    async_http.REQUEST_TIMEOUT_SECONDS),
+                is_failure=is_server_error)
+            response.raise_for_status()
+            for obj in response.json():
+                tracks[obj['id']] = Track(obj=obj, client=self)
+        return tracks
+
+    async def hydrate_tracks_async(self, track_ids):
+        """hydrate_tracks on the shared async client."""
+        if not self.client_id:
+            await self.get_credentials_async()
+        tracks = {}
+        for start in range(0, len(track_ids), TRACKS_PER_REQUEST):
+            chunk = track_ids[start:start + TRACKS_PER_REQUEST]
+            response = await soundcloud_breaker.call_async(
+                async_http.get,
+                TRACKS_URL,
+                params=self._ids_params(chunk),
+                is_failure=is_server_error)
+            response.raise_for_status()
+            for obj in response.json():
+                tracks[obj['id']] = Track(obj=obj, client=self)
+        return tracks
+
+    def _ids_params(self, track_ids):
+        return {
+            'ids': ','.join(str(i) for i in track_ids),
+            'client_id': self.client_id
+        }
+
+
+class LazyPlaylistTracks:
+    """
+    The tracks of a resolved playlist. SoundCloud only returns the first few
+    tracks in full and the rest as id-only stubs; stubs are hydrated a page
+    at a time as they are read, so rendering a tracklist only pays for the
+    lines that fit. Tracks that can no longer be fetched are dropped.
+    """
+
+    def __init__(self, api, items, page_size=HYDRATE_PAGE_SIZE):
+        self._api = api
+        self._items = list(items)
+        self.page_size = page_size
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        self._hydrate_from(index)
+        return self._items[index]
+
+    def __iter__(self):
+        index = 0
+        while True:
+            self._hydrate_from(index)
+            if index >= len(self._items):
+                return
+            yield self._items[index]
+            index += 1
+
+    def _hydrate_from(self, index):
+        while index < len(self._items) and isinstance(self._items[index], dict):
+            end = min(index + self.page_size, len(self._items))
+            page = self._items[index:end]
+            stub_ids = [
+                item['id'] for item in page
+                if isinstance(item, dict) and 'title' not in item
+            ]
+            hydrated = self._api.hydrate_tracks(stub_ids) if stub_ids else {}
+            tracks = []
+            for item in page:
+                if not isinstance(item, dict):
+                    tracks.append(item)
+                elif 'title' in item:
+                    tracks.append(Track(obj=item, client=self._api))
+                elif item['id'] in hydrated:
+                    tracks.append(hydrated[item['id']])
+            self._items[index:end] = tracks
+
 
 class YtDlpTrack:
     def __init__(self, info):
@@ -67,7 +252,9 @@ def fetchTrackWithYtDlp(track_url):
     }
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(track_url, download=False)
+            info = circuit_breakers['yt_dlp'].call(ydl.extract_info,
+                                                   track_url,
+                                                   download=False)
             if info and isinstance(info, dict):
                 return YtDlpTrack(info)
     except Exception:
@@ -75,32 +262,163 @@ def fetchTrackWithYtDlp(track_url):
     return None
 
 
+def fetchFallbackTrack(track_url):
+    """fetchTrackWithYtDlp, unless it would not finish within the deadline."""
+    if not deadlines.allows('soundcloud fallback',
+                            YTDLP_FALLBACK_SECONDS):
+        return None
+    return fetchTrackWithYtDlp(track_url)
+
+
 def fetchTrack(track_url):
+    posted_url = track_url
     if track_url.startswith('https://on.soundcloud.com'):
-        response = requests.get(track_url, allow_redirects=True)
-        if response.status_code == 200:
-            track_url = response.history[0].headers['location']
-        else:
-            raise Exception('Unable to fetch Soundcloud Mobile URL')
+        response = soundcloud_breaker.call(
+            requests.get,
+            track_url,
+            allow_redirects=True,
+            timeout=deadlines.request_timeout(async_http.REQUEST_TIMEOUT_SECONDS),
+            is_failure=is_server_error)
+        track_url = readShortLinkTarget(response)
     try:
         api = SoundcloudAPI()
         track = api.resolve(track_url)
-        return track
+    except CircuitOpen:
+        # SoundCloud is failing, go straight to the fallback
+        fallback_track = fetchFallbackTrack(track_url)
+        if fallback_track:
+            return fallback_track
+        raise
+    except Exception as e:
+        # the scraped client id may have been rotated
+        SoundcloudAPI.forget_rejected_client_id(e)
+        fallback_track = fetchFallbackTrack(track_url)
+        if fallback_track:
+            return fallback_track
+        raise
+    if isinstance(track, Track):
+        resolved_track_ids.set(posted_url, {'id': track.id}, RESOLVED_ID_TTL)
+    return track
+
+
+async def fetchTrackAsync(track_url):
+    """fetchTrack on the shared async client, only yt-dlp takes a thread."""
+    posted_url = track_url
+    if track_url.startswith('https://on.soundcloud.com'):
+        response = await soundcloud_breaker.call_async(
+            async_http.get, track_url, is_failure=is_server_error)
+        track_url = readShortLinkTarget(response)
+    try:
+        api = SoundcloudAPI()
+        track = await api.resolve_async(track_url)
+    except CircuitOpen:
+        # yt-dlp has its own bulkhead, slow fallbacks hold up no lookups
+        fallback_track = await bulkheads['yt_dlp'].run(fetchFallbackTrack,
+                                                       track_url)
+        if fallback_track:
+            return fallback_track
+        raise
     except Exception as e:
-        fallback_track = fetchTrackWithYtDlp(track_url)
+        SoundcloudAPI.forget_rejected_client_id(e)
+        fallback_track = await bulkheads['yt_dlp'].run(fetchFallbackTrack,
+                                                       track_url)
         if fallback_track:
             return fallback_track
         raise
+    if isinstance(track, Track):
+        resolved_track_ids.set(posted_url, {'id': track.id}, RESOLVED_ID_TTL)
+    return track
+
+
+def readShortLinkTarget(response):
+    """The track URL an on.soundcloud.com link redirected to."""
+    if response.status_code == 200:
+        return response.history[0].headers['location']
+    if response.status_code == 404:
+        raise LinkUnavailable('not_found',
+                              'Unable to fetch Soundcloud Mobile URL')
+    raise Exception('Unable to fetch Soundcloud Mobile URL')
+
+
+async def fetchTracksAsync(track_urls):
+    """
+    Fetch several tracks at once. URLs resolved before are hydrated together
+    through the multi-id tracks endpoint, the rest are resolved concurrently.
+    Returns a dict mapping each URL to its track, or to the exception raised.
+    """
+    known_ids = knownTrackIds(track_urls)
+    hydrated = {}
+    if known_ids:
+        try:
+            hydrated = await SoundcloudAPI().hydrate_tracks_async(
+                list(dict.fromkeys(known_ids.values())))
+        except Exception as e:
+            print(f"An error occurred while hydrating SoundCloud tracks: {e}")
+
+    results = matchHydratedTracks(known_ids, hydrated)
+    unresolved = [url for url in track_urls if url not in results]
+    tracks = await asyncio.gather(
+        *(fetchTrackAsync(url) for url in unresolved), return_exceptions=True)
+    results.update(zip(unresolved, tracks, strict=True))
+    return results
+
+
+def knownTrackIds(track_urls):
+    known_ids = {}
+    for url in track_urls:
+        entry = resolved_track_ids.get(url)
+        if entry:
+            known_ids[url] = entry['id']
+    return known_ids
+
+
+def matchHydratedTracks(known_ids, hydrated):
+    results = {}
+    for url, track_id in known_ids.items():
+        if track_id in hydrated:
+            results[url] = hydrated[track_id]
+        else:
+            # deleted or made private since it was resolved
+            resolved_track_ids.purge(url)
+    return results
+
+
+async def fetchPartsBatchAsync(track_urls):
+    """Embed parts for a batch of URLs, for the WindowBatcher."""
+    results = {}
+    for url, track in (await fetchTracksAsync(track_urls)).items():
+        try:
+            if isinstance(track, Exception):
+                results[url] = track
+            elif isinstance(track, Playlist):
+                # the tracklist hydrates its stubs with blocking requests
+                results[url] = await bulkheads['soundcloud'].run(
+                    mapTrackToParts, track)
+            else:
+                results[url] = mapTrackToParts(track)
+        except Exception as e:
+            results[url] = e
+    return results
+
+
+soundcloud_batcher = WindowBatcher(fetchPartsBatchAsync)
 
 
 def getSoundcloudParts(url: str):
+    return mapTrackToParts(fetchTrack(remove_trailing_slash(url)))
+
+
+async def getSoundcloudPartsAsync(url: str):
+    """getSoundcloudParts for the event loop, batched with other messages."""
+    return dict(await soundcloud_batcher.get(remove_trailing_slash(url)))
+
+
+def mapTrackToParts(track):
     soundcloudParts = {
         'embedPlatformType': 'soundcloud',
         'embedColour': 0xff5500
     }
 
-    track = fetchTrack(remove_trailing_slash(url))
-
     if isinstance(track, (Track, YtDlpTrack)):
         if checkTrackTitle(track.title):
             setTrackTitle(track)
@@ -131,13 +449,8 @@ def getSoundcloudParts(url: str):
             soundcloudParts['Uploaded on'] = formatTimeToDisplay(
                 track.created_at, '%Y-%m-%dT%H:%M:%SZ')
 
-        #Likes
-        if track.likes_count:
-            soundcloudParts['Likes'] = f':orange_heart: {track.likes_count}'
-
-        #Plays
-        if track.playback_count:
-            soundcloudParts['Plays'] = f':notes: {track.playback_count:,}'
+        #Likes and Plays
+        soundcloudParts.update(mapVolatileTrackParts(track))
 
         #Buy Link
         if track.purchase_url:
@@ -168,6 +481,10 @@ def getSoundcloudParts(url: str):
         # if track.description:
         #     soundcloudParts['Description'] = cleanLinks(track.description)
 
+        if isinstance(track, Track):
+            # lets the cache refresh Likes and Plays from the track JSON
+            soundcloudParts['refreshSource'] = {'trackId': track.id}
+
     elif isinstance(track, Playlist):  #set, playlist or album
         soundcloudParts['title'] = f'{track.title}'
         if (track.is_album):
@@ -176,18 +493,17 @@ def getSoundcloudParts(url: str):
                                          f'({track.user["permalink_url"]})')
             trackStrings = []
             trackSummaryCharLength = 0
-            maxDisplayableTracksReached = False
             for song in track.tracks:
-                if not maxDisplayableTracksReached:
-                    outputString = (
-                        f'1. [{song.title}]({song.permalink_url}) '
-                        f'{formatMillisecondsToDurationString(song.duration)}')
-                    outputStringLength = len(outputString) + 1
-                    if trackSummaryCharLength + outputStringLength <= 1000:
-                        trackStrings.append(outputString)
-                        trackSummaryCharLength += outputStringLength
-                    else:
-                        maxDisplayableTracksReached = True
+                outputString = (
+                    f'1. [{song.title}]({song.permalink_url}) '
+                    f'{formatMillisecondsToDurationString(song.duration)}')
+                outputStringLength = len(outputString) + 1
+                if trackSummaryCharLength + outputStringLength <= 1000:
+                    trackStrings.append(outputString)
+                    trackSummaryCharLength += outputStringLength
+                else:
+                    # stop here so the remaining tracks are never hydrated
+                    break
 
             soundcloudParts['Tracks'] = '\n'.join(trackStrings)
             if len(trackStrings) != track.track_count:
@@ -232,6 +548,33 @@ def getSoundcloudParts(url: str):
     return soundcloudParts
 
 
+def mapVolatileTrackParts(track):
+    parts = {}
+    #Likes
+    if track.likes_count:
+        parts['Likes'] = f':orange_heart: {track.likes_count}'
+
+    #Plays
+    if track.playback_count:
+        parts['Plays'] = f':notes: {track.playback_count:,}'
+    return parts
+
+
+def refreshVolatileParts(refreshSource):
+    """
+    Likes and Plays of a track resolved before, from its track JSON alone.
+    Returns None if the track cannot be fetched anymore.
+    """
+    try:
+        track_id = refreshSource['trackId']
+        track = SoundcloudAPI().hydrate_tracks([track_id]).get(track_id)
+    except Exception as e:
+        SoundcloudAPI.forget_rejected_client_id(e)
+        print(f"An error occurred while refreshing a SoundCloud track: {e}")
+        return None
+    return mapVolatileTrackParts(track) if track else None
+
+
 def checkTrackTitle(track_title):
     return '-' in track_title or '–' in track_title or '—' in track_title
 
@@ -1,14 +1,140 @@
+import asyncio
 import logging
 import re
-from typing import Optional
+import threading
+from typing import Any, Callable, Mapping, Optional
 
 from spotapi.album import PublicAlbum
-from spotapi.public import Public
-
+from spotapi.client import BaseClient
+from spotapi.http.request import TLSClient
+from spotapi.playlist import PublicPlaylist
+from spotapi.song import Song
+
+import deadlines
+from batching import WindowBatcher
+from bulkheads import bulkheads
+from circuit_breaker import circuit_breakers
 from general_utils import formatMillisecondsToDurationString, formatTimeToDisplay
+from negative_cache import NO_DATA
+from object_types import (
+    SpotifyAlbum,
+    SpotifyArtist,
+    SpotifyImage,
+    SpotifyPlaylist,
+    SpotifyPlaylistTrack,
+    SpotifyTrack,
+)
 
 logger = logging.getLogger(__name__)
 
+# Tracks fetched per page while the tracklist is still being rendered
+TRACKLIST_PAGE_SIZE = 50
+# Largest page the pathfinder queries accept, used once only durations are needed
+MAX_PAGE_SIZE = 343
+# Character budget of the Tracks field
+TRACKLIST_CHAR_LIMIT = 1000
+
+
+class SpotifyClient:
+    """
+    Long-lived holder for the TLS session and anonymous web-player tokens.
+
+    spotapi keeps the session cookies, access token, client token and GraphQL
+    query hashes on a `BaseClient`, and `Song`/`PublicAlbum` each create a new
+    one. Sharing a single `BaseClient` makes the token handshake a one-off cost
+    instead of part of every lookup.
+    """
+
+    def __init__(self, client_factory: Optional[Callable[[], TLSClient]] = None):
+        self._client_factory = client_factory or (
+            lambda: TLSClient('chrome120', '', auto_retries=3))
+        self._lock = threading.Lock()
+        # held while spotapi checks or swaps the token, see _create_base
+        self._auth_lock = threading.RLock()
+        self._base: Optional[BaseClient] = None
+
+    @property
+    def base(self) -> BaseClient:
+        with self._lock:
+            if self._base is None:
+                self._base = self._create_base()
+            return self._base
+
+    def _create_base(self) -> BaseClient:
+        base = BaseClient(client=self._client_factory())
+        # spotapi refreshes the token itself, ahead of its expiry and after a
+        # 401. Bulkhead threads share the client, so a request must not read
+        # the token while another thread swaps it
+        client = base.client
+        client.authenticate = self._locked(client.authenticate)
+        client.on_auth_failure = self._locked(client.on_auth_failure)
+        return base
+
+    def _locked(self, function: Callable[..., Any]) -> Callable[..., Any]:
+        def locked(*args):
+            with self._auth_lock:
+                return function(*args)
+        return locked
+
+    def _call(self, request: Callable[[BaseClient], Mapping[str, Any]]):
+        return circuit_breakers['spotify'].call(request, self.base)
+
+    def song_info(self, track_id: str) -> Mapping[str, Any]:
+        return self._call(lambda base: _bind(Song, base, playlist=None)
+                          .get_track_info(track_id))
+
+    def album_info(self, album_id: str, limit: int = 25,
+                   offset: int = 0) -> Mapping[str, Any]:
+        album = {
+            'album_id': album_id,
+            'album_link': f'https://open.spotify.com/album/{album_id}',
+        }
+        return self._call(lambda base: _bind(PublicAlbum, base, **album)
+                          .get_album_info(limit, offset=offset))
+
+    def playlist_info(self, playlist_id: str, limit: int = 25,
+                      offset: int = 0) -> Mapping[str, Any]:
+        playlist = {
+            'playlist_id': playlist_id,
+            'playlist_link': f'https://open.spotify.com/playlist/{playlist_id}',
+        }
+        return self._call(lambda base: _bind(PublicPlaylist, base, **playlist)
+                          .get_playlist_info(limit, offset=offset))
+
+
+async def fetch_track_infos(track_ids: list[str]) -> dict[str, Any]:
+    """
+    Fetch a batch of tracks for the WindowBatcher. The pathfinder API has no
+    multi-track query, so one `getTrack` request per distinct id is the least
+    it allows; they run concurrently on the Spotify bulkhead and the shared
+    session.
+    """
+    async def fetch(track_id):
+        try:
+            return await bulkheads['spotify'].run(spotify_client.song_info, track_id)
+        except Exception as e:
+            return e
+
+    results = await asyncio.gather(*(fetch(track_id) for track_id in track_ids))
+    return dict(zip(track_ids, results, strict=True))
+
+
+def _bind(cls, base: BaseClient, **slots):
+    """
+    Instantiate a spotapi endpoint class on an existing `BaseClient`.
+    Their constructors would create a new one and re-bind the session's auth
+    hooks to it, so the slots are filled in directly instead.
+    """
+    instance = cls.__new__(cls)
+    instance.base = base
+    for name, value in slots.items():
+        setattr(instance, name, value)
+    return instance
+
+
+spotify_client = SpotifyClient()
+spotify_batcher = WindowBatcher(fetch_track_infos)
+
 
 def _spotify_url(uri: str) -> str:
     parts = uri.split(':')
@@ -64,6 +190,48 @@ def _title_artist_names(artists: list, title: str) -> str:
     )
 
 
+class TrackPages:
+    """
+    Iterates the tracks of a paginated pathfinder response, fetching the next
+    page only when the current one is used up.
+
+    Pages are requested with `page_size`, which callers raise to
+    `MAX_PAGE_SIZE` once they no longer render tracks so that the remainder
+    of a large release costs as few requests as possible.
+
+    No more pages are fetched once the deadline leaves no time for them;
+    `complete` tells whether every track was read.
+    """
+
+    def __init__(self, first_page: dict, fetch_page: Callable[[int, int], dict],
+                 page_size: int = TRACKLIST_PAGE_SIZE):
+        # `page_size` must match the limit the first page was requested with
+        self.total = first_page.get('totalCount', 0)
+        self.page_size = page_size
+        self.pages_fetched = 1
+        self.complete = False
+        self._first_items = first_page.get('items', [])
+        self._first_limit = page_size
+        self._fetch_page = fetch_page
+
+    def __iter__(self):
+        items = self._first_items
+        requested = self._first_limit
+        offset = 0
+        while True:
+            yield from items
+            offset += len(items)
+            # a short page is the last one, whatever totalCount says
+            if not items or len(items) < requested or offset >= self.total:
+                self.complete = True
+                return
+            if not deadlines.allows('spotify tracks page'):
+                return
+            requested = self.page_size
+            items = self._fetch_page(offset, requested).get('items', [])
+            self.pages_fetched += 1
+
+
 def reformatTitle(title: str) -> str:
     remix_regex = r"(.+?)\s[-–]\s(.*?(Remix|Mix|Edit).*)"
     if re.match(remix_regex, title):
@@ -84,14 +252,42 @@ def getSpotifyParts(url: str) -> dict:
             if not album_id:
                 raise ValueError('Could not extract album ID')
             _build_album_parts(parts, album_id)
+        elif '/playlist/' in url and 'open.spotify.com' in url:
+            playlist_id = _extract_id(url, 'playlist')
+            if not playlist_id:
+                raise ValueError('Could not extract playlist ID')
+            _build_playlist_parts(parts, playlist_id)
+    except Exception as e:
+        logger.error('Error fetching Spotify details: %s', e)
+    return parts
+
+
+async def getSpotifyPartsAsync(url: str) -> dict:
+    """
+    getSpotifyParts for the event loop. Track links go through the batcher so
+    tracks posted together share their lookups.
+    """
+    track_id = (_extract_id(url, 'track')
+                if '/track/' in url and 'open.spotify.com' in url else None)
+    if not track_id:
+        return await bulkheads['spotify'].run(getSpotifyParts, url)
+
+    parts = {'embedPlatformType': 'spotify', 'embedColour': 0x1db954}
+    try:
+        _apply_track_info(parts, await spotify_batcher.get(track_id))
     except Exception as e:
         logger.error('Error fetching Spotify details: %s', e)
     return parts
 
 
 def _build_track_parts(parts: dict, track_id: str) -> None:
-    info = Public.song_info(track_id)
+    _apply_track_info(parts, spotify_client.song_info(track_id))
+
+
+def _apply_track_info(parts: dict, info: Mapping[str, Any]) -> None:
     if not info:
+        # Spotify answered, there is nothing to embed
+        parts[NO_DATA] = True
         raise ValueError('No data returned')
     track = info['data']['trackUnion']
 
@@ -126,15 +322,20 @@ def _build_track_parts(parts: dict, track_id: str) -> None:
 
 
 def _build_album_parts(parts: dict, album_id: str) -> None:
-    info = PublicAlbum(album_id).get_album_info()
+    info = spotify_client.album_info(album_id, limit=TRACKLIST_PAGE_SIZE)
     if not info:
+        # Spotify answered, there is nothing to embed
+        parts[NO_DATA] = True
         raise ValueError('No data returned')
     album = info['data']['albumUnion']
 
     title = album['name']
     artists = album.get('artists', {}).get('items', [])
-    track_items = album.get('tracksV2', {}).get('items', [])
-    total_tracks = album.get('tracksV2', {}).get('totalCount', 0)
+    track_pages = TrackPages(
+        album.get('tracksV2', {}),
+        lambda offset, limit: spotify_client.album_info(
+            album_id, limit=limit, offset=offset)['data']['albumUnion']['tracksV2'])
+    total_tracks = track_pages.total
 
     artist_str = _format_artist_string(artists)
     title_artists = _title_artist_names(artists, title)
@@ -142,11 +343,15 @@ def _build_album_parts(parts: dict, album_id: str) -> None:
     track_strings = []
     track_char_len = 0
     total_duration = 0
+    first_track_ms = 0
     max_reached = False
 
-    for item in track_items:
+    for index, item in enumerate(track_pages):
         t = item['track']
-        total_duration += t.get('duration', {}).get('totalMilliseconds', 0)
+        duration_ms = t.get('duration', {}).get('totalMilliseconds', 0)
+        total_duration += duration_ms
+        if index == 0:
+            first_track_ms = duration_ms
         if not max_reached:
             track_title = reformatTitle(t.get('name', ''))
             track_artists_list = t.get('artists', {}).get('items', [])
@@ -162,17 +367,19 @@ def _build_album_parts(parts: dict, album_id: str) -> None:
                 f'{t["trackNumber"]}. {display}({track_url})'
                 f' {formatMillisecondsToDurationString(t.get("duration", {}).get("totalMilliseconds", 0))}'
             )
-            if track_char_len + len(track_str) + 1 <= 1000:
+            if track_char_len + len(track_str) + 1 <= TRACKLIST_CHAR_LIMIT:
                 track_strings.append(track_str)
                 track_char_len += len(track_str) + 1
             else:
                 max_reached = True
+                # only durations are read from here on
+                track_pages.page_size = MAX_PAGE_SIZE
 
-    if total_tracks > 1:
+    if total_tracks <= 1:
+        parts['Duration'] = formatMillisecondsToDurationString(first_track_ms)
+    elif track_pages.complete:
+        # the duration is only known when every track has been read
         parts['Duration'] = formatMillisecondsToDurationString(total_duration)
-    else:
-        single_ms = track_items[0]['track'].get('duration', {}).get('totalMilliseconds', 0) if track_items else 0
-        parts['Duration'] = formatMillisecondsToDurationString(single_ms)
 
     parts['Released'] = _format_date(album['date'])
 
@@ -201,3 +408,135 @@ def _build_album_parts(parts: dict, album_id: str) -> None:
         if title_artists and title_artists != 'Various Artists'
         else title
     )
+
+
+def _images(cover_art: dict) -> list[SpotifyImage]:
+    return [
+        SpotifyImage(url=source.get('url', ''),
+                     height=source.get('height') or 0,
+                     width=source.get('width') or 0)
+        for source in cover_art.get('sources', [])
+    ]
+
+
+def _artist(artist: dict) -> SpotifyArtist:
+    uri = artist.get('uri', '')
+    return SpotifyArtist(name=artist.get('profile', {}).get('name', ''),
+                         external_urls={'spotify': _spotify_url(uri)},
+                         id=uri.split(':')[-1])
+
+
+def _playlist_track(item: dict) -> Optional[SpotifyPlaylistTrack]:
+    """Map a pathfinder playlist item, skipping episodes and removed tracks."""
+    data = (item.get('itemV2') or {}).get('data') or {}
+    if data.get('__typename') != 'Track':
+        return None
+    album = data.get('albumOfTrack') or {}
+    url = _spotify_url(data.get('uri', ''))
+    track = SpotifyTrack(
+        name=data.get('name', ''),
+        artists=[_artist(a) for a in data.get('artists', {}).get('items', [])],
+        album=SpotifyAlbum(
+            name=album.get('name', ''),
+            artists=[_artist(a) for a in album.get('artists', {}).get('items', [])],
+            images=_images(album.get('coverArt', {})),
+            release_date='',
+            release_date_precision='',
+            tracks={'items': [], 'total': 0, 'next': None},
+            total_tracks=0,
+            external_urls={'spotify': _spotify_url(album.get('uri', ''))},
+            label=None,
+        ),
+        duration_ms=data.get('trackDuration', {}).get('totalMilliseconds', 0),
+        external_urls={'spotify': url},
+        track_number=0,
+    )
+    return SpotifyPlaylistTrack(track=track)
+
+
+def _playlist_header(playlist: dict) -> SpotifyPlaylist:
+    """Map the fetchPlaylist header; `tracks.items` is left to TrackPages."""
+    owner = (playlist.get('ownerV2') or {}).get('data') or {}
+    images = playlist.get('images', {}).get('items', [])
+    return SpotifyPlaylist(
+        name=playlist.get('name', ''),
+        owner={
+            'display_name': owner.get('name', ''),
+            'external_urls': {'spotify': _spotify_url(owner.get('uri', ''))},
+        },
+        tracks={
+            'items': [],
+            'total': playlist.get('content', {}).get('totalCount', 0),
+            'next': None,
+        },
+        images=_images(images[0]) if images else [],
+        followers={'total': playlist.get('followers') or 0},
+        description=playlist.get('description') or None,
+    )
+
+
+def _build_playlist_parts(parts: dict, playlist_id: str) -> None:
+    info = spotify_client.playlist_info(playlist_id, limit=TRACKLIST_PAGE_SIZE)
+    if not info:
+        # Spotify answered, there is nothing to embed
+        parts[NO_DATA] = True
+        raise ValueError('No data returned')
+    raw_playlist = info['data']['playlistV2']
+    playlist = _playlist_header(raw_playlist)
+    total_tracks = playlist['tracks']['total']
+
+    parts['title'] = playlist['name']
+    parts['description'] = f'Playlist ({total_tracks} tracks)'
+
+    if playlist['images']:
+        parts['thumbnailUrl'] = max(
+            playlist['images'], key=lambda image: image['height'])['url']
+
+    owner = playlist['owner']
+    if owner['display_name']:
+        owner_url = owner['external_urls']['spotify']
+        parts['Created by'] = (f'[{owner["display_name"]}]({owner_url})'
+                               if owner_url else owner['display_name'])
+
+    followers = playlist['followers']['total']
+    if followers:
+        parts['Followers'] = f'{followers:,}'
+
+    # Tracks are fetched page by page and only until the field is full
+    track_pages = TrackPages(
+        raw_playlist.get('content', {}),
+        lambda offset, limit: spotify_client.playlist_info(
+            playlist_id, limit=limit, offset=offset)['data']['playlistV2']['content'])
+    track_strings = []
+    track_char_len = 0
+    total_duration = 0
+    tracks_read = 0
+    for item in track_pages:
+        tracks_read += 1
+        playlist_track = _playlist_track(item)
+        if not playlist_track:
+            continue
+        track = playlist_track['track']
+        total_duration += track['duration_ms']
+        artist_names = ', '.join(a['name'] for a in track['artists'])
+        track_title = reformatTitle(track['name'])
+        display = (f'[{artist_names} - {track_title}]'
+                   if artist_names else f'[{track_title}]')
+        # numbered as shown, skipped items leave no gaps
+        track_str = (
+            f'{len(track_strings) + 1}. {display}'
+            f'({track["external_urls"]["spotify"]})'
+            f' {formatMillisecondsToDurationString(track["duration_ms"])}')
+        if track_char_len + len(track_str) + 1 > TRACKLIST_CHAR_LIMIT:
+            break
+        track_strings.append(track_str)
+        track_char_len += len(track_str) + 1
+
+    # the duration is only known when every track has been read
+    if tracks_read == total_tracks and total_tracks > 0:
+        parts['Duration'] = formatMillisecondsToDurationString(total_duration)
+
+    if track_strings:
+        parts['Tracks'] = '\n'.join(track_strings)
+        if len(track_strings) != total_tracks:
+            parts['Tracks'] += f'\n...and {total_tracks - len(track_strings)} more'
@@ -5,6 +5,7 @@ from sclib import Playlist, Track
 
 def setupBasicTrack():
     mock_track = MagicMock(spec=Track)
+    mock_track.id = 123456789
     mock_track.artist = 'Mock Artist'
     mock_track.title = 'Mock Track Title'
     mock_track.artwork_url = 'https://example.com/track-artwork.jpg'
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import async_http
+from async_http import HttpStatusError
+
+
+async def _track(_request):
+    return web.json_response({'id': 1, 'kind': 'track'})
+
+
+async def _short_link(_request):
+    raise web.HTTPFound('/track')
+
+
+async def _missing(_request):
+    raise web.HTTPNotFound(text='Gone')
+
+
+class TestAsyncHttp(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = web.Application()
+        app.router.add_get('/track', _track)
+        app.router.add_get('/short', _short_link)
+        app.router.add_get('/missing', _missing)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await async_http.close()
+        await self.server.close()
+
+    async def test_response_reads_like_requests(self):
+        response = await async_http.get(str(self.server.make_url('/track')))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'id': 1, 'kind': 'track'})
+        self.assertIn('"kind"', response.text)
+        response.raise_for_status()
+
+    async def test_redirects_are_kept_in_history(self):
+        response = await async_http.get(str(self.server.make_url('/short')))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.history[0].headers['Location'], '/track')
+
+    async def test_raise_for_status_carries_the_response(self):
+        response = await async_http.get(str(self.server.make_url('/missing')))
+
+        with self.assertRaises(HttpStatusError) as context:
+            response.raise_for_status()
+        self.assertEqual(context.exception.response.status_code, 404)
+
+    async def test_lookups_share_one_client(self):
+        self.assertIs(async_http.session(), async_http.session())
+
+
+async def _open_session():
+    return async_http.session()
+
+
+class TestSessionLoops(unittest.TestCase):
+
+    def tearDown(self):
+        asyncio.run(async_http.close())
+
+    def test_session_of_another_loop_is_closed_on_it(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        abandoned = loop.run_until_complete(_open_session())
+
+        current = asyncio.run(_open_session())
+        loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertIsNot(current, abandoned)
+        self.assertTrue(abandoned.closed)
+
+    def test_session_of_a_closed_loop_is_dropped(self):
+        loop = asyncio.new_event_loop()
+        abandoned = loop.run_until_complete(_open_session())
+        loop.close()
+
+        asyncio.run(_open_session())
+
+        self.assertTrue(abandoned.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from backfill import BackfillProgress, backfill_history
+
+TRACK = 'https://soundcloud.com/artist/track'
+CACHED = 'https://soundcloud.com/artist/cached'
+GONE = 'https://soundcloud.com/artist/gone'
+
+
+async def _history(*contents):
+    for content in contents:
+        message = MagicMock()
+        message.content = content
+        yield message
+
+
+class TestBackfill(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('backfill').setLevel(logging.CRITICAL)
+
+    async def test_warms_each_link_once(self):
+        async def lookup(link):
+            if link[0] == GONE:
+                raise LookupError('Gone')
+            return {'title': link[0]}
+
+        resolve = AsyncMock(side_effect=lookup)
+        cached = AsyncMock(side_effect=lambda link: (
+            {'title': 'Cached'} if link[0] == CACHED else None))
+        report = AsyncMock()
+
+        progress = await backfill_history(
+            _history(f'listen {TRACK}', f'{TRACK}?si=share', None, CACHED,
+                     f'{GONE} and https://example.com'),
+            resolve, cached, report=report, lookups_per_second=1000)
+
+        self.assertEqual(
+            sorted(call.args[0][0] for call in resolve.await_args_list),
+            [GONE, TRACK])
+        self.assertEqual(
+            (progress.messages, progress.links, progress.cached,
+             progress.resolved, progress.failed),
+            (5, 3, 1, 1, 1))
+        self.assertTrue(progress.done)
+        report.assert_awaited_with(progress)
+        self.assertIn('Backfill done', progress.summary())
+
+    async def test_lookups_are_bounded(self):
+        running, most = 0, 0
+
+        async def resolve(_link):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        links = [f'https://soundcloud.com/artist/track{n}' for n in range(6)]
+        progress = BackfillProgress()
+        await backfill_history(
+            _history(*links), resolve, AsyncMock(return_value=None),
+            progress=progress, concurrency=2, lookups_per_second=1000)
+
+        self.assertEqual(most, 2)
+        self.assertEqual(progress.resolved, 6)
+
+
+    async def test_a_failing_cache_check_counts_as_failed(self):
+        async def cached(link):
+            if link[0] == GONE:
+                raise ConnectionError('Resolver tier unreachable')
+            return None
+
+        resolve = AsyncMock(return_value={'title': 'Track'})
+        progress = await backfill_history(
+            _history(GONE, TRACK), resolve, cached, lookups_per_second=1000)
+
+        self.assertEqual((progress.resolved, progress.failed), (1, 1))
+        resolve.assert_awaited_once()
+        self.assertIn('Backfill done', progress.summary())
+
+    async def test_summary_is_reported_when_the_history_fails(self):
+        async def history():
+            async for message in _history(TRACK):
+                yield message
+            raise RuntimeError('Missing Access')
+
+        report = AsyncMock()
+        progress = BackfillProgress()
+        with self.assertRaises(RuntimeError):
+            await backfill_history(
+                history(), AsyncMock(return_value={'title': 'Track'}),
+                AsyncMock(return_value=None), progress=progress, report=report,
+                lookups_per_second=1000)
+
+        report.assert_awaited_once_with(progress)
+        self.assertEqual(progress.resolved, 1)
+        self.assertIn('Backfill stopped (Missing Access)', progress.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,18 @@
 import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from mockData.bandcamp_mock_scenarios import MockTrack
 
+from bandcamp_utils import (
+    BandcampScraper,
+    getBandcampParts,
+    getBandcampPartsAsync,
+    refreshVolatileParts,
+    types,
+)
+from bulkheads import bulkheads
+from negative_cache import LinkUnavailable
+
 
 class TestBandcampUtils(unittest.TestCase):
 
@@ -90,3 +101,105 @@ class TestBandcampUtils(unittest.TestCase):
         # Assert
         self.assertEqual(parts['title'], 'Test Track (Test Artist - Edit)')
         self.assertEqual(parts['Artist'], '[Test Artist](http://test.com)')
+
+    @patch('bandcamp_utils.callAPI')
+    def test_refresh_volatile_parts_from_api_only(self, mock_call_api):
+        # Arrange
+        mock_call_api.return_value = {
+            'is_purchasable': True,
+            'free_download': False,
+            'price': 5.0,
+            'currency': 'USD',
+            'release_date': 1640995200
+        }
+
+        # Act
+        parts = refreshVolatileParts({
+            'bandId': 1,
+            'itemId': 2,
+            'itemType': types.album,
+            'url': 'http://album.com'
+        })
+
+        # Assert
+        mock_call_api.assert_called_once_with(1, 2, types.album)
+        self.assertEqual(parts, {
+            'Price': '`$5.00`',
+            'Released on': '1 January 2022'
+        })
+
+    @patch('bandcamp_utils.callAPI')
+    def test_refresh_volatile_parts_without_api_data(self, mock_call_api):
+        # Arrange
+        mock_call_api.return_value = None
+
+        # Act
+        parts = refreshVolatileParts({
+            'bandId': 1,
+            'itemId': 2,
+            'itemType': types.track,
+            'url': 'http://track.com'
+        })
+
+        # Assert
+        self.assertIsNone(parts)
+
+    @patch('bandcamp_utils.requests.post')
+    @patch('bandcamp_utils.requests.get')
+    def test_missing_page_is_unavailable(self, mock_get, mock_post):
+        # Arrange
+        mock_get.return_value.status_code = 404
+        mock_post.return_value.status_code = 500
+        mock_post.return_value.headers = {}
+
+        # Act & Assert
+        with self.assertRaises(LinkUnavailable) as context:
+            getBandcampParts('https://artist.bandcamp.com/track/deleted')
+        self.assertEqual(context.exception.reason, 'not_found')
+
+
+def _page_response(status_code, content=b''):
+    response = MagicMock()
+    response.status_code = status_code
+    response.content = content
+    response.headers = {}
+    return response
+
+
+class TestBandcampUtilsAsync(unittest.IsolatedAsyncioTestCase):
+
+    @patch('bandcamp_utils.async_http.post', new_callable=AsyncMock)
+    @patch('bandcamp_utils.async_http.get', new_callable=AsyncMock)
+    async def test_missing_page_is_unavailable(self, mock_get, mock_post):
+        mock_get.return_value = _page_response(404)
+        mock_post.return_value = _page_response(500)
+
+        with self.assertRaises(LinkUnavailable) as context:
+            await getBandcampPartsAsync(
+                'https://artist.bandcamp.com/track/deleted')
+        self.assertEqual(context.exception.reason, 'not_found')
+
+    @patch('bandcamp_utils.async_http.get', new_callable=AsyncMock)
+    async def test_discography_is_scraped_without_the_api(self, mock_get):
+        mock_get.return_value = _page_response(
+            200, b'<html><head><meta name="title" content="Artist">'
+            b'<meta property="og:description" content="Bio"></head></html>')
+
+        parts = await getBandcampPartsAsync('https://artist.bandcamp.com/music')
+
+        mock_get.assert_called_once_with('https://artist.bandcamp.com/music')
+        self.assertEqual(parts['title'], 'Artist')
+        self.assertEqual(parts['description'], 'Discography\n\nBio')
+
+    @patch('bandcamp_utils.async_http.get', new_callable=AsyncMock)
+    async def test_pages_are_parsed_on_the_bandcamp_bulkhead(self, mock_get):
+        mock_get.return_value = _page_response(
+            200, b'<html><head><meta name="title" content="Artist"></head></html>')
+        bulkhead = bulkheads['bandcamp']
+
+        with patch.object(bulkhead, 'run',
+                          AsyncMock(side_effect=bulkhead.run)) as mock_run:
+            await getBandcampPartsAsync('https://artist.bandcamp.com/music')
+
+        self.assertIn(BandcampScraper._read_page,
+                      [call.args[0] for call in mock_run.await_args_list])
@@ -0,0 +1,77 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from batch_resolve import completed_urls, main, resolve_record
+from negative_cache import LinkUnavailable, failed_links
+from object_types import link_types
+from platform_registry import parts_cache
+
+TRACK = 'https://soundcloud.com/artist/track'
+OTHER = 'https://soundcloud.com/artist/other'
+
+
+class TestBatchResolve(unittest.TestCase):
+
+    def setUp(self):
+        parts_cache.clear()
+        failed_links.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_record(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+        self.assertEqual(
+            resolve_record((TRACK, link_types.soundcloud)),
+            {'url': TRACK, 'platform': 'soundcloud',
+             'parts': {'title': 'Test Track'}})
+
+        mock_get_parts.side_effect = LinkUnavailable('not_found', 'Gone')
+        self.assertEqual(
+            resolve_record((OTHER, link_types.soundcloud))['error'],
+            {'message': 'Gone', 'reason': 'not_found'})
+
+    def test_completed_urls_drops_a_cut_off_line(self):
+        path = self._write(
+            'parts.jsonl',
+            json.dumps({'url': TRACK, 'parts': {}}) + '\n{"url": "https://sou')
+
+        self.assertEqual(completed_urls(path), {TRACK})
+        with open(path, encoding='utf-8') as file:
+            self.assertTrue(file.read().endswith('}\n'))
+        self.assertEqual(completed_urls(os.path.join(self.directory, 'new')),
+                         set())
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resumes_from_the_output(self, mock_get_parts):
+        mock_get_parts.side_effect = lambda url: {'title': url}
+        links = self._write('links.txt', f'{TRACK}\n{OTHER}\n')
+        output = self._write(
+            'parts.jsonl', json.dumps({'url': TRACK, 'parts': {}}) + '\n')
+
+        with patch('sys.stderr', io.StringIO()):
+            main([links, '-o', output, '-w', '1', '--limit', 'soundcloud=1'])
+
+        with open(output, encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record['url'] for record in records], [TRACK, OTHER])
+        self.assertEqual(records[1]['parts'], {'title': OTHER})
+
+    def test_bad_limit(self):
+        with patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            main(['-', '--limit', 'myspace=3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
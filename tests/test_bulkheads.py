@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import unittest
+
+import deadlines
+import metrics
+from bulkheads import Bulkhead, BulkheadFull
+
+
+class TestBulkhead(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def _stuck(self):
+        self.release.wait(5)
+        return 'stuck'
+
+    async def _wait_until_busy(self, bulkhead, busy):
+        for _ in range(100):
+            if bulkhead.busy == busy:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f'{bulkhead.name} never had {busy} busy workers')
+
+    async def test_stuck_bulkhead_does_not_block_another(self):
+        stuck = Bulkhead('stuck', workers=1)
+        healthy = Bulkhead('healthy', workers=1)
+        blocked = asyncio.ensure_future(stuck.run(self._stuck))
+        queued = asyncio.ensure_future(stuck.run(self._stuck))
+        await self._wait_until_busy(stuck, 1)
+
+        result = await asyncio.wait_for(healthy.run(lambda: 'fast'), 1)
+
+        self.assertEqual(result, 'fast')
+        self.assertEqual(stuck.queued, 1)
+        self.release.set()
+        self.assertEqual(await asyncio.gather(blocked, queued),
+                         ['stuck', 'stuck'])
+
+    async def test_publishes_queue_depth_and_saturation(self):
+        bulkhead = Bulkhead('test', workers=2)
+        calls = [asyncio.ensure_future(bulkhead.run(self._stuck))
+                 for _ in range(3)]
+        await self._wait_until_busy(bulkhead, 2)
+
+        self.assertEqual(metrics.get('bulkhead_busy_workers', bulkhead='test'), 2)
+        self.assertEqual(metrics.get('bulkhead_queue_depth', bulkhead='test'), 1)
+        self.assertEqual(metrics.get('bulkhead_saturation', bulkhead='test'), 1)
+
+        self.release.set()
+        await asyncio.gather(*calls)
+        self.assertEqual(metrics.get('bulkhead_busy_workers', bulkhead='test'), 0)
+        self.assertEqual(metrics.get('bulkhead_queue_depth', bulkhead='test'), 0)
+
+    async def test_full_queue_refuses_calls(self):
+        bulkhead = Bulkhead('test', workers=1, max_queue=1)
+        blocked = asyncio.ensure_future(bulkhead.run(self._stuck))
+        await self._wait_until_busy(bulkhead, 1)
+        queued = asyncio.ensure_future(bulkhead.run(self._stuck))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(BulkheadFull):
+            await bulkhead.run(self._stuck)
+        self.assertEqual(
+            metrics.get('bulkhead_rejected_total', bulkhead='test'), 1)
+        self.release.set()
+        await asyncio.gather(blocked, queued)
+
+    async def test_cancelled_queued_call_leaves_the_queue(self):
+        bulkhead = Bulkhead('test', workers=1)
+        blocked = asyncio.ensure_future(bulkhead.run(self._stuck))
+        await self._wait_until_busy(bulkhead, 1)
+        queued = asyncio.ensure_future(bulkhead.run(self._stuck))
+        await asyncio.sleep(0)
+
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+
+        self.assertEqual(bulkhead.queued, 0)
+        self.release.set()
+        await blocked
+
+    async def test_calls_keep_the_callers_deadline(self):
+        bulkhead = Bulkhead('test', workers=1)
+        with deadlines.budget(30):
+            remaining = await bulkhead.run(deadlines.remaining)
+
+        self.assertGreater(remaining, 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
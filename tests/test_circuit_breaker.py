@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import deadlines
+import metrics
+from circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpen,
+    HostBusy,
+    circuit_breakers,
+    is_server_error,
+)
+from concurrency_limiter import AdaptiveLimiter
+from negative_cache import LinkUnavailable
+
+
+def _fail():
+    raise ConnectionError('connection reset')
+
+
+def _response(status_code):
+    response = MagicMock()
+    response.status_code = status_code
+    return response
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('circuit_breaker').setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        metrics.reset()
+
+    def _open(self, breaker):
+        for _ in range(breaker.min_calls):
+            with self.assertRaises(ConnectionError):
+                breaker.call(_fail)
+
+    def test_opens_after_error_rate_and_fails_fast(self):
+        breaker = CircuitBreaker('test', min_calls=4)
+        self._open(breaker)
+
+        self.assertEqual(breaker.state, OPEN)
+        function = MagicMock()
+        with self.assertRaises(CircuitOpen):
+            breaker.call(function)
+        function.assert_not_called()
+        self.assertEqual(metrics.get('circuit_state', upstream='test'), 2)
+        self.assertEqual(
+            metrics.get('circuit_transitions_total', upstream='test',
+                        to=OPEN), 1)
+        self.assertEqual(
+            metrics.get('circuit_rejected_total', upstream='test'), 1)
+
+    def test_half_open_probe_closes_on_success(self):
+        breaker = CircuitBreaker('test', open_seconds=0)
+        self._open(breaker)
+
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_half_open_probe_reopens_on_failure(self):
+        breaker = CircuitBreaker('test', open_seconds=0)
+        self._open(breaker)
+
+        self.assertTrue(breaker.allow())
+        # only one probe at a time
+        self.assertFalse(breaker.allow())
+        breaker.open_seconds = 60
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_retry_after_past_the_deadline_fails_right_away(self):
+        limiter = AdaptiveLimiter('test', initial=1)
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True, retry_after=120)
+        breaker = CircuitBreaker('test', limiter=limiter)
+
+        started = time.monotonic()
+        with deadlines.budget(2), self.assertRaises(HostBusy):
+            breaker.call(lambda: _response(200))
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_upstreams_on_one_host_share_its_limiter(self):
+        self.assertIs(circuit_breakers['bandcamp_page'].limiter,
+                      circuit_breakers['bandcamp_api'].limiter)
+        # the yt-dlp fallback is slow, it must not shrink SoundCloud's limit
+        self.assertIsNot(circuit_breakers['yt_dlp'].limiter,
+                         circuit_breakers['soundcloud_api'].limiter)
+
+    def test_client_errors_do_not_count(self):
+        breaker = CircuitBreaker('test', min_calls=2)
+
+        def missing():
+            raise LinkUnavailable('not_found', 'Gone')
+
+        for _ in range(3):
+            with self.assertRaises(LinkUnavailable):
+                breaker.call(missing)
+            breaker.call(lambda: _response(404), is_failure=is_server_error)
+        self.assertEqual(breaker.state, CLOSED)
+
+        for _ in range(6):
+            breaker.call(lambda: _response(503), is_failure=is_server_error)
+        self.assertEqual(breaker.state, OPEN)
+
+
+class TestCircuitBreakerAsync(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('circuit_breaker').setLevel(logging.CRITICAL)
+
+    async def test_call_async_counts_failures(self):
+        breaker = CircuitBreaker('test', min_calls=2)
+
+        async def unavailable():
+            return _response(503)
+
+        for _ in range(2):
+            await breaker.call_async(unavailable, is_failure=is_server_error)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpen):
+            await breaker.call_async(unavailable)
+
+    async def test_call_async_waits_no_longer_than_the_deadline(self):
+        limiter = AdaptiveLimiter('test', initial=1)
+        limiter.acquire()
+        breaker = CircuitBreaker('test', open_seconds=0, limiter=limiter)
+        breaker._transition(HALF_OPEN)
+
+        async def ok():
+            return _response(200)
+
+        with deadlines.budget(0.05), self.assertRaises(HostBusy):
+            await breaker.call_async(ok)
+
+        # the probe slot was given back
+        self.assertTrue(breaker.allow())
+
+    async def test_cancelled_call_frees_its_slots(self):
+        limiter = AdaptiveLimiter('test', initial=1)
+        breaker = CircuitBreaker('test', open_seconds=0, limiter=limiter)
+        breaker._transition(HALF_OPEN)
+
+        call = asyncio.ensure_future(breaker.call_async(asyncio.sleep, 10))
+        await asyncio.sleep(0.01)
+        self.assertEqual(limiter.in_flight, 1)
+        call.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await call
+
+        self.assertEqual(limiter.in_flight, 0)
+        # the probe slot is free again and nothing was recorded
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from circuit_breaker import CircuitBreaker, is_server_error
+from concurrency_limiter import AdaptiveLimiter, retry_after_seconds
+
+
+def _response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('concurrency_limiter').setLevel(logging.CRITICAL)
+        logging.getLogger('circuit_breaker').setLevel(logging.CRITICAL)
+
+    def test_limit_grows_while_in_use(self):
+        limiter = AdaptiveLimiter('test', initial=2)
+        for _ in range(2):
+            self.assertTrue(limiter.acquire(timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0))
+
+        limiter.release(0.1)
+        limiter.release(0.1)
+        self.assertGreater(limiter.limit, 2)
+
+    def test_limit_does_not_grow_while_idle(self):
+        limiter = AdaptiveLimiter('test', initial=2)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_overload_halves_limit(self):
+        limiter = AdaptiveLimiter('test', initial=8)
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_slow_calls_trim_limit(self):
+        limiter = AdaptiveLimiter('test', initial=10)
+        limiter.acquire()
+        limiter.release(0.1)
+        limiter.acquire()
+        limiter.release(1.0)
+        self.assertAlmostEqual(limiter.limit, 9)
+
+    def test_retry_after_pauses_the_host(self):
+        limiter = AdaptiveLimiter('test', initial=4)
+        breaker = CircuitBreaker('test', limiter=limiter)
+
+        breaker.call(lambda: _response(429, {'Retry-After': '120'}),
+                     is_failure=is_server_error)
+
+        self.assertEqual(limiter.limit, 2)
+        self.assertFalse(limiter.acquire(timeout=0.01))
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds({'Retry-After': '30'}), 30)
+        self.assertEqual(
+            retry_after_seconds({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+            0)
+        self.assertIsNone(retry_after_seconds({}))
+        self.assertIsNone(retry_after_seconds(None))
+
+
+class TestAdaptiveLimiterAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_acquire_async_waits_for_a_release(self):
+        limiter = AdaptiveLimiter('test', initial=1)
+        await limiter.acquire_async()
+
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+
+        # released from a worker thread, like a blocking call would
+        threading.Thread(target=limiter.release, args=(0.1,)).start()
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_cancelled_wait_leaves_no_waiter(self):
+        limiter = AdaptiveLimiter('test', initial=1)
+        await limiter.acquire_async()
+
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+
+        limiter.cancel()
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter._async_waiters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
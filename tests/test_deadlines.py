@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+
+import deadlines
+from batching import WindowBatcher
+
+
+class TestDeadlines(unittest.IsolatedAsyncioTestCase):
+
+    async def test_budget_follows_the_lookup_into_threads(self):
+        with deadlines.budget(0) as budget:
+            allowed = await asyncio.to_thread(deadlines.allows, 'enrichment')
+
+        self.assertFalse(allowed)
+        self.assertEqual(budget.dropped, ['enrichment'])
+
+    async def test_no_budget_allows_everything(self):
+        self.assertTrue(deadlines.allows('enrichment'))
+        self.assertEqual(deadlines.dropped(), [])
+
+    async def test_nested_budget_keeps_the_earlier_deadline(self):
+        with deadlines.budget(0), deadlines.budget(60):
+            self.assertFalse(deadlines.allows('enrichment'))
+
+    async def test_request_timeout_follows_the_budget_within_bounds(self):
+        self.assertEqual(deadlines.request_timeout(15), 15)
+        with deadlines.budget(5):
+            self.assertTrue(4 < deadlines.request_timeout(15) <= 5)
+            self.assertEqual(deadlines.request_timeout(2), 2)
+        with deadlines.budget(0):
+            self.assertEqual(deadlines.request_timeout(15),
+                             deadlines.MIN_REQUEST_TIMEOUT_SECONDS)
+
+    async def test_batch_runs_under_the_latest_budget(self):
+        def fetch_batch(keys):
+            allowed = deadlines.allows('enrichment')
+            return dict.fromkeys(keys, allowed)
+
+        batcher = WindowBatcher(fetch_batch, window=0)
+
+        async def get(key, seconds):
+            with deadlines.budget(seconds) as budget:
+                return await batcher.get(key), budget.dropped
+
+        results = await asyncio.gather(get('a', 0), get('b', 60))
+
+        self.assertEqual(results, [(True, []), (True, [])])
+
+    async def test_batch_reports_dropped_enrichments_to_callers(self):
+        def fetch_batch(keys):
+            deadlines.allows('enrichment')
+            return {key: key for key in keys}
+
+        batcher = WindowBatcher(fetch_batch, window=0)
+        with deadlines.budget(0) as budget:
+            self.assertEqual(await batcher.get('a'), 'a')
+
+        self.assertEqual(budget.dropped, ['enrichment'])
+
+    async def test_caller_joining_a_flushed_batch_leaves_no_budget_behind(self):
+        started, release = asyncio.Event(), asyncio.Event()
+        allowed = []
+
+        async def fetch_batch(keys):
+            allowed.append(deadlines.allows('enrichment'))
+            started.set()
+            await release.wait()
+            return {key: key for key in keys}
+
+        batcher = WindowBatcher(fetch_batch, window=0)
+
+        async def get(seconds):
+            with deadlines.budget(seconds) as budget:
+                return await batcher.get('a'), budget.dropped
+
+        first = asyncio.ensure_future(get(0))
+        await started.wait()
+        joiner = asyncio.ensure_future(get(60))
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual(await first, ('a', ['enrichment']))
+        self.assertEqual(await joiner, ('a', ['enrichment']))
+        # the joiner's generous budget does not carry over to the next batch
+        self.assertEqual(await get(0), ('a', ['enrichment']))
+        self.assertEqual(allowed, [False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
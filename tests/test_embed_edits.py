@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+import discord
+
+from embed_edits import EditBatcher
+
+
+def _message(message_id, channel_id=1):
+    message = MagicMock()
+    message.id = message_id
+    message.channel.id = channel_id
+    message.edit = AsyncMock()
+    return message
+
+
+class TestEditBatcher(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('embed_edits').setLevel(logging.CRITICAL)
+
+    async def _drained(self, batcher):
+        await asyncio.gather(*batcher._workers.values())
+
+    async def test_edits_to_a_waiting_message_are_merged(self):
+        batcher = EditBatcher(interval=0)
+        first, second = _message(1), _message(2)
+
+        batcher.edit(first, content='a')
+        batcher.edit(second, content='b')
+        batcher.edit(second, content='c', embeds=[])
+        await self._drained(batcher)
+
+        first.edit.assert_awaited_once_with(content='a')
+        second.edit.assert_awaited_once_with(content='c', embeds=[])
+        self.assertEqual(batcher.pending(), 0)
+
+    async def test_edits_are_spaced_per_channel(self):
+        batcher = EditBatcher(interval=0.05)
+        messages = [_message(1), _message(2), _message(3, channel_id=2)]
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for message in messages:
+            batcher.edit(message, content='x')
+        await self._drained(batcher)
+
+        self.assertGreaterEqual(loop.time() - start, 0.1)
+        for message in messages:
+            message.edit.assert_awaited_once()
+
+    async def test_failed_edit_does_not_stop_the_queue(self):
+        batcher = EditBatcher(interval=0)
+        failing, working = _message(1), _message(2)
+        failing.edit.side_effect = discord.HTTPException(MagicMock(), 'gone')
+
+        batcher.edit(failing, content='a')
+        batcher.edit(working, content='b')
+        await self._drained(batcher)
+
+        working.edit.assert_awaited_once_with(content='b')
+
+
+if __name__ == '__main__':
+    unittest.main()
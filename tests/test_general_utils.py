@@ -7,9 +7,13 @@ from general_utils import (
     formatMillisecondsToDurationString,
     formatTimeToDisplay,
     formatTimeToTimestamp,
+    read_links,
 )
 from object_types import link_types
 
+TRACK = 'https://soundcloud.com/artist/track'
+OTHER = 'https://soundcloud.com/artist/other'
+
 
 class TestGeneralUtils(unittest.TestCase):
 
@@ -106,6 +110,17 @@ class TestGeneralUtils(unittest.TestCase):
              ('https://artist.bandcamp.com/track/sample-track',
               link_types.bandcamp)])
 
+    def test_read_links(self):
+        links = read_links([
+            f'first {TRACK} and https://example.com/page',
+            f'{TRACK}?si=tracking',
+            '',
+            f'<{OTHER}>',
+        ])
+
+        self.assertEqual(links, [(TRACK, link_types.soundcloud),
+                                 (OTHER, link_types.soundcloud)])
+
     def test_find_and_categorize_links_mobile_soundcloud(self):
         message_content = (
             "Check out this mobile link: "
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import unittest
+
+import metrics
+from ingestion import BUSY, DROP_OLDEST, IngestionQueue
+
+
+class TestIngestionQueue(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('ingestion').setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        metrics.reset()
+        self.handled, self.shed = [], []
+        self.release = asyncio.Event()
+
+    async def _handle(self, item):
+        await self.release.wait()
+        self.handled.append(item)
+
+    async def _shed(self, item):
+        self.shed.append(item)
+
+    def _queue(self, **kwargs):
+        queue = IngestionQueue(self._handle, self._shed, **kwargs)
+        self.addCleanup(queue.stop)
+        return queue
+
+    async def test_workers_bound_items_in_flight(self):
+        queue = self._queue(workers=2, capacity=10)
+        for item in range(5):
+            await queue.submit(item)
+        await asyncio.sleep(0)
+
+        self.assertEqual(queue.depth, 3)
+        self.assertEqual(metrics.get('ingestion_busy_workers'), 2)
+
+        self.release.set()
+        await queue.join()
+        self.assertEqual(sorted(self.handled), [0, 1, 2, 3, 4])
+
+    async def test_drop_oldest_makes_room(self):
+        queue = self._queue(workers=1, capacity=2, policy=DROP_OLDEST)
+        await queue.submit('running')
+        await asyncio.sleep(0)
+        for item in ('old', 'newer', 'newest'):
+            await queue.submit(item)
+
+        self.assertEqual(self.shed, ['old'])
+        self.assertEqual(
+            metrics.get('ingestion_shed_total', policy=DROP_OLDEST), 1)
+
+        self.release.set()
+        await queue.join()
+        self.assertEqual(self.handled, ['running', 'newer', 'newest'])
+
+    async def test_busy_turns_new_items_away(self):
+        queue = self._queue(workers=1, capacity=1, policy=BUSY)
+        await queue.submit('running')
+        await asyncio.sleep(0)
+        await queue.submit('queued')
+        await queue.submit('turned away')
+
+        self.assertEqual(self.shed, ['turned away'])
+
+        self.release.set()
+        await queue.join()
+        self.assertEqual(self.handled, ['running', 'queued'])
+
+    async def test_guilds_take_turns(self):
+        queue = self._queue(workers=1, capacity=10)
+        for item in ('a1', 'a2', 'a3'):
+            await queue.submit(item, key='a')
+        await queue.submit('b1', key='b')
+        await queue.submit('c1', key='c')
+
+        self.release.set()
+        await queue.join()
+        self.assertEqual(self.handled, ['a1', 'b1', 'c1', 'a2', 'a3'])
+
+    async def test_full_queue_drops_from_the_flooding_guild(self):
+        queue = self._queue(workers=1, capacity=3, policy=DROP_OLDEST)
+        await queue.submit('running', key='flood')
+        await asyncio.sleep(0)
+        for item in ('f1', 'f2', 'f3'):
+            await queue.submit(item, key='flood')
+        await queue.submit('quiet', key='quiet')
+
+        self.assertEqual(self.shed, ['f1'])
+        self.release.set()
+        await queue.join()
+        self.assertEqual(self.handled, ['running', 'f2', 'quiet', 'f3'])
+
+    async def test_busy_turns_away_the_flooding_guild(self):
+        queue = self._queue(workers=1, capacity=2, policy=BUSY)
+        await queue.submit('running', key='flood')
+        await asyncio.sleep(0)
+        for item in ('f1', 'f2', 'f3'):
+            await queue.submit(item, key='flood')
+        await queue.submit('quiet', key='quiet')
+
+        self.assertEqual(self.shed, ['f3', 'f2'])
+        self.release.set()
+        await queue.join()
+        self.assertEqual(self.handled, ['running', 'f1', 'quiet'])
+
+    async def test_failing_item_does_not_stop_a_worker(self):
+        async def handle(item):
+            if item == 'bad':
+                raise ValueError('bad item')
+            self.handled.append(item)
+
+        queue = IngestionQueue(handle, self._shed, workers=1)
+        self.addCleanup(queue.stop)
+        await queue.submit('bad')
+        await queue.submit('good')
+        await queue.join()
+
+        self.assertEqual(self.handled, ['good'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            IngestionQueue(self._handle, self._shed, policy='ignore')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from job_store import MAX_ATTEMPTS, JobStore
+
+
+class TestJobStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('job_store').setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'jobs.sqlite3')
+        self.store = JobStore(self.path)
+        self.addCleanup(self.store.close)
+
+    def test_pending_jobs_survive_a_restart(self):
+        self.store.add(2, 20, 200)
+        self.store.add(1, 10, None)
+        self.store.close()
+
+        self.assertEqual(JobStore(self.path).pending(), [(1, 10), (2, 20)])
+
+    def test_a_message_is_queued_once(self):
+        self.assertTrue(self.store.add(1, 10, 100))
+        self.assertFalse(self.store.add(1, 10, 100))
+
+        self.store.finish(1)
+        self.assertFalse(self.store.add(1, 10, 100))
+        self.assertEqual(self.store.pending(), [])
+
+    def test_jobs_failing_too_often_are_given_up(self):
+        self.store.add(1, 10, 100)
+        self.store.add(2, 10, 100)
+        for _ in range(MAX_ATTEMPTS):
+            self.store.start(1)
+
+        self.assertEqual(self.store.pending(), [(2, 10)])
+
+    def test_prune_forgets_finished_jobs(self):
+        self.store.add(1, 10, 100)
+        self.store.add(2, 10, 100)
+        self.store.finish(1)
+
+        self.assertEqual(self.store.prune(retention=-1), 1)
+        self.assertTrue(self.store.add(1, 10, 100))
+        self.assertEqual(self.store.pending(), [(1, 10), (2, 10)])
+
+
+    def test_finished_jobs_are_pruned_as_jobs_finish(self):
+        store = JobStore(self.path, retention=-1, prune_every=2)
+        self.addCleanup(store.close)
+        for message_id in (1, 2, 3):
+            store.add(message_id, 10, 100)
+
+        store.finish(1)
+        self.assertFalse(store.add(1, 10, 100))
+        store.finish(2)
+
+        # the second finish pruned both finished jobs
+        self.assertTrue(store.add(1, 10, 100))
+        self.assertTrue(store.add(2, 10, 100))
+        self.assertEqual(store.pending(), [(1, 10), (2, 10), (3, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,33 @@
+import asyncio
+import os
+import tempfile
 import unittest
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import discord
 
-from main import fetchEmbed, getDescriptionParts, getUserIdFromFooter, setAuthorLink
+import main
+import metrics
+from ingestion import IngestionQueue
+from job_store import JobStore
+from main import (
+    fetchEmbed,
+    getDescriptionParts,
+    getUserIdFromFooter,
+    on_message,
+    setAuthorLink,
+)
+from negative_cache import failed_links
 from object_types import CategorizedLink, link_types
+from platform_registry import parts_cache
+from processed_index import ProcessedIndex
 
 
 class TestMainBot(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
+        parts_cache.clear()
+        failed_links.clear()
         # Create mock message and channel
         self.mock_message = MagicMock()
         self.mock_message.id = 123456789
@@ -35,7 +53,7 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
         link: CategorizedLink = ("https://soundcloud.com/artist/track",
                                  link_types.soundcloud)
 
-        with patch('main.getSoundcloudParts') as mock_get_soundcloud:
+        with patch('soundcloud_utils.getSoundcloudParts') as mock_get_soundcloud:
             mock_get_soundcloud.return_value = {'title': 'Test Track'}
 
             # Act
@@ -50,7 +68,7 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
         link: CategorizedLink = ("https://youtube.com/watch?v=test",
                                  link_types.youtube)
 
-        with patch('main.getYouTubeParts') as mock_get_youtube:
+        with patch('youtube_utils.getYouTubeParts') as mock_get_youtube:
             mock_get_youtube.return_value = {'title': 'Test Video'}
 
             # Act
@@ -65,7 +83,7 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
         link: CategorizedLink = ("https://spotify.com/track/test",
                                  link_types.spotify)
 
-        with patch('main.getSpotifyParts') as mock_get_spotify:
+        with patch('spotify_utils.getSpotifyParts') as mock_get_spotify:
             mock_get_spotify.return_value = {'title': 'Test Song'}
 
             # Act
@@ -80,7 +98,7 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
         link: CategorizedLink = ("https://artist.bandcamp.com/track/test",
                                  link_types.bandcamp)
 
-        with patch('main.getBandcampParts') as mock_get_bandcamp:
+        with patch('bandcamp_utils.getBandcampParts') as mock_get_bandcamp:
             mock_get_bandcamp.return_value = {'title': 'Test Album'}
 
             # Act
@@ -234,13 +252,13 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
         mock_bot.get_emoji.return_value = MagicMock()
 
         with patch('main.bot', mock_bot), \
-             patch('main.getDescriptionParts') as mock_get_parts:
-            mock_get_parts.return_value = {
+             patch('main.resolve_links') as mock_resolve_links:
+            mock_resolve_links.return_value = [{
                 'title': 'Test Track',
                 'embedPlatformType': 'soundcloud',
                 'embedColour': 0xff5500,
                 'description': 'Test Description'
-            }
+            }]
 
             # Act
             result = await fetchEmbed(self.mock_message, isInteraction=True)
@@ -250,6 +268,109 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(result and result.title, 'Test Track')
             self.mock_message.add_reaction.assert_called_once()
 
+    async def test_fetchEmbed_progressive_posts_before_looking_up(self):
+        self.mock_message.content = "https://soundcloud.com/artist/track"
+        self.mock_message.delete = AsyncMock()
+        webhook = MagicMock()
+        webhook.send = AsyncMock()
+        enriched = {'title': 'Test Track', 'embedPlatformType': 'soundcloud',
+                    'Plays': '`1,000`'}
+        sentBeforeLookup = []
+
+        async def resolve(_links):
+            sentBeforeLookup.append(webhook.send.await_count)
+            return [enriched]
+
+        with patch('main.progressiveEmbeds', True), \
+             patch('main.fetchWebhook', AsyncMock(return_value=webhook)), \
+             patch('main.getReferencedUser', AsyncMock(return_value=None)), \
+             patch('main.cachedLinks', AsyncMock(return_value=[None])), \
+             patch('main.resolve_links', side_effect=resolve), \
+             patch('main.edit_batcher') as mock_edit_batcher:
+            await fetchEmbed(self.mock_message)
+            await asyncio.gather(*main._background_tasks)
+
+        self.assertEqual(sentBeforeLookup, [1])
+        sent = webhook.send.call_args
+        self.assertTrue(sent.kwargs['wait'])
+        self.assertEqual(sent.kwargs['embeds'][0].title,
+                         'https://soundcloud.com/artist/track')
+        self.assertEqual(len(sent.kwargs['embeds'][0].fields), 0)
+        mock_edit_batcher.edit.assert_called_once()
+        message, kwargs = mock_edit_batcher.edit.call_args
+        self.assertIs(message[0], webhook.send.return_value)
+        self.assertEqual(kwargs['embeds'][0].fields[0].name, 'Plays')
+        self.assertIsNotNone(kwargs['embeds'][0].footer.icon_url)
+
+    async def test_fetchEmbed_progressive_looks_up_only_partial_links(self):
+        self.mock_message.content = (
+            "https://soundcloud.com/artist/one https://soundcloud.com/artist/two")
+        self.mock_message.delete = AsyncMock()
+        webhook = MagicMock()
+        webhook.send = AsyncMock()
+        complete = {'title': 'One', 'embedPlatformType': 'soundcloud',
+                    'Plays': '`5`'}
+        enriched = {'title': 'Two', 'embedPlatformType': 'soundcloud',
+                    'Plays': '`1,000`'}
+        lookups = []
+
+        async def resolve(links):
+            lookups.append(links)
+            return [enriched]
+
+        with patch('main.progressiveEmbeds', True), \
+             patch('main.fetchWebhook', AsyncMock(return_value=webhook)), \
+             patch('main.getReferencedUser', AsyncMock(return_value=None)), \
+             patch('main.cachedLinks', AsyncMock(return_value=[complete, None])), \
+             patch('main.resolve_links', side_effect=resolve), \
+             patch('main.edit_batcher') as mock_edit_batcher:
+            await fetchEmbed(self.mock_message)
+            await asyncio.gather(*main._background_tasks)
+
+        self.assertEqual(
+            lookups, [[('https://soundcloud.com/artist/two', 'soundcloud')]])
+        sent = webhook.send.call_args
+        self.assertEqual([embed.title for embed in sent.kwargs['embeds']],
+                         ['One', 'https://soundcloud.com/artist/two'])
+        _, kwargs = mock_edit_batcher.edit.call_args
+        self.assertEqual([embed.title for embed in kwargs['embeds']],
+                         ['One', 'Two'])
+        self.assertEqual(kwargs['embeds'][1].fields[0].value, '`1,000`')
+
+    async def test_fetchEmbed_progressive_sends_cached_links_as_they_are(self):
+        self.mock_message.content = "https://soundcloud.com/artist/track"
+        self.mock_message.delete = AsyncMock()
+        webhook = MagicMock()
+        webhook.send = AsyncMock()
+        cached = {'title': 'Test Track', 'embedPlatformType': 'soundcloud'}
+        mock_resolve_links = AsyncMock()
+
+        with patch('main.progressiveEmbeds', True), \
+             patch('main.fetchWebhook', AsyncMock(return_value=webhook)), \
+             patch('main.getReferencedUser', AsyncMock(return_value=None)), \
+             patch('main.cachedLinks', AsyncMock(return_value=[cached])), \
+             patch('main.resolve_links', mock_resolve_links):
+            await fetchEmbed(self.mock_message)
+
+        self.assertFalse(webhook.send.call_args.kwargs['wait'])
+        self.assertEqual(webhook.send.call_args.kwargs['embeds'][0].title,
+                         'Test Track')
+        mock_resolve_links.assert_not_called()
+
+    async def test_fetchEmbed_waits_for_enrichments_by_default(self):
+        self.mock_message.content = "https://soundcloud.com/artist/track"
+        self.mock_message.delete = AsyncMock()
+        webhook = MagicMock()
+        webhook.send = AsyncMock()
+
+        with patch('main.fetchWebhook', AsyncMock(return_value=webhook)), \
+             patch('main.getReferencedUser', AsyncMock(return_value=None)), \
+             patch('main.resolve_links', AsyncMock(return_value=[
+                 {'title': 'Test Track', 'embedPlatformType': 'soundcloud'}])):
+            await fetchEmbed(self.mock_message)
+
+        self.assertFalse(webhook.send.call_args.kwargs['wait'])
+
     async def test_fetchEmbed_no_supported_embeds(self):
         # Arrange
         mock_message = MagicMock()
@@ -267,5 +388,121 @@ class TestMainBot(unittest.IsolatedAsyncioTestCase):
                       str(context.exception))
 
 
+class TestOnMessage(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        metrics.reset()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.job_store = JobStore(os.path.join(directory.name, 'jobs.sqlite3'))
+        self.addCleanup(self.job_store.close)
+        self.handled = []
+        self.release = asyncio.Event()
+        self.queue = IngestionQueue(self._handle, AsyncMock(), workers=1)
+        self.addCleanup(self.queue.stop)
+        for patcher in (
+            patch('main.job_store', self.job_store),
+            patch('main.processed_index', ProcessedIndex()),
+            patch('main.ingestion_queue', self.queue),
+            patch('main.server_whitelist', ['1', '2']),
+            patch('main.bot', MagicMock(user=None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def _handle(self, message):
+        await self.release.wait()
+        self.handled.append(message.id)
+
+    @staticmethod
+    def _message(message_id, guild_id):
+        message = MagicMock()
+        message.id = message_id
+        message.author.bot = False
+        message.guild.id = guild_id
+        message.channel.id = guild_id * 10
+        message.content = "https://soundcloud.com/artist/track"
+        return message
+
+    async def test_queues_a_job_for_a_message_once(self):
+        message = self._message(100, 1)
+
+        await on_message(message)
+        await on_message(message)
+
+        self.assertEqual(self.job_store.pending(), [(100, 10)])
+        self.assertEqual(metrics.get('duplicate_messages_total'), 1)
+        self.release.set()
+        await self.queue.join()
+        self.assertEqual(self.handled, [100])
+
+    async def test_only_queued_messages_touch_the_processed_index(self):
+        index = MagicMock()
+        index.check_and_add.return_value = False
+        noLinks = self._message(101, 1)
+        noLinks.content = "no links here"
+
+        with patch('main.processed_index', index), \
+             patch('main.getReferencedUser', AsyncMock(return_value=None)), \
+             patch('main.embedMessage', AsyncMock()):
+            await on_message(self._message(300, 3))
+            await on_message(noLinks)
+            index.check_and_add.assert_not_called()
+            await on_message(self._message(100, 1))
+
+        index.check_and_add.assert_called_once_with(100)
+
+    async def test_guilds_take_turns_in_the_queue(self):
+        await on_message(self._message(100, 1))
+        await asyncio.sleep(0)
+        for message_id in (101, 102):
+            await on_message(self._message(message_id, 1))
+        await on_message(self._message(200, 2))
+
+        self.release.set()
+        await self.queue.join()
+        self.assertEqual(self.handled, [100, 101, 200, 102])
+
+    async def test_finished_jobs_are_pruned_while_running(self):
+        self.job_store.retention = -1
+        self.job_store.prune_every = 1
+        message = self._message(100, 1)
+        await on_message(message)
+
+        with patch('main.embedMessage', AsyncMock()):
+            await main.handleQueuedMessage(message)
+
+        # the job row is gone, not just finished
+        self.assertTrue(self.job_store.add(100, 10, 1))
+
+
+class TestOnReady(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.bot = MagicMock()
+        self.bot.tree.sync = AsyncMock(return_value=[])
+        for patcher in (
+            patch('main.bot', self.bot),
+            patch('main.jobsReplayed', True),
+            patch('main.commandsSynced', False),
+            patch('builtins.print'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_commands_are_synced_once(self):
+        with patch('main.syncsCommands', True):
+            await main.on_ready()
+            await main.on_ready()
+
+        self.bot.tree.sync.assert_awaited_once()
+
+    async def test_only_the_shard_0_process_syncs_commands(self):
+        with patch('main.syncsCommands', False):
+            await main.on_ready()
+
+        self.bot.tree.sync.assert_not_awaited()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,311 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+import deadlines
+from circuit_breaker import CircuitOpen
+from embed_cache import EmbedCache, merge_volatile
+from negative_cache import NO_DATA, LinkUnavailable, failed_links
+from object_types import link_types
+from platform_registry import (
+    cached_link,
+    get_author_block,
+    get_platform,
+    match_platform,
+    parts_cache,
+    purge_link,
+    resolve_link,
+    resolve_link_async,
+    resolve_links,
+    strip_tracking,
+)
+
+
+class TestPlatformRegistry(unittest.TestCase):
+
+    def setUp(self):
+        parts_cache.clear()
+        failed_links.clear()
+
+    def test_match_platform(self):
+        self.assertEqual(
+            match_platform('https://soundcloud.com/artist/track').name,
+            link_types.soundcloud)
+        self.assertEqual(
+            match_platform('https://youtu.be/dQw4w9WgXcQ').name,
+            link_types.youtube)
+        self.assertEqual(
+            match_platform('https://open.spotify.com/track/abc').name,
+            link_types.spotify)
+        self.assertEqual(
+            match_platform('https://artist.bandcamp.com/album/test').name,
+            link_types.bandcamp)
+        self.assertIsNone(match_platform('https://example.com/track'))
+
+    def test_youtube_video_key_needs_a_video_link(self):
+        youtube = get_platform(link_types.youtube)
+        for url in ('https://www.youtube.com/shorts/dQw4w9WgXcQ',
+                    'https://www.youtube.com/embed/dQw4w9WgXcQ',
+                    'https://www.youtube.com/live/dQw4w9WgXcQ?si=x'):
+            self.assertEqual(youtube.cache_key(url), 'youtube:video:dQw4w9WgXcQ')
+
+        # an 11 character channel or page name is not a video id
+        self.assertEqual(youtube.cache_key('https://www.youtube.com/@abcdefghijk'),
+                         'youtube:https://www.youtube.com/@abcdefghijk')
+        self.assertEqual(
+            youtube.cache_key('https://www.youtube.com/c/abcdefghijk/videos'),
+            'youtube:https://www.youtube.com/c/abcdefghijk/videos')
+
+    def test_cache_key_ignores_tracking_and_host_variants(self):
+        youtube = get_platform(link_types.youtube)
+        self.assertEqual(
+            youtube.cache_key('https://youtu.be/dQw4w9WgXcQ?si=abc'),
+            youtube.cache_key(
+                'https://music.youtube.com/watch?v=dQw4w9WgXcQ&feature=share'))
+
+        spotify = get_platform(link_types.spotify)
+        self.assertEqual(
+            spotify.cache_key('https://open.spotify.com/track/abc?si=123'),
+            'spotify:track:abc')
+
+    def test_strip_tracking(self):
+        self.assertEqual(
+            strip_tracking(
+                'https://Artist.bandcamp.com/track/test/?utm_source=x#top'),
+            'https://artist.bandcamp.com/track/test')
+
+    def test_get_author_block_defaults_to_bandcamp(self):
+        self.assertEqual(get_author_block('youtubemusic')['name'],
+                         'YouTube Music')
+        self.assertEqual(get_author_block(None)['name'], 'Bandcamp')
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_caches_complete_parts(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        self.assertEqual(resolve_link(link), {'title': 'Test Track'})
+        self.assertEqual(resolve_link(link), {'title': 'Test Track'})
+        mock_get_parts.assert_called_once_with(link[0])
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_remembers_incomplete_lookups(self, mock_get_parts):
+        mock_get_parts.return_value = {
+            'embedPlatformType': 'soundcloud', NO_DATA: True}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+        key = get_platform(link_types.soundcloud).cache_key(link[0])
+
+        self.assertEqual(resolve_link(link), {'embedPlatformType': 'soundcloud'})
+        self.assertEqual(resolve_link(link), {'embedPlatformType': 'soundcloud'})
+        mock_get_parts.assert_called_once()
+        self.assertIsNone(parts_cache.get(key))
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_retries_bare_parts_after_errors(self, mock_get_parts):
+        # bare parts without NO_DATA come from a resolver that hit an error
+        mock_get_parts.return_value = {'embedPlatformType': 'soundcloud'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        resolve_link(link)
+        resolve_link(link)
+        self.assertEqual(mock_get_parts.call_count, 2)
+
+    @patch('spotify_utils.spotify_client.song_info')
+    def test_open_circuit_is_not_remembered(self, mock_song_info):
+        mock_song_info.side_effect = CircuitOpen('spotify')
+        link = ('https://open.spotify.com/track/abc', link_types.spotify)
+
+        self.assertNotIn('title', resolve_link(link))
+        resolve_link(link)
+        self.assertEqual(mock_song_info.call_count, 2)
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_remembers_dead_links(self, mock_get_parts):
+        mock_get_parts.side_effect = LinkUnavailable('not_found', 'Gone')
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        for _ in range(2):
+            with self.assertRaises(LinkUnavailable):
+                resolve_link(link)
+        mock_get_parts.assert_called_once()
+
+        self.assertTrue(purge_link(link[0]))
+        with self.assertRaises(LinkUnavailable):
+            resolve_link(link)
+        self.assertEqual(mock_get_parts.call_count, 2)
+
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_retries_transient_failures(self, mock_get_parts):
+        mock_get_parts.side_effect = TimeoutError('timed out')
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        for _ in range(2):
+            with self.assertRaises(TimeoutError):
+                resolve_link(link)
+        self.assertEqual(mock_get_parts.call_count, 2)
+
+    @patch('soundcloud_utils.refreshVolatileParts')
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_refreshes_only_volatile_fields(
+            self, mock_get_parts, mock_refresh):
+        mock_get_parts.return_value = {
+            'title': 'Test Track',
+            'Likes': ':orange_heart: 1',
+            'Plays': ':notes: 2',
+            'Tags': '`tag`',
+            'refreshSource': {'trackId': 1},
+        }
+        mock_refresh.return_value = {'Likes': ':orange_heart: 5',
+                                     'Plays': ':notes: 9'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+        key = get_platform(link_types.soundcloud).cache_key(link[0])
+
+        resolve_link(link)
+        # expire the volatile part only
+        parts_cache.set(key, parts_cache.get(key), 60, volatile_ttl=0)
+        result = resolve_link(link)
+
+        mock_get_parts.assert_called_once()
+        mock_refresh.assert_called_once_with({'trackId': 1})
+        self.assertEqual(list(result),
+                         ['title', 'Likes', 'Plays', 'Tags', 'refreshSource'])
+        self.assertEqual(result['Plays'], ':notes: 9')
+        self.assertEqual(parts_cache.get(key)['Plays'], ':notes: 9')
+
+    @patch('soundcloud_utils.refreshVolatileParts')
+    @patch('soundcloud_utils.getSoundcloudParts')
+    def test_resolve_link_resolves_again_when_refresh_fails(
+            self, mock_get_parts, mock_refresh):
+        mock_get_parts.return_value = {'title': 'Test Track',
+                                       'Likes': ':orange_heart: 1',
+                                       'refreshSource': {'trackId': 1}}
+        mock_refresh.return_value = None
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+        key = get_platform(link_types.soundcloud).cache_key(link[0])
+
+        resolve_link(link)
+        parts_cache.set(key, parts_cache.get(key), 60, volatile_ttl=0)
+        resolve_link(link)
+
+        self.assertEqual(mock_get_parts.call_count, 2)
+
+    def test_entry_ttls(self):
+        soundcloud = get_platform(link_types.soundcloud)
+        self.assertEqual(
+            soundcloud.entry_ttls({'Likes': '', 'refreshSource': {'trackId': 1}}),
+            (soundcloud.cache_ttl, soundcloud.volatile_ttl))
+        # playlists cannot be refreshed on their own
+        self.assertEqual(soundcloud.entry_ttls({'Likes': ''}),
+                         (soundcloud.volatile_ttl, None))
+        self.assertEqual(soundcloud.entry_ttls({'title': ''}),
+                         (soundcloud.cache_ttl, None))
+
+
+class TestEmbedCache(unittest.TestCase):
+
+    def test_volatile_expiry_keeps_stable_part(self):
+        cache = EmbedCache()
+        cache.set('key', {'title': 'Test'}, 60, volatile_ttl=0)
+
+        self.assertIsNone(cache.get('key'))
+        cached = cache.lookup('key')
+        self.assertEqual(cached.parts, {'title': 'Test'})
+        self.assertFalse(cached.stale)
+        self.assertTrue(cached.volatile_stale)
+
+    def test_expired_entries_are_kept_for_max_stale(self):
+        cache = EmbedCache()
+        cache.set('stale', {'title': 'Test'}, 0, max_stale=60)
+        cache.set('gone', {'title': 'Test'}, 0)
+
+        self.assertIsNone(cache.get('stale'))
+        self.assertTrue(cache.lookup('stale').servable)
+        self.assertIsNone(cache.lookup('gone'))
+
+    def test_merge_volatile_keeps_field_order(self):
+        parts = {'title': 'Test', 'Price': '`$1.00`',
+                 'Releases on': '1 January 2030', 'Artist': 'Test Artist'}
+
+        merged = merge_volatile(parts, {'Released on': '1 January 2030'},
+                                ('Price', 'Releases on', 'Released on'))
+
+        self.assertEqual(list(merged), ['title', 'Released on', 'Artist'])
+
+
+class TestResolveLinks(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        parts_cache.clear()
+        failed_links.clear()
+
+    @patch('bandcamp_utils.getBandcampPartsAsync')
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_resolve_links_keeps_order(self, mock_soundcloud,
+                                             mock_bandcamp):
+        mock_soundcloud.return_value = {'title': 'SoundCloud Track'}
+        mock_bandcamp.return_value = {'title': 'Bandcamp Track'}
+
+        result = await resolve_links([
+            ('https://artist.bandcamp.com/track/test', link_types.bandcamp),
+            ('https://soundcloud.com/artist/track', link_types.soundcloud),
+            ('https://bandcamp.com/tag/test', link_types.bandcamp),
+        ])
+
+        self.assertEqual(result, [{'title': 'Bandcamp Track'},
+                                  {'title': 'SoundCloud Track'}, None])
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_stale_parts_are_served_and_revalidated(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'New Title'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+        key = get_platform(link_types.soundcloud).cache_key(link[0])
+        parts_cache.set(key, {'title': 'Old Title'}, 0, max_stale=60)
+
+        result = await resolve_link_async(link)
+        self.assertEqual(result, {'title': 'Old Title'})
+
+        # let the background revalidation finish
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        mock_get_parts.assert_called_once_with(link[0])
+        self.assertEqual(parts_cache.get(key), {'title': 'New Title'})
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_concurrent_misses_share_one_lookup(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        result = await asyncio.gather(resolve_link_async(link),
+                                      resolve_link_async(link))
+
+        self.assertEqual(result, [{'title': 'Test Track'}] * 2)
+        mock_get_parts.assert_called_once()
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_cached_link_never_looks_up(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        self.assertIsNone(cached_link(link))
+        await resolve_link_async(link)
+        self.assertEqual(cached_link(link), {'title': 'Test Track'})
+        mock_get_parts.assert_called_once()
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_partial_parts_are_not_cached(self, mock_get_parts):
+        async def get_parts(_url):
+            deadlines.allows('soundcloud fallback')
+            return {'title': 'Test Track'}
+
+        mock_get_parts.side_effect = get_parts
+        link = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+        with deadlines.budget(0):
+            result = await resolve_link_async(link)
+
+        self.assertEqual(result, {'title': 'Test Track'})
+        self.assertEqual(len(parts_cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
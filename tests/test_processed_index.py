@@ -0,0 +1,75 @@
+import logging
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from processed_index import ProcessedIndex
+
+
+class TestProcessedIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('processed_index').setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'processed_index.bin')
+
+    def test_check_and_add(self):
+        index = ProcessedIndex(bits=1 << 16)
+
+        self.assertFalse(index.check_and_add(1234567890123456789))
+        self.assertTrue(index.check_and_add(1234567890123456789))
+        self.assertFalse(index.seen(1234567890123456790))
+
+    def test_ids_outlive_the_ring(self):
+        index = ProcessedIndex(ring_size=2, bits=1 << 16)
+        for message_id in range(10):
+            index.add(message_id)
+
+        self.assertEqual(len(index._ring), 2)
+        self.assertTrue(all(index.seen(message_id) for message_id in range(10)))
+
+    def test_index_survives_a_restart(self):
+        index = ProcessedIndex(self.path, bits=1 << 16)
+        index.add(42)
+        index.save()
+
+        self.assertTrue(ProcessedIndex(self.path, bits=1 << 16).seen(42))
+        # saved with another size, started afresh
+        self.assertFalse(ProcessedIndex(self.path, bits=1 << 17).seen(42))
+
+    def test_concurrent_checks_record_an_id_once(self):
+        index = ProcessedIndex(bits=1 << 16)
+
+        with ThreadPoolExecutor(8) as executor:
+            first = list(executor.map(index.check_and_add, [42] * 64))
+
+        self.assertEqual(first.count(False), 1)
+
+    def test_saves_when_due(self):
+        index = ProcessedIndex(self.path, bits=1 << 16)
+
+        with patch('processed_index.SAVE_INTERVAL_SECONDS', 0):
+            index.check_and_add(42)
+
+        self.assertTrue(ProcessedIndex(self.path, bits=1 << 16).seen(42))
+
+    def test_ids_expire_after_two_generations(self):
+        index = ProcessedIndex(ring_size=0, bits=1 << 16, generation_seconds=10)
+        index.add(42)
+        now = time.time()
+
+        with patch('processed_index.time.time', return_value=now + 15):
+            self.assertTrue(index.seen(42))
+        with patch('processed_index.time.time', return_value=now + 30):
+            self.assertFalse(index.seen(42))
+
+
+if __name__ == '__main__':
+    unittest.main()
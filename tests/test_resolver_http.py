@@ -0,0 +1,109 @@
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from negative_cache import LinkUnavailable, failed_links
+from platform_registry import parts_cache
+from resolver_http import create_app
+
+TRACK = 'https://soundcloud.com/artist/track'
+
+
+class TestResolverHttp(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('resolver_http').setLevel(logging.CRITICAL)
+        logging.getLogger('platform_registry').setLevel(logging.CRITICAL)
+
+    async def asyncSetUp(self):
+        parts_cache.clear()
+        failed_links.clear()
+        self.client = TestClient(TestServer(create_app()))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_resolve_one(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+
+        response = await self.client.get('/resolve', params={'url': TRACK + '?si=x'})
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(),
+                         {'url': TRACK + '?si=x', 'parts': {'title': 'Test Track'}})
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_internal_keys_are_left_out(self, mock_get_parts):
+        mock_get_parts.return_value = {
+            'title': 'Test Track',
+            'embedPlatformType': 'soundcloud',
+            'Plays': '`1,000`',
+            'refreshSource': {'trackId': 1},
+            'noData': False,
+        }
+
+        parts = {
+            'title': 'Test Track',
+            'embedPlatformType': 'soundcloud',
+            'Plays': '`1,000`',
+        }
+
+        response = await self.client.get('/resolve', params={'url': TRACK})
+        self.assertEqual(await response.json(), {'url': TRACK, 'parts': parts})
+
+        # the second lookup is served from the cache
+        response = await self.client.post('/resolve', json={'urls': [TRACK]})
+        self.assertEqual(json.loads(await response.text()),
+                         {'url': TRACK, 'parts': parts, 'status': 200})
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_unavailable_link(self, mock_get_parts):
+        mock_get_parts.side_effect = LinkUnavailable('private', 'Private track')
+
+        response = await self.client.get('/resolve', params={'url': TRACK})
+
+        self.assertEqual(response.status, 403)
+        self.assertEqual((await response.json())['error'],
+                         {'message': 'Private track', 'reason': 'private'})
+
+    async def test_unsupported_link(self):
+        response = await self.client.get(
+            '/resolve', params={'url': 'https://example.com/song'})
+        self.assertEqual(response.status, 422)
+
+        response = await self.client.get('/resolve')
+        self.assertEqual(response.status, 400)
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_batch_streams_json_lines(self, mock_get_parts):
+        async def get_parts(url):
+            if url.endswith('gone'):
+                raise LinkUnavailable('not_found', 'Gone')
+            return {'title': url.rsplit('/', 1)[-1]}
+
+        mock_get_parts.side_effect = get_parts
+        urls = [TRACK, 'https://soundcloud.com/artist/gone', 'not a link']
+
+        response = await self.client.post('/resolve', json={'urls': urls})
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        by_url = {line['url']: line for line in lines}
+        self.assertEqual(by_url[TRACK]['parts'], {'title': 'track'})
+        self.assertEqual(by_url[urls[1]]['status'], 404)
+        self.assertEqual(by_url[urls[2]]['status'], 422)
+
+    async def test_bad_batch(self):
+        response = await self.client.post('/resolve', json={'urls': 'one'})
+        self.assertEqual(response.status, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import deadlines
+import metrics
+from negative_cache import LinkUnavailable, failed_links
+from object_types import link_types
+from platform_registry import parts_cache
+from resolver_tier import ResolverClient, ResolverError, ResolverServer
+
+LINK = ('https://soundcloud.com/artist/track', link_types.soundcloud)
+
+
+class TestResolverTier(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('platform_registry').setLevel(logging.CRITICAL)
+
+    async def asyncSetUp(self):
+        parts_cache.clear()
+        failed_links.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'resolver.sock')
+        self.server = ResolverServer(path)
+        await self.server.start()
+        self.client = ResolverClient(path)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_shards_share_the_cache(self, mock_get_parts):
+        mock_get_parts.return_value = {'title': 'Test Track'}
+        other_shard = ResolverClient(self.server.path)
+        self.addAsyncCleanup(other_shard.close)
+
+        self.assertEqual(await self.client.resolve_links([LINK]),
+                         [{'title': 'Test Track'}])
+        self.assertEqual(await other_shard.resolve_link(LINK),
+                         {'title': 'Test Track'})
+        self.assertEqual(await other_shard.cached_link(LINK),
+                         {'title': 'Test Track'})
+        mock_get_parts.assert_called_once()
+
+        self.assertTrue(await self.client.purge_link(LINK[0]))
+        self.assertIsNone(await other_shard.cached_link(LINK))
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_deadline_and_drops_travel_with_the_lookup(self, mock_get_parts):
+        async def get_parts(_url):
+            deadlines.allows('soundcloud fallback')
+            return {'title': 'Test Track'}
+
+        mock_get_parts.side_effect = get_parts
+
+        with deadlines.budget(0) as budget:
+            await self.client.resolve_link(LINK)
+
+        self.assertEqual(budget.dropped, ['soundcloud fallback'])
+
+    @patch('soundcloud_utils.getSoundcloudPartsAsync')
+    async def test_errors_are_raised_on_the_shard(self, mock_get_parts):
+        mock_get_parts.side_effect = LinkUnavailable('not_found', 'Gone')
+        with self.assertRaises(LinkUnavailable) as context:
+            await self.client.resolve_link(LINK)
+        self.assertEqual(context.exception.reason, 'not_found')
+
+        mock_get_parts.side_effect = ValueError('Broken page')
+        other = ('https://soundcloud.com/artist/other', link_types.soundcloud)
+        with self.assertRaises(ResolverError):
+            await self.client.resolve_link(other)
+
+    async def test_reconnects_after_the_connection_breaks(self):
+        self.assertIsNone(await self.client.cached_link(LINK))
+        self.client._writer.transport.abort()
+
+        self.assertIsNone(await self.client.cached_link(LINK))
+
+    async def test_unreachable_tier(self):
+        client = ResolverClient(self.server.path + '.missing')
+        with self.assertRaises(OSError):
+            await client.cached_link(LINK)
+
+    async def test_shards_read_the_tier_metrics(self):
+        metrics.reset()
+        metrics.increment('parts_cache_hits_total', platform='soundcloud')
+
+        rendered = await self.client.metrics()
+
+        self.assertIn('parts_cache_hits_total{platform="soundcloud"} 1', rendered)
+
+    async def test_closing_the_server_ends_shard_connections(self):
+        self.assertIsNone(await self.client.cached_link(LINK))
+
+        await self.server.close()
+
+        with self.assertRaises((ResolverError, OSError)):
+            await self.client.cached_link(LINK)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import unittest
+
+import metrics
+from scheduler import (
+    INTERACTIVE,
+    PASSIVE,
+    PriorityScheduler,
+    SchedulerOverloaded,
+)
+
+
+class TestPriorityScheduler(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('scheduler').setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        metrics.reset()
+
+    async def _job(self, scheduler, job_class, started, release):
+        async with scheduler.slot(job_class):
+            started.append(job_class)
+            await release.wait()
+
+    async def _job_in(self, scheduler, guild, started, release):
+        async with scheduler.slot(PASSIVE, guild):
+            started.append(guild)
+            await release.wait()
+
+    async def test_interactive_jobs_start_first(self):
+        scheduler = PriorityScheduler(concurrency=1, interactive_reserve=0)
+        started, release = [], asyncio.Event()
+        blocker = asyncio.ensure_future(
+            self._job(scheduler, PASSIVE, started, release))
+        await asyncio.sleep(0)
+
+        jobs = [asyncio.ensure_future(self._job(scheduler, job_class, [], release))
+                for job_class in (PASSIVE, PASSIVE, INTERACTIVE)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.depth(PASSIVE), 2)
+        self.assertEqual(scheduler.depth(INTERACTIVE), 1)
+
+        order = []
+        for job in jobs:
+            job.add_done_callback(lambda _, job=job: order.append(jobs.index(job)))
+        release.set()
+        await asyncio.gather(blocker, *jobs)
+
+        self.assertEqual(order[0], 2)
+        self.assertEqual(
+            metrics.get('scheduler_queue_depth', job_class=PASSIVE), 0)
+
+    async def test_reserved_slots_are_kept_for_interactions(self):
+        scheduler = PriorityScheduler(concurrency=2, interactive_reserve=1)
+        started, release = [], asyncio.Event()
+        jobs = [asyncio.ensure_future(self._job(scheduler, PASSIVE, started, release))
+                for _ in range(2)]
+        await asyncio.sleep(0)
+        self.assertEqual(started, [PASSIVE])
+
+        interaction = asyncio.ensure_future(
+            self._job(scheduler, INTERACTIVE, started, release))
+        await asyncio.sleep(0)
+        self.assertEqual(started, [PASSIVE, INTERACTIVE])
+
+        release.set()
+        await asyncio.gather(interaction, *jobs)
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_passive_jobs_are_shed_when_the_queue_is_deep(self):
+        scheduler = PriorityScheduler(
+            concurrency=1, interactive_reserve=0, max_passive_queue=1)
+        release = asyncio.Event()
+        jobs = [asyncio.ensure_future(self._job(scheduler, PASSIVE, [], release))
+                for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with self.assertRaises(SchedulerOverloaded):
+            async with scheduler.slot(PASSIVE):
+                pass
+        self.assertEqual(
+            metrics.get('scheduler_shed_total', job_class=PASSIVE), 1)
+
+        release.set()
+        await asyncio.gather(*jobs)
+
+    async def test_passive_jobs_waiting_too_long_are_shed(self):
+        scheduler = PriorityScheduler(
+            concurrency=1, interactive_reserve=0, max_passive_wait=0.01)
+        release = asyncio.Event()
+        blocker = asyncio.ensure_future(self._job(scheduler, PASSIVE, [], release))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(SchedulerOverloaded):
+            async with scheduler.slot(PASSIVE):
+                pass
+        self.assertEqual(scheduler.depth(PASSIVE), 0)
+
+        release.set()
+        await blocker
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_guilds_take_turns(self):
+        scheduler = PriorityScheduler(concurrency=1, interactive_reserve=0)
+        started, release = [], asyncio.Event()
+        blocker = asyncio.ensure_future(
+            self._job(scheduler, PASSIVE, [], release))
+        await asyncio.sleep(0)
+
+        async def job(guild):
+            async with scheduler.slot(PASSIVE, guild):
+                started.append(guild)
+
+        jobs = [asyncio.ensure_future(job('noisy')) for _ in range(4)]
+        jobs.append(asyncio.ensure_future(job('quiet')))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.depth(PASSIVE, 'noisy'), 4)
+        self.assertEqual(
+            metrics.get('scheduler_guild_queue_depth', guild='noisy'), 4)
+
+        release.set()
+        await asyncio.gather(blocker, *jobs)
+
+        self.assertEqual(started, ['noisy', 'quiet', 'noisy', 'noisy', 'noisy'])
+
+    async def test_weights_share_capacity(self):
+        scheduler = PriorityScheduler(concurrency=1, interactive_reserve=0)
+        scheduler.configure_guild('heavy', weight=2)
+        started, release = [], asyncio.Event()
+        blocker = asyncio.ensure_future(
+            self._job(scheduler, PASSIVE, [], release))
+        await asyncio.sleep(0)
+
+        async def job(guild):
+            async with scheduler.slot(PASSIVE, guild):
+                started.append(guild)
+
+        jobs = [asyncio.ensure_future(job(guild))
+                for guild in ['light'] * 3 + ['heavy'] * 6]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *jobs)
+
+        self.assertEqual(started[:6].count('heavy'), 4)
+
+    async def test_guild_concurrency_cap(self):
+        scheduler = PriorityScheduler(concurrency=4, interactive_reserve=0)
+        scheduler.configure_guild('capped', max_concurrency=1)
+        started, release = [], asyncio.Event()
+        jobs = [asyncio.ensure_future(
+                    self._job_in(scheduler, guild, started, release))
+                for guild in ('capped', 'capped', 'other')]
+        await asyncio.sleep(0)
+
+        self.assertEqual(started, ['capped', 'other'])
+        self.assertEqual(scheduler.depth(PASSIVE, 'capped'), 1)
+
+        release.set()
+        await asyncio.gather(*jobs)
+        self.assertEqual(started, ['capped', 'other', 'capped'])
+
+    async def test_noisy_guild_is_shed_alone(self):
+        scheduler = PriorityScheduler(
+            concurrency=1, interactive_reserve=0, max_guild_queue=1)
+        release = asyncio.Event()
+        jobs = [asyncio.ensure_future(
+                    self._job_in(scheduler, 'noisy', [], release))
+                for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with self.assertRaises(SchedulerOverloaded):
+            async with scheduler.slot(PASSIVE, 'noisy'):
+                pass
+        jobs.append(asyncio.ensure_future(
+            self._job_in(scheduler, 'quiet', [], release)))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.depth(PASSIVE, 'quiet'), 1)
+
+        release.set()
+        await asyncio.gather(*jobs)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        scheduler = PriorityScheduler(concurrency=1, interactive_reserve=0)
+        release = asyncio.Event()
+        blocker = asyncio.ensure_future(self._job(scheduler, PASSIVE, [], release))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(self._job(scheduler, INTERACTIVE, [], release))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(scheduler.depth(INTERACTIVE), 0)
+
+        release.set()
+        await blocker
+        self.assertEqual(scheduler.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
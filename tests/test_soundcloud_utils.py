@@ -1,8 +1,9 @@
 # test_soundcloud_utils.py
 import unittest
 from urllib.error import HTTPError
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import requests
 from mockData.soundcloud_mock_scenarios import (
     setupBasicAlbum,
     setupBasicPlaylist,
@@ -13,15 +14,48 @@ from mockData.soundcloud_mock_scenarios import (
 )
 from sclib import Track
 
+from async_http import REQUEST_TIMEOUT_SECONDS
 from soundcloud_utils import (
+    SoundcloudAPI,
     YtDlpTrack,
     fetchTrack,
+    fetchTrackAsync,
+    fetchTracksAsync,
     fetchTrackWithYtDlp,
     getSoundcloudParts,
+    refreshVolatileParts,
+    resolved_track_ids,
+    soundcloud_breaker,
     split_tags,
 )
 
 
+def _track_obj(track_id, title='Artist - Song'):
+    return {
+        'id': track_id,
+        'kind': 'track',
+        'title': title,
+        'duration': 1000,
+        'permalink_url': f'https://soundcloud.com/artist/{track_id}',
+        'user': {'username': 'Artist'},
+    }
+
+
+def _json_response(payload):
+    response = MagicMock()
+    response.status_code = 200
+    response.json.return_value = payload
+    return response
+
+
+def _error_response(status_code):
+    response = MagicMock()
+    response.status_code = status_code
+    response.raise_for_status.side_effect = requests.HTTPError(
+        f'{status_code} Error', response=response)
+    return response
+
+
 class TestSoundcloudUtils(unittest.TestCase):
 
     def test_split_tags(self):
@@ -60,8 +94,10 @@ class TestSoundcloudUtils(unittest.TestCase):
         if isinstance(result, Track):
             self.assertEqual(result.artist, 'Mock Artist')
             self.assertEqual(result.title, 'Mock Track Title')
-            mock_requests_get.assert_called_once_with(mock_track_url,
-                                                      allow_redirects=True)
+            mock_requests_get.assert_called_once_with(
+                mock_track_url,
+                allow_redirects=True,
+                timeout=REQUEST_TIMEOUT_SECONDS)
             mock_soundcloud_api.return_value.resolve.assert_called_once_with(
                 'https://soundcloud.com/resolved-url')
         else:
@@ -130,8 +166,10 @@ class TestSoundcloudUtils(unittest.TestCase):
             fetchTrack(mock_track_url)
         self.assertEqual(str(e.exception),
                          "Unable to fetch Soundcloud Mobile URL")
-        mock_requests_get.assert_called_once_with(mock_track_url,
-                                                  allow_redirects=True)
+        mock_requests_get.assert_called_once_with(
+            mock_track_url,
+            allow_redirects=True,
+            timeout=REQUEST_TIMEOUT_SECONDS)
         mock_soundcloud_api.return_value.resolve.assert_not_called()
 
     def test_ytdlp_track_initialization(self):
@@ -213,6 +251,47 @@ class TestSoundcloudUtils(unittest.TestCase):
         mock_ytdlp_fallback.assert_called_once_with(
             'https://soundcloud.com/artist/track')
 
+    @patch('soundcloud_utils.fetchTrackWithYtDlp', return_value=None)
+    @patch('soundcloud_utils.requests.get')
+    def test_fetchTrack_keeps_the_client_id_for_a_missing_track(
+            self, mock_requests_get, _mock_ytdlp_fallback):
+        SoundcloudAPI.shared_client_id = 'client-id'
+        self.addCleanup(setattr, SoundcloudAPI, 'shared_client_id', None)
+        mock_requests_get.return_value = _error_response(404)
+
+        with self.assertRaises(requests.HTTPError):
+            fetchTrack('https://soundcloud.com/artist/deleted')
+
+        self.assertEqual(SoundcloudAPI.shared_client_id, 'client-id')
+
+    @patch('soundcloud_utils.fetchTrackWithYtDlp', return_value=None)
+    @patch('soundcloud_utils.requests.get')
+    def test_fetchTrack_forgets_a_rejected_client_id(
+            self, mock_requests_get, _mock_ytdlp_fallback):
+        SoundcloudAPI.shared_client_id = 'client-id'
+        self.addCleanup(setattr, SoundcloudAPI, 'shared_client_id', None)
+        mock_requests_get.return_value = _error_response(401)
+
+        with self.assertRaises(requests.HTTPError):
+            fetchTrack('https://soundcloud.com/artist/track')
+
+        self.assertIsNone(SoundcloudAPI.shared_client_id)
+
+    @patch('soundcloud_utils.fetchTrackWithYtDlp')
+    @patch('soundcloud_utils.requests.get')
+    def test_fetchTrack_skips_soundcloud_while_circuit_is_open(
+            self, mock_requests_get, mock_ytdlp_fallback):
+        SoundcloudAPI.shared_client_id = 'client-id'
+        mock_ytdlp_fallback.return_value = YtDlpTrack({'title': 'Fallback'})
+        with patch.object(soundcloud_breaker, 'allow', return_value=False):
+            result = fetchTrack('https://soundcloud.com/artist/track')
+
+        self.assertEqual(result.title, 'Fallback')
+        mock_requests_get.assert_not_called()
+        # the client id still works, it was never tried
+        self.assertEqual(SoundcloudAPI.shared_client_id, 'client-id')
+        SoundcloudAPI.shared_client_id = None
+
     @patch('soundcloud_utils.fetchTrack')
     def test_getSoundcloudParts_with_ytdlp_track(self, mock_fetch_track):
         mock_track = YtDlpTrack({
@@ -264,7 +343,8 @@ class TestSoundcloudUtils(unittest.TestCase):
             'Channel': '[Mock Artist](https://soundcloud.com/mockartist)',
             'Likes': ':orange_heart: 123',
             'thumbnailUrl': 'https://example.com/track-artwork.jpg',
-            'Plays': ':notes: 456'
+            'Plays': ':notes: 456',
+            'refreshSource': {'trackId': 123456789}
         }
         self.assertEqual(result, expected_parts)
 
@@ -560,3 +640,145 @@ class TestSoundcloudUtils(unittest.TestCase):
         # Assert
         self.assertEqual(result['thumbnailUrl'],
                          'https://example.com/track-artwork.jpg')
+
+
+class TestSoundcloudBatching(unittest.TestCase):
+
+    def setUp(self):
+        resolved_track_ids.clear()
+        SoundcloudAPI.shared_client_id = 'client-id'
+
+    def tearDown(self):
+        SoundcloudAPI.shared_client_id = None
+
+    @patch('soundcloud_utils.requests.get')
+    def test_hydrate_tracks_uses_50_ids_per_request(self, mock_requests_get):
+        mock_requests_get.side_effect = [
+            _json_response([_track_obj(i) for i in range(50)]),
+            _json_response([_track_obj(i) for i in range(50, 60)]),
+        ]
+
+        tracks = SoundcloudAPI().hydrate_tracks(list(range(60)))
+
+        self.assertEqual(mock_requests_get.call_count, 2)
+        self.assertEqual(len(tracks), 60)
+
+    @patch('soundcloud_utils.requests.get')
+    def test_resolve_playlist_hydrates_stubs_when_read(self, mock_requests_get):
+        playlist = {
+            'id': 99,
+            'kind': 'playlist',
+            'title': 'Set',
+            'tracks': [_track_obj(1), {'id': 2}, {'id': 3}, {'id': 4}],
+        }
+        mock_requests_get.side_effect = [
+            _json_response(playlist),
+            _json_response([_track_obj(3), _track_obj(2)]),
+        ]
+
+        result = SoundcloudAPI().resolve('https://soundcloud.com/artist/sets/set')
+        self.assertEqual(mock_requests_get.call_count, 1)
+
+        # track 4 was deleted and is dropped from the set
+        self.assertEqual([track.id for track in result.tracks], [1, 2, 3])
+        self.assertEqual(mock_requests_get.call_count, 2)
+        self.assertEqual(
+            mock_requests_get.call_args.kwargs['params']['ids'], '2,3,4')
+
+    @patch('soundcloud_utils.requests.get')
+    def test_large_album_only_hydrates_displayed_tracks(
+            self, mock_requests_get):
+        album = {
+            'id': 99,
+            'kind': 'playlist',
+            'title': 'Big Album',
+            'is_album': True,
+            'track_count': 500,
+            'duration': 500 * 1000,
+            'artwork_url': 'https://example.com/large.jpg',
+            'likes_count': 1,
+            'tag_list': '',
+            'user': {'username': 'Artist',
+                     'permalink_url': 'https://soundcloud.com/artist'},
+            'tracks': [_track_obj(1)] + [{'id': i} for i in range(2, 501)],
+        }
+
+        def respond(_url, params, timeout):
+            if 'ids' not in params:
+                return _json_response(album)
+            return _json_response(
+                [_track_obj(int(i)) for i in params['ids'].split(',')])
+        mock_requests_get.side_effect = respond
+
+        result = getSoundcloudParts('https://soundcloud.com/artist/sets/big')
+
+        self.assertEqual(result['description'], '500 track album')
+        self.assertIn('more', result['Tracks'])
+        # one resolve plus a single page of stubs
+        self.assertEqual(mock_requests_get.call_count, 2)
+
+    @patch('soundcloud_utils.requests.get')
+    def test_refreshVolatileParts_reads_only_the_track_json(
+            self, mock_requests_get):
+        track = _track_obj(1)
+        track.update({'likes_count': 7, 'playback_count': 1234})
+        mock_requests_get.return_value = _json_response([track])
+
+        result = refreshVolatileParts({'trackId': 1})
+
+        self.assertEqual(result, {'Likes': ':orange_heart: 7',
+                                  'Plays': ':notes: 1,234'})
+        self.assertEqual(mock_requests_get.call_args.args[0],
+                         'https://api-v2.soundcloud.com/tracks')
+
+    @patch('soundcloud_utils.requests.get')
+    def test_refreshVolatileParts_returns_none_for_deleted_track(
+            self, mock_requests_get):
+        mock_requests_get.return_value = _json_response([])
+
+        self.assertIsNone(refreshVolatileParts({'trackId': 1}))
+
+
+class TestSoundcloudAsync(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        resolved_track_ids.clear()
+        SoundcloudAPI.shared_client_id = 'client-id'
+
+    def tearDown(self):
+        SoundcloudAPI.shared_client_id = None
+
+    @patch('soundcloud_utils.async_http.get', new_callable=AsyncMock)
+    async def test_fetchTrackAsync_follows_short_links(self, mock_get):
+        short_link = MagicMock()
+        short_link.status_code = 200
+        short_link.history = [MagicMock(
+            headers={'location': 'https://soundcloud.com/artist/one'})]
+        mock_get.side_effect = [short_link, _json_response(_track_obj(1))]
+
+        track = await fetchTrackAsync('https://on.soundcloud.com/abc')
+
+        self.assertEqual(track.id, 1)
+        self.assertEqual(mock_get.call_args.kwargs['params']['url'],
+                         'https://soundcloud.com/artist/one')
+        self.assertEqual(resolved_track_ids.get('https://on.soundcloud.com/abc'),
+                         {'id': 1})
+
+    @patch('soundcloud_utils.async_http.get', new_callable=AsyncMock)
+    async def test_fetchTracksAsync_hydrates_known_ids_in_one_request(
+            self, mock_get):
+        urls = ['https://soundcloud.com/artist/one',
+                'https://soundcloud.com/artist/two']
+        resolved_track_ids.set(urls[0], {'id': 1}, 60)
+        mock_get.side_effect = [
+            _json_response([_track_obj(1)]),
+            _json_response(_track_obj(2)),
+        ]
+
+        result = await fetchTracksAsync(urls)
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_get.call_args_list[0].kwargs['params']['ids'],
+                         '1')
+        self.assertEqual(result[urls[0]].id, 1)
+        self.assertEqual(result[urls[1]].id, 2)
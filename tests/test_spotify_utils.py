@@ -1,8 +1,18 @@
+import asyncio
 import logging
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
-from spotify_utils import getSpotifyParts
+import deadlines
+from batching import WindowBatcher
+from spotify_utils import (
+    SpotifyClient,
+    fetch_track_infos,
+    getSpotifyParts,
+    getSpotifyPartsAsync,
+)
 
 
 def _make_track_response(
@@ -129,7 +139,7 @@ class TestSpotifyUtils(unittest.TestCase):
     def setUpClass(cls):
         logging.getLogger('spotify_utils').setLevel(logging.CRITICAL)
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_track_basic(self, mock_song_info):
         mock_song_info.return_value = _make_track_response()
 
@@ -150,7 +160,7 @@ class TestSpotifyUtils(unittest.TestCase):
 
         mock_song_info.assert_called_once_with('789')
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_track_multiple_artists(self, mock_song_info):
         mock_song_info.return_value = _make_track_response(
             name='Collaboration Song',
@@ -179,7 +189,7 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertEqual(result['Released'], 'June 2023')
         self.assertEqual(result['title'], 'Artist One, Artist Two - Collaboration Song')
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_track_single_track_album(self, mock_song_info):
         mock_song_info.return_value = _make_track_response(
             name='Single Track',
@@ -200,11 +210,9 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertEqual(result['Released'], '2023')
         self.assertEqual(result['Duration'], '`4:00`')
 
-    @patch('spotify_utils.PublicAlbum')
-    def test_getSpotifyParts_album_basic(self, mock_album_class):
-        mock_instance = MagicMock()
-        mock_album_class.return_value = mock_instance
-        mock_instance.get_album_info.return_value = _make_album_response()
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_getSpotifyParts_album_basic(self, mock_album_info):
+        mock_album_info.return_value = _make_album_response()
 
         result = getSpotifyParts('https://open.spotify.com/album/test-album')
 
@@ -225,11 +233,9 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertIn('Tracks', result)
         self.assertIn('1. [Track One](https://open.spotify.com/track/1)', result['Tracks'])
 
-    @patch('spotify_utils.PublicAlbum')
-    def test_getSpotifyParts_album_various_artists(self, mock_album_class):
-        mock_instance = MagicMock()
-        mock_album_class.return_value = mock_instance
-        mock_instance.get_album_info.return_value = _make_album_response(
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_getSpotifyParts_album_various_artists(self, mock_album_info):
+        mock_album_info.return_value = _make_album_response(
             name='Compilation Album',
             album_uri='spotify:album:compilation',
             artists=[{
@@ -270,7 +276,7 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertIn('[Artist A - Song A]', result['Tracks'])
         self.assertIn('[Artist B - Song B]', result['Tracks'])
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_track_with_remix_title(self, mock_song_info):
         mock_song_info.return_value = _make_track_response(
             name='Original Song - Remixer Remix',
@@ -285,7 +291,7 @@ class TestSpotifyUtils(unittest.TestCase):
 
         self.assertEqual(result['title'], 'Original Artist - Original Song (Remixer Remix)')
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_error_handling(self, mock_song_info):
         mock_song_info.side_effect = Exception('API Error')
 
@@ -295,7 +301,7 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertEqual(result['embedColour'], 0x1db954)
         self.assertNotIn('title', result)
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_track_no_data(self, mock_song_info):
         mock_song_info.return_value = None
 
@@ -305,7 +311,7 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertEqual(result['embedColour'], 0x1db954)
         self.assertNotIn('title', result)
 
-    @patch('spotify_utils.Public.song_info')
+    @patch('spotify_utils.spotify_client.song_info')
     def test_getSpotifyParts_intl_track_basic(self, mock_song_info):
         mock_song_info.return_value = _make_track_response(
             name='German Track',
@@ -341,11 +347,9 @@ class TestSpotifyUtils(unittest.TestCase):
 
         mock_song_info.assert_called_once_with('1QeliItLbS0fvWbJA2dxMX')
 
-    @patch('spotify_utils.PublicAlbum')
-    def test_getSpotifyParts_intl_album_basic(self, mock_album_class):
-        mock_instance = MagicMock()
-        mock_album_class.return_value = mock_instance
-        mock_instance.get_album_info.return_value = _make_album_response(
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_getSpotifyParts_intl_album_basic(self, mock_album_info):
+        mock_album_info.return_value = _make_album_response(
             name='International Album',
             album_uri='spotify:album:intl',
             artists=[{
@@ -401,14 +405,251 @@ class TestSpotifyUtils(unittest.TestCase):
         self.assertIn('Tracks', result)
         self.assertIn('1. [Intl Track One](https://open.spotify.com/track/intl1)', result['Tracks'])
 
-    @patch('spotify_utils.PublicAlbum')
-    def test_getSpotifyParts_album_error_handling(self, mock_album_class):
-        mock_instance = MagicMock()
-        mock_album_class.return_value = mock_instance
-        mock_instance.get_album_info.side_effect = Exception('Network error')
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_getSpotifyParts_album_error_handling(self, mock_album_info):
+        mock_album_info.side_effect = Exception('Network error')
 
         result = getSpotifyParts('https://open.spotify.com/album/error-album')
 
         self.assertEqual(result['embedPlatformType'], 'spotify')
         self.assertEqual(result['embedColour'], 0x1db954)
         self.assertNotIn('title', result)
+
+
+def _make_album_page(start, count, total, duration_ms=60000):
+    return _make_album_response(
+        name='Big Compilation',
+        total_tracks=total,
+        track_items=[{
+            'track': {
+                'name': f'Track {n}',
+                'trackNumber': n,
+                'uri': f'spotify:track:{n}',
+                'duration': {'totalMilliseconds': duration_ms},
+                'artists': {'items': [{'profile': {'name': 'Test Artist'},
+                                       'uri': 'spotify:artist:test'}]},
+            }
+        } for n in range(start + 1, start + count + 1)])
+
+
+class TestSpotifyAlbumPagination(unittest.TestCase):
+
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_large_album_counts_every_page(self, mock_album_info):
+        pages = {0: _make_album_page(0, 50, 420), 50: _make_album_page(50, 343, 420),
+                 393: _make_album_page(393, 27, 420)}
+        mock_album_info.side_effect = (
+            lambda _album_id, offset=0, **_page: pages[offset])
+
+        result = getSpotifyParts('https://open.spotify.com/album/big')
+
+        self.assertEqual(result['Duration'], '`7:00:00`')
+        self.assertEqual(result['description'], '420 track album')
+        self.assertIn('more', result['Tracks'])
+        self.assertEqual(
+            [call.kwargs['limit'] for call in mock_album_info.call_args_list],
+            [50, 343, 343])
+
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_short_first_page_is_the_last(self, mock_album_info):
+        mock_album_info.return_value = _make_album_page(0, 2, 3)
+
+        getSpotifyParts('https://open.spotify.com/album/short')
+
+        mock_album_info.assert_called_once()
+
+    @patch('spotify_utils.spotify_client.album_info')
+    def test_out_of_time_stops_paging(self, mock_album_info):
+        mock_album_info.return_value = _make_album_page(0, 50, 420)
+
+        with deadlines.budget(0) as budget:
+            result = getSpotifyParts('https://open.spotify.com/album/late')
+
+        mock_album_info.assert_called_once()
+        self.assertNotIn('Duration', result)
+        self.assertEqual(result['description'], '420 track album')
+        self.assertEqual(budget.dropped, ['spotify tracks page'])
+
+
+def _make_playlist_response(start=0, count=2, total=2, followers=1234):
+    return {
+        'data': {
+            'playlistV2': {
+                'name': 'Test Playlist',
+                'description': 'Songs for testing',
+                'followers': followers,
+                'ownerV2': {'data': {'name': 'Test Curator',
+                                     'uri': 'spotify:user:curator'}},
+                'images': {'items': [{'sources': [
+                    {'url': 'https://example.com/small.jpg',
+                     'height': 60, 'width': 60},
+                    {'url': 'https://example.com/large.jpg',
+                     'height': 640, 'width': 640},
+                ]}]},
+                'content': {
+                    'totalCount': total,
+                    'items': [{
+                        'itemV2': {'data': {
+                            '__typename': 'Track',
+                            'name': f'Song {n}',
+                            'uri': f'spotify:track:{n}',
+                            'trackDuration': {'totalMilliseconds': 120000},
+                            'artists': {'items': [{'profile': {'name': 'Artist'},
+                                                   'uri': 'spotify:artist:a'}]},
+                            'albumOfTrack': {'name': 'Album',
+                                             'uri': 'spotify:album:a'},
+                        }}
+                    } for n in range(start + 1, start + count + 1)],
+                },
+            }
+        }
+    }
+
+
+class TestSpotifyPlaylist(unittest.TestCase):
+
+    @patch('spotify_utils.spotify_client.playlist_info')
+    def test_getSpotifyParts_playlist_basic(self, mock_playlist_info):
+        mock_playlist_info.return_value = _make_playlist_response()
+
+        result = getSpotifyParts('https://open.spotify.com/playlist/test')
+
+        self.assertEqual(result['title'], 'Test Playlist')
+        self.assertEqual(result['description'], 'Playlist (2 tracks)')
+        self.assertEqual(result['thumbnailUrl'], 'https://example.com/large.jpg')
+        self.assertEqual(result['Created by'],
+                         '[Test Curator](https://open.spotify.com/user/curator)')
+        self.assertEqual(result['Followers'], '1,234')
+        self.assertEqual(result['Duration'], '`4:00`')
+        self.assertEqual(
+            result['Tracks'],
+            '1. [Artist - Song 1](https://open.spotify.com/track/1) `2:00`\n'
+            '2. [Artist - Song 2](https://open.spotify.com/track/2) `2:00`')
+
+    @patch('spotify_utils.spotify_client.playlist_info')
+    def test_getSpotifyParts_large_playlist_stops_at_budget(
+            self, mock_playlist_info):
+        mock_playlist_info.return_value = _make_playlist_response(
+            count=50, total=600)
+
+        result = getSpotifyParts('https://open.spotify.com/playlist/big')
+
+        mock_playlist_info.assert_called_once()
+        self.assertEqual(result['description'], 'Playlist (600 tracks)')
+        self.assertNotIn('Duration', result)
+        self.assertRegex(result['Tracks'], r'\.\.\.and \d+ more$')
+
+    @patch('spotify_utils.spotify_client.playlist_info')
+    def test_getSpotifyParts_playlist_skips_unavailable_items(
+            self, mock_playlist_info):
+        response = _make_playlist_response(total=3)
+        response['data']['playlistV2']['content']['items'].insert(
+            0, {'itemV2': {'data': {'__typename': 'NotFound'}}})
+        mock_playlist_info.return_value = response
+
+        result = getSpotifyParts('https://open.spotify.com/playlist/test')
+
+        self.assertEqual(
+            result['Tracks'].splitlines()[:2],
+            ['1. [Artist - Song 1](https://open.spotify.com/track/1) `2:00`',
+             '2. [Artist - Song 2](https://open.spotify.com/track/2) `2:00`'])
+        self.assertIn('...and 1 more', result['Tracks'])
+
+
+def _make_base_client(expires_in_ms=3_600_000):
+    base = MagicMock()
+    base.client_token = 'client-token'
+    base.access_token = 'access-token'
+    base.access_token_expires_at_ms = time.time() * 1000 + expires_in_ms
+    return base
+
+
+class TestSpotifyClient(unittest.TestCase):
+
+    @patch('spotify_utils.Song.get_track_info')
+    @patch('spotify_utils.BaseClient')
+    def test_reuses_one_session_across_lookups(self, mock_base_class,
+                                               mock_get_track_info):
+        mock_base_class.return_value = _make_base_client()
+        mock_get_track_info.return_value = _make_track_response()
+        client = SpotifyClient(client_factory=MagicMock)
+
+        client.song_info('1')
+        client.song_info('2')
+
+        mock_base_class.assert_called_once()
+        mock_base_class.return_value._get_auth_vars.assert_not_called()
+
+    def test_token_refresh_runs_under_the_auth_lock(self):
+        client = SpotifyClient(
+            client_factory=lambda: MagicMock(impersonate='chrome120'))
+        held = []
+
+        def record(_base, kwargs):
+            held.append(client._auth_lock._is_owned())
+            return kwargs
+
+        with patch('spotify_utils.BaseClient._auth_rule', record), \
+             patch('spotify_utils.BaseClient._handle_auth_failure',
+                   lambda _base, _response: True):
+            tls_client = client.base.client
+            tls_client.authenticate({})
+            self.assertTrue(tls_client.on_auth_failure(MagicMock(status_code=401)))
+
+        self.assertEqual(held, [True])
+
+
+class TestSpotifyTrackBatcher(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger('spotify_utils').setLevel(logging.CRITICAL)
+
+    @patch('spotify_utils.spotify_client.song_info')
+    async def test_duplicate_tracks_share_one_lookup(self, mock_song_info):
+        mock_song_info.side_effect = lambda track_id: _make_track_response(
+            name=f'Song {track_id}')
+
+        with patch('spotify_utils.spotify_batcher',
+                   WindowBatcher(fetch_track_infos)):
+            results = await asyncio.gather(
+                getSpotifyPartsAsync('https://open.spotify.com/track/1'),
+                getSpotifyPartsAsync('https://open.spotify.com/track/2'),
+                getSpotifyPartsAsync('https://open.spotify.com/track/1?si=x'),
+            )
+
+        self.assertEqual([r['title'] for r in results], [
+            'Test Artist - Song 1', 'Test Artist - Song 2',
+            'Test Artist - Song 1'
+        ])
+        self.assertEqual(sorted(c.args[0] for c in mock_song_info.call_args_list),
+                         ['1', '2'])
+
+    @patch('spotify_utils.spotify_client.song_info')
+    async def test_batch_fans_out_on_the_bulkhead(self, mock_song_info):
+        def song_info(track_id):
+            self.assertTrue(
+                threading.current_thread().name.startswith('bulkhead-spotify'))
+            return _make_track_response(
+                name=f'Song {track_id} {deadlines.remaining() > 25}')
+
+        mock_song_info.side_effect = song_info
+
+        with deadlines.budget(30):
+            results = await fetch_track_infos(['1', '2'])
+
+        self.assertEqual(
+            [r['data']['trackUnion']['name'] for r in results.values()],
+            ['Song 1 True', 'Song 2 True'])
+
+    @patch('spotify_utils.spotify_client.song_info')
+    async def test_failed_lookup_returns_bare_parts(self, mock_song_info):
+        mock_song_info.side_effect = Exception('Network error')
+
+        with patch('spotify_utils.spotify_batcher',
+                   WindowBatcher(fetch_track_infos)):
+            result = await getSpotifyPartsAsync(
+                'https://open.spotify.com/track/1')
+
+        self.assertNotIn('title', result)
+        self.assertEqual(result['embedPlatformType'], 'spotify')
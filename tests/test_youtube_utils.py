@@ -3,6 +3,7 @@ from unittest.mock import patch
 
 from mockData.youtube_mock_scenarios import setupBasicVideo
 
+from negative_cache import LinkUnavailable
 from youtube_utils import fetchVideoDescription, getYouTubeParts, isYoutubeMusic
 
 
@@ -91,6 +92,54 @@ class TestYoutubeUtils(unittest.TestCase):
             "An error occurred while fetching Youtube details: no track",
             str(context.exception))
 
+    @patch('youtube_utils.fetchTrack')
+    def test_getYouTubeParts_removed_video(self, mock_fetch_track):
+        # Arrange
+        mock_fetch_track.return_value = ({
+            'playabilityStatus': {
+                'status': 'ERROR',
+                'reason': 'Video unavailable'
+            }
+        }, 1)
+
+        # Act & Assert
+        with self.assertRaises(LinkUnavailable) as context:
+            getYouTubeParts('https://www.youtube.com/watch?v=123456789')
+        self.assertEqual(context.exception.reason, 'not_found')
+        self.assertEqual(str(context.exception), 'Video unavailable')
+
+    @patch('youtube_utils.ytmusic_breaker')
+    @patch('youtube_utils.ytmusic')
+    @patch('youtube_utils.fetchTrack')
+    def test_getYouTubeParts_playlist_durations_use_the_breaker(
+            self, mock_fetch_track, mock_ytmusic, mock_breaker):
+        # Arrange
+        mock_fetch_track.return_value = ({
+            'title': 'Mock Playlist',
+            'trackCount': 1,
+            'thumbnails': [],
+            'duration': '3 minutes',
+            'tracks': [{
+                'videoType': 'MUSIC_VIDEO_TYPE_UGC',
+                'title': 'Mock Video',
+                'videoId': 'abcdefghijk',
+                'duration': None
+            }]
+        }, 3)  # 3 is types.playlist
+        mock_breaker.call.side_effect = lambda fn, *args: fn(*args)
+        mock_ytmusic.get_song.return_value = setupBasicVideo()
+
+        # Act
+        result = getYouTubeParts(
+            'https://www.youtube.com/playlist?list=PL123456789')
+
+        # Assert
+        mock_breaker.call.assert_called_once_with(mock_ytmusic.get_song,
+                                                  'abcdefghijk')
+        self.assertEqual(
+            result['Videos'],
+            '1. [Mock Video](https://www.youtube.com/watch?v=abcdefghijk) `3:00`')
+
     @patch('youtube_utils.youtube_api')
     def test_fetchVideoDescription_success(self, mock_youtube_api):
         # Arrange
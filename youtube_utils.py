@@ -6,13 +6,18 @@ import tempfile
 
 from dotmap import DotMap
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 from ytmusicapi import OAuthCredentials, YTMusic
 
+import deadlines
+from async_http import REQUEST_TIMEOUT_SECONDS
+from circuit_breaker import circuit_breakers
 from general_utils import (
     formatMillisecondsToDurationString,
     formatTimeToDisplay,
     formatTimeToTimestamp,
 )
+from negative_cache import LinkUnavailable
 
 types = DotMap(track=1, album=2, playlist=3)
 
@@ -31,6 +36,7 @@ with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".json") as tf:
     temp_path = tf.name
 
 ytmusic = YTMusic(temp_path)
+ytmusic_breaker = circuit_breakers['ytmusic']
 
 # YouTube Data API configuration
 DEVELOPER_KEY = os.getenv("YOUTUBE_API_KEY")
@@ -47,19 +53,21 @@ def fetchTrack(track_url):
     videoId = re.search(r'(?:v=|\/)([0-9A-Za-z_-]{11}).*', track_url)
     if videoId is not None:
         videoId = videoId.group(1)
-        track = ytmusic.get_song(videoId)
+        track = ytmusic_breaker.call(ytmusic.get_song, videoId)
         trackType = types.track
     else:
         playlistId = re.search(r'playlist\?list=([^&]*)', track_url)
         if playlistId is not None:
             playlistId = playlistId.group(1)
-            track = ytmusic.get_playlist(playlistId)
+            track = ytmusic_breaker.call(ytmusic.get_playlist, playlistId)
             trackType = types.playlist
-            if not track.get('duration'):
-                albumBrowseId = ytmusic.get_album_browse_id(playlistId)
+            if not track.get('duration') and deadlines.allows(
+                    'youtube album'):
+                albumBrowseId = ytmusic_breaker.call(ytmusic.get_album_browse_id,
+                                                     playlistId)
                 if albumBrowseId:
                     try:
-                        track = ytmusic.get_album(albumBrowseId)
+                        track = ytmusic_breaker.call(ytmusic.get_album, albumBrowseId)
                         trackType = types.album
                     except Exception as e:
                         print(f"Error getting album browse id: {e}")
@@ -76,6 +84,14 @@ def getYouTubeParts(url: str):
             'An error occurred while fetching Youtube details: no track')
 
     if type is types.track:
+        if 'videoDetails' not in track:
+            #removed or private video
+            status = track.get('playabilityStatus', {})
+            raise LinkUnavailable(
+                'private' if status.get('status') == 'LOGIN_REQUIRED' else
+                'not_found',
+                status.get('reason') or 'This video is unavailable.')
+
         #Title
         videoTitle = track['videoDetails']['title']
         if videoTitle:
@@ -193,7 +209,6 @@ def getYouTubeParts(url: str):
         trackStrings = []
         trackSummaryCharLength = 0
         maxDisplayableTracksReached = False
-        ytMusic = YTMusic()
         for trackEntry in track['tracks']:
             if maxDisplayableTracksReached:
                 break
@@ -209,11 +224,14 @@ def getYouTubeParts(url: str):
                 trackUrl = f'https://www.youtube.com/watch?v={trackEntry["videoId"]}'
 
             if not trackEntry.get('duration'):
-                song = ytMusic.get_song(trackEntry['videoId'])
-                trackDuration = getVideoDisplayDuration(song)
+                trackDuration = ''
+                if deadlines.allows('youtube video duration'):
+                    song = ytmusic_breaker.call(ytmusic.get_song,
+                                                trackEntry['videoId'])
+                    trackDuration = getVideoDisplayDuration(song)
             else:
                 trackDuration = f'`{trackEntry["duration"]}`'
-            trackString = f'1. [{trackTitle}]({trackUrl}) {trackDuration}'
+            trackString = f'1. [{trackTitle}]({trackUrl}) {trackDuration}'.rstrip()
 
             trackStringLength = len(trackString) + 1
             if trackSummaryCharLength + trackStringLength <= 1000:
@@ -227,7 +245,7 @@ def getYouTubeParts(url: str):
                 f'\n...and {totalVideos - len(trackStrings)} more')
 
     #description check
-    if 'videoDetails' in track:
+    if 'videoDetails' in track and deadlines.allows('youtube description'):
         description = fetchVideoDescription(track['videoDetails']['videoId'])
         if description:
             descriptionMatch = re.search('.+?\n\n(.+?)\n.*Released on: (.*?)\n',
@@ -286,7 +304,12 @@ def fetchVideoDescription(video_id):
 
     try:
         request = youtube_api.videos().list(part="snippet", id=video_id)
-        response = request.execute()
+        # the client's own connection waits up to a minute, too long for
+        # the embed's budget
+        http = build_http()
+        http.timeout = deadlines.request_timeout(REQUEST_TIMEOUT_SECONDS)
+        response = circuit_breakers['youtube_data_api'].call(request.execute,
+                                                             http=http)
 
         if response.get('items'):
             return response['items'][0]['snippet']['description']